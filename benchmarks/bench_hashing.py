@@ -0,0 +1,280 @@
+#
+# Micro-benchmarks for the per-file hot paths: hash_file, get_file_type,
+# hash_file_lines, hash_csv_file_lines, createShingleFingerprints,
+# getShingles and analyze_file. Each function is run over each kind of
+# file in the generated corpus (see corpus.py) in a fresh process, and
+# reports MB/s, files/s, peak RSS and a digest of everything it returned.
+#
+#   python benchmarks/bench_hashing.py --corpus /tmp/knps-corpus
+#   python benchmarks/bench_hashing.py --corpus /tmp/knps-corpus --json results.json
+#   python benchmarks/bench_hashing.py --corpus /tmp/knps-corpus --compare v0.1.0 HEAD
+#
+# --compare checks each revision out into a temporary git worktree
+# (WORKTREE means the current checkout, uncommitted changes included) and
+# benchmarks both. A function more than --threshold percent slower is
+# flagged, and so is one whose results changed: differing getShingles
+# digests mean new MinHash signatures can't be compared with the ones the
+# server already holds. The exit status is 1 if anything was flagged.
+#
+import argparse
+import hashlib
+import json
+import mimetypes
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import corpus
+
+REPO = Path(__file__).resolve().parent.parent
+
+ALL_KINDS = ['text', 'log', 'csv', 'pdf', 'binary', 'many']
+TEXT_KINDS = ['text', 'log', 'csv', 'many']
+
+# Functions that take the file's text as a string aren't run on files
+# bigger than this
+MAX_STRING_BYTES = 256 * corpus.MB
+
+#
+# name -> (kinds of file it is run on, call(knps_cli, path, file_type, text))
+#
+BENCHMARKS = {
+    'hash_file': (ALL_KINDS, lambda k, path, file_type, text: k.hash_file(path)),
+    'get_file_type': (ALL_KINDS, lambda k, path, file_type, text: k.get_file_type(path)),
+    'hash_file_lines': (['text', 'log', 'csv', 'pdf', 'many'],
+                        lambda k, path, file_type, text: k.hash_file_lines(path, file_type)),
+    'hash_csv_file_lines': (['csv'], lambda k, path, file_type, text: k.hash_csv_file_lines(path)),
+    'createShingleFingerprints': (TEXT_KINDS,
+                                  lambda k, path, file_type, text: k.createShingleFingerprints(text, path, file_type)),
+    'getShingles': (TEXT_KINDS, lambda k, path, file_type, text: k.getShingles(text, path, file_type)),
+    'analyze_file': (ALL_KINDS, lambda k, path, file_type, text: k.analyze_file(path)),
+}
+
+NEEDS_TEXT = ('createShingleFingerprints', 'getShingles')
+
+# --compare doesn't call anything faster than this slower; it's noise
+MIN_COMPARE_SECONDS = 0.01
+
+#
+# Peak resident set size of this process so far, in bytes
+#
+def peak_rss():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+def file_type_of(path, kind):
+    file_type = mimetypes.guess_type(path)[0]
+    if file_type:
+        return file_type
+    return 'binary/unknown' if kind == 'binary' else 'text/unknown'
+
+#
+# Runs in the benchmark subprocess: time one function over the corpus
+# files of one kind (best of repeat runs) and print the result as JSON.
+#
+def run_worker(name, kind, corpus_dir, repeat):
+    started = time.perf_counter()
+    from knps import knps_cli as k
+    import_seconds = time.perf_counter() - started
+
+    kinds, call = BENCHMARKS[name]
+    result = {'function': name, 'kind': kind, 'module': k.__file__, 'import_seconds': import_seconds}
+    if not hasattr(k, name):
+        result['missing'] = True
+        return result
+
+    manifest = json.loads(Path(corpus_dir, 'manifest.json').read_text())
+    files = [f for f in manifest['files'] if f['kind'] == kind]
+    if name in NEEDS_TEXT:
+        files = [f for f in files if f['bytes'] <= MAX_STRING_BYTES]
+    paths = [str(Path(corpus_dir, f['path'])) for f in files]
+    file_types = [file_type_of(p, kind) for p in paths]
+    result['files'] = len(files)
+    result['bytes'] = sum(f['bytes'] for f in files)
+
+    rss_before = peak_rss()
+    best = None
+    digest = None
+    try:
+        for i in range(repeat):
+            # hash_file memoizes in-process
+            getattr(k, 'HASH_CACHE', {}).clear()
+
+            seconds = 0
+            cpu_seconds = 0
+            outputs = []
+            for path, file_type in zip(paths, file_types):
+                text = ''
+                if name in NEEDS_TEXT and file_type != 'text/csv':
+                    with open(path, 'rt') as f:
+                        text = f.read()
+
+                wall = time.perf_counter()
+                cpu = time.process_time()
+                outputs.append(call(k, path, file_type, text))
+                seconds += time.perf_counter() - wall
+                cpu_seconds += time.process_time() - cpu
+                text = None
+
+            if best is None or seconds < best[0]:
+                best = (seconds, cpu_seconds)
+            digest = hashlib.sha256(json.dumps(outputs, sort_keys=True, default=str).encode()).hexdigest()
+    except Exception as e:
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+        return result
+
+    seconds, cpu_seconds = best
+    result.update({
+        'seconds': seconds,
+        'cpu_seconds': cpu_seconds,
+        'mb_per_s': result['bytes'] / corpus.MB / seconds if seconds else None,
+        'files_per_s': len(files) / seconds if seconds else None,
+        'rss_before': rss_before,
+        'peak_rss': peak_rss(),
+        'digest': digest,
+    })
+    return result
+
+#
+# Benchmark the knps package found under src, one subprocess per
+# (function, kind).
+#
+def run_suite(src, corpus_dir, repeat, functions):
+    home = tempfile.mkdtemp(prefix='knps-bench-home-')
+    env = dict(os.environ, PYTHONPATH=str(src), HOME=home, KNPS_USE_HASH_CACHE='False')
+    manifest = json.loads(Path(corpus_dir, 'manifest.json').read_text())
+    kinds_present = {f['kind'] for f in manifest['files']}
+
+    results = []
+    for name in functions:
+        for kind in BENCHMARKS[name][0]:
+            if kind not in kinds_present:
+                continue
+            proc = subprocess.run([sys.executable, __file__, '--worker', name, kind,
+                                   '--corpus', str(corpus_dir), '--repeat', str(repeat)],
+                                  env=env, capture_output=True, text=True)
+            lines = proc.stdout.strip().splitlines()
+            try:
+                result = json.loads(lines[-1])
+            except (IndexError, ValueError):
+                result = {'function': name, 'kind': kind,
+                          'error': 'worker failed: {}'.format(proc.stderr.strip().splitlines()[-1:])}
+            results.append(result)
+            print_result(result)
+    return results
+
+def print_header():
+    print('{:<26} {:<7} {:>6} {:>9} {:>9} {:>10} {:>9}  {}'.format(
+        'function', 'kind', 'files', 'MB', 'MB/s', 'files/s', 'peak MB', 'digest'))
+
+def print_result(r):
+    if r.get('missing'):
+        print('{:<26} {:<7} (not in this revision)'.format(r['function'], r['kind']))
+    elif 'error' in r:
+        print('{:<26} {:<7} ERROR {}'.format(r['function'], r['kind'], r['error'][:80]))
+    else:
+        print('{:<26} {:<7} {:>6} {:>9.1f} {:>9.1f} {:>10.1f} {:>9.1f}  {}'.format(
+            r['function'], r['kind'], r['files'], r['bytes'] / corpus.MB, r['mb_per_s'] or 0,
+            r['files_per_s'] or 0, r['peak_rss'] / corpus.MB, r['digest'][:12]))
+
+#
+# Check out rev into a temporary worktree and return (path to its src, cleanup)
+#
+def checkout(rev):
+    if rev == 'WORKTREE':
+        return REPO / 'src', lambda: None
+
+    directory = tempfile.mkdtemp(prefix='knps-bench-rev-')
+    subprocess.run(['git', '-C', str(REPO), 'worktree', 'add', '--detach', directory, rev],
+                   check=True, capture_output=True)
+
+    def cleanup():
+        subprocess.run(['git', '-C', str(REPO), 'worktree', 'remove', '--force', directory], capture_output=True)
+    return Path(directory, 'src'), cleanup
+
+#
+# Print a side-by-side comparison and return the number of flagged rows
+#
+def compare(old_rev, old, new_rev, new, threshold):
+    old_by_key = {(r['function'], r['kind']): r for r in old}
+    flagged = 0
+
+    print()
+    print('{:<26} {:<7} {:>10} {:>10} {:>8} {:>9} {:>9}  {}'.format(
+        'function', 'kind', old_rev[:10], new_rev[:10], 'change', 'old MB', 'new MB', 'results'))
+    for r in new:
+        o = old_by_key.get((r['function'], r['kind']))
+        if o is None or o.get('missing') or r.get('missing') or 'error' in o or 'error' in r:
+            note = 'skipped' if o is None or o.get('missing') or r.get('missing') else 'error'
+            print('{:<26} {:<7} {}'.format(r['function'], r['kind'], note))
+            continue
+
+        change = (r['mb_per_s'] / o['mb_per_s'] - 1) * 100 if o['mb_per_s'] else 0
+        same = r['digest'] == o['digest']
+        flags = []
+        if change < -threshold and max(o['seconds'], r['seconds']) >= MIN_COMPARE_SECONDS:
+            flags.append('SLOWER')
+        if not same:
+            flags.append('RESULTS CHANGED')
+        flagged += bool(flags)
+        print('{:<26} {:<7} {:>10.1f} {:>10.1f} {:>+7.0f}% {:>9.1f} {:>9.1f}  {} {}'.format(
+            r['function'], r['kind'], o['mb_per_s'], r['mb_per_s'], change,
+            o['peak_rss'] / corpus.MB, r['peak_rss'] / corpus.MB, 'same' if same else 'differ', ' '.join(flags)))
+
+    shingles = [(old_by_key.get(('getShingles', r['kind']), {}).get('digest'), r.get('digest'))
+                for r in new if r['function'] == 'getShingles']
+    if shingles and all(a and b for a, b in shingles):
+        print()
+        print('MinHash signatures: {}'.format('compatible' if all(a == b for a, b in shingles) else 'INCOMPATIBLE'))
+    return flagged
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the KNPS hashing and fingerprinting functions')
+    parser.add_argument('--corpus', default=os.path.join(tempfile.gettempdir(), 'knps-bench-corpus'),
+                        help='Corpus directory (generated if missing)')
+    parser.add_argument('--size', choices=sorted(corpus.SIZES), default='small', help='Corpus size (default: small)')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per function; the fastest counts')
+    parser.add_argument('--function', action='append', choices=sorted(BENCHMARKS),
+                        help='Only benchmark this function (may be repeated)')
+    parser.add_argument('--json', help='Write the results to this file')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='Compare two git revisions')
+    parser.add_argument('--threshold', type=float, default=10, help='Slowdown (percent) flagged by --compare')
+    parser.add_argument('--worker', nargs=2, metavar=('FUNCTION', 'KIND'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_worker(args.worker[0], args.worker[1], args.corpus, args.repeat)))
+        return
+
+    corpus.generate(args.corpus, args.size)
+    functions = args.function or list(BENCHMARKS)
+
+    if not args.compare:
+        print_header()
+        results = run_suite(REPO / 'src', args.corpus, args.repeat, functions)
+        if args.json:
+            Path(args.json).write_text(json.dumps({'corpus': args.size, 'results': results}, indent=2))
+        return
+
+    runs = {}
+    for rev in args.compare:
+        src, cleanup = checkout(rev)
+        try:
+            print('\n{}'.format(rev))
+            print_header()
+            runs[rev] = run_suite(src, args.corpus, args.repeat, functions)
+        finally:
+            cleanup()
+
+    old_rev, new_rev = args.compare
+    flagged = compare(old_rev, runs[old_rev], new_rev, runs[new_rev], args.threshold)
+    if args.json:
+        Path(args.json).write_text(json.dumps({'corpus': args.size, 'runs': runs}, indent=2))
+    sys.exit(1 if flagged else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+#
+# Cold-start time of the knps command. Each command is run --runs times
+# in a fresh interpreter against a throwaway HOME with a logged-in user
+# and a small watched directory, and the median wall time is reported
+# next to that of a bare `python -c pass`, which no change to knps can
+# improve on.
+#
+#   python benchmarks/bench_startup.py
+#   python benchmarks/bench_startup.py --importtime
+#   python benchmarks/bench_startup.py --compare HEAD~1 WORKTREE
+#
+# The exit status is 1 if `knps --status` takes longer than --budget-ms.
+# --importtime also lists the modules that take longest to import
+# (python -X importtime), which is where a startup regression usually is.
+#
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from bench_hashing import checkout
+
+COMMANDS = [['--version'], ['--status'], ['--help']]
+BUDGET_COMMAND = ['--status']
+WATCHED_FILES = 100
+
+def knps_command(args):
+    return [sys.executable, '-c', 'from knps.knps_cli import main; main()'] + list(args)
+
+def time_command(command, env, runs):
+    times = []
+    for i in range(runs):
+        started = time.perf_counter()
+        proc = subprocess.run(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        times.append(time.perf_counter() - started)
+        if proc.returncode:
+            raise RuntimeError('{} failed: {}'.format(' '.join(command), proc.stderr.strip().splitlines()[-1:]))
+    return times
+
+#
+# A HOME with a logged-in user watching a directory of a few small files
+#
+def make_home(src):
+    home = tempfile.mkdtemp(prefix='knps-startup-home-')
+    env = dict(os.environ, HOME=home, PYTHONPATH=str(src))
+
+    watched = Path(home, 'data')
+    watched.mkdir()
+    for i in range(WATCHED_FILES):
+        Path(watched, 'file-{:03d}.txt'.format(i)).write_text('line {}\n'.format(i))
+
+    subprocess.run(knps_command(['--login_temp', 'startup']), env=env, capture_output=True, check=True)
+    subprocess.run(knps_command(['--watch', str(watched)]), env=env, capture_output=True, check=True)
+    return home, env
+
+#
+# Modules sorted by cumulative import time, in ms
+#
+def slowest_imports(env, args, top):
+    proc = subprocess.run([sys.executable, '-X', 'importtime'] + knps_command(args)[1:],
+                          env=env, capture_output=True, text=True)
+    imports = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        imports.append((int(cumulative_us) / 1000, name.rstrip()))
+    return sorted(imports, reverse=True)[:top]
+
+def run_suite(src, runs, importtime=False, top=15):
+    home, env = make_home(src)
+    try:
+        baseline = statistics.median(time_command([sys.executable, '-c', 'pass'], env, runs))
+        print('{:<12} {:>9} {:>9} {:>12}'.format('command', 'median', 'min', 'over python'))
+        print('{:<12} {:>7.1f}ms'.format('(python)', baseline * 1000))
+
+        results = {'python_ms': baseline * 1000, 'commands': {}}
+        for args in COMMANDS:
+            times = time_command(knps_command(args), env, runs)
+            median = statistics.median(times)
+            results['commands'][' '.join(args)] = {'median_ms': median * 1000, 'min_ms': min(times) * 1000}
+            print('{:<12} {:>7.1f}ms {:>7.1f}ms {:>10.1f}ms'.format(
+                ' '.join(args), median * 1000, min(times) * 1000, (median - baseline) * 1000))
+
+        if importtime:
+            print('\nSlowest imports for knps {}:'.format(' '.join(BUDGET_COMMAND)))
+            for ms, name in slowest_imports(env, BUDGET_COMMAND, top):
+                print('   {:>7.1f}ms  {}'.format(ms, name))
+        return results
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark knps command startup time')
+    parser.add_argument('--runs', type=int, default=15, help='Runs per command; the median counts')
+    parser.add_argument('--budget-ms', type=float, default=100, help='Budget for knps --status (median)')
+    parser.add_argument('--importtime', action='store_true', help='List the slowest imports')
+    parser.add_argument('--top', type=int, default=15, help='How many imports --importtime lists')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='Compare two git revisions')
+    parser.add_argument('--json', help='Write the results to this file')
+    args = parser.parse_args()
+
+    revisions = args.compare or ['WORKTREE']
+    runs = {}
+    for rev in revisions:
+        src, cleanup = checkout(rev)
+        try:
+            if args.compare:
+                print('\n{}'.format(rev))
+            runs[rev] = run_suite(src, args.runs, args.importtime, args.top)
+        finally:
+            cleanup()
+
+    if args.compare:
+        old, new = (runs[rev]['commands'] for rev in revisions)
+        print('\n{:<12} {:>10} {:>10} {:>8}'.format('command', revisions[0][:10], revisions[1][:10], 'change'))
+        for command in new:
+            print('{:<12} {:>8.1f}ms {:>8.1f}ms {:>+7.0f}%'.format(
+                command, old[command]['median_ms'], new[command]['median_ms'],
+                (new[command]['median_ms'] / old[command]['median_ms'] - 1) * 100))
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(runs, indent=2))
+
+    status_ms = runs[revisions[-1]]['commands'][' '.join(BUDGET_COMMAND)]['median_ms']
+    if status_ms > args.budget_ms:
+        print('\nknps {} took {:.1f}ms, over the {:.0f}ms budget'.format(' '.join(BUDGET_COMMAND), status_ms, args.budget_ms))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+#
+# Deterministic synthetic corpus for the benchmarks: prose, logs, CSV,
+# PDF and binary files from KB to multi-GB. The same seed and size always
+# give byte-identical files, so numbers from different runs and revisions
+# are comparable.
+#
+#   python benchmarks/corpus.py /tmp/knps-corpus --size small
+#
+import argparse
+import json
+import os
+import random
+from pathlib import Path
+
+KB = 1024
+MB = 1024 * KB
+GB = 1024 * MB
+
+SEED = 0x6b6e7073
+
+# kind -> file sizes, per corpus size. 'many' is a directory of small
+# files, for per-file overhead (files/s).
+SIZES = {
+    'tiny': {
+        'text': [4 * KB, 256 * KB],
+        'log': [256 * KB],
+        'csv': [256 * KB],
+        'pdf': [16 * KB],
+        'binary': [256 * KB],
+        'many': (50, 4 * KB),
+    },
+    'small': {
+        'text': [4 * KB, 1 * MB, 16 * MB],
+        'log': [1 * MB, 64 * MB],
+        'csv': [256 * KB, 32 * MB],
+        'pdf': [64 * KB, 2 * MB],
+        'binary': [1 * MB, 64 * MB],
+        'many': (1000, 4 * KB),
+    },
+    'large': {
+        'text': [4 * KB, 16 * MB, 256 * MB],
+        'log': [64 * MB, 1 * GB],
+        'csv': [32 * MB, 2 * GB],
+        'pdf': [2 * MB, 16 * MB],
+        'binary': [64 * MB, 2 * GB],
+        'many': (10000, 4 * KB),
+    },
+}
+
+EXTENSIONS = {'text': '.txt', 'log': '.log', 'csv': '.csv', 'pdf': '.pdf', 'binary': '.bin'}
+
+LINE_POOL = 4096
+WRITE_LINES = 8192
+
+def make_words(rng, count=2000):
+    letters = 'etaoinshrdlcumwfgypbvkjxqz'
+    weights = [13, 9, 8, 8, 7, 7, 6, 6, 6, 4, 4, 3, 3, 2, 2, 2, 2, 2, 2, 1, 1, 1, 1, 1, 1, 1]
+    return [''.join(rng.choices(letters, weights, k=rng.randint(1, 10))) for i in range(count)]
+
+def prose_line(rng, words):
+    line = ' '.join(rng.choices(words, k=rng.randint(4, 16)))
+    return line[0].upper() + line[1:] + rng.choice(['.', '.', '.', ',', '?', '!'])
+
+def log_line(rng, words, i):
+    level = rng.choices(['INFO', 'DEBUG', 'WARN', 'ERROR'], [70, 20, 8, 2])[0]
+    return '2022-03-{:02d}T{:02d}:{:02d}:{:02d}.{:03d}Z {} [{}] {} {}'.format(
+        1 + i % 28, i % 24, i % 60, (i * 7) % 60, i % 1000, level,
+        rng.choice(words), ' '.join(rng.choices(words, k=rng.randint(3, 10))), rng.randrange(1 << 20))
+
+def csv_line(rng, words):
+    return '{},{},{:.6f},{},"{}"'.format(rng.choice(words), rng.randrange(1000000), rng.random() * 1000,
+                                         rng.choice(['true', 'false']), ' '.join(rng.choices(words, k=rng.randint(1, 6))))
+
+#
+# Write lines drawn from a fixed pool until the file reaches size bytes.
+# Drawing from a pool keeps generation fast enough for multi-GB files.
+#
+def write_lines(path, size, rng, pool, header=None, numbered=False):
+    written = 0
+    row = 0
+    with open(path, 'w', newline='\n') as f:
+        if header:
+            f.write(header + '\n')
+            written += len(header) + 1
+        while written < size:
+            lines = rng.choices(pool, k=WRITE_LINES)
+            if numbered:
+                lines = ['{},{}'.format(row + i, line) for i, line in enumerate(lines)]
+                row += len(lines)
+            block = '\n'.join(lines) + '\n'
+            if written + len(block) > size:
+                block = block[:size - written]
+                block = block[:block.rfind('\n') + 1] or block
+            f.write(block)
+            written += len(block)
+
+def randbytes(rng, n):
+    return rng.getrandbits(n * 8).to_bytes(n, 'little')
+
+def write_binary(path, size, rng):
+    # Half random bytes, half repeated runs, so it is neither all noise
+    # nor trivially compressible
+    pattern = randbytes(rng, 64 * KB)
+    with open(path, 'wb') as f:
+        written = 0
+        while written < size:
+            n = min(MB, size - written)
+            f.write(randbytes(rng, n) if (written // MB) % 2 == 0 else (pattern * (n // len(pattern) + 1))[:n])
+            written += n
+
+#
+# A minimal PDF with one text stream per page, about 40 lines each, that
+# PyPDF2 can extract.
+#
+def write_pdf(path, size, rng, words):
+    objects = {1: '<< /Type /Catalog /Pages 2 0 R >>',
+               3: '<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>'}
+    kids = []
+    n = 4
+    total = 0
+    while total < size or not kids:
+        lines = ' '.join("({}) '".format(prose_line(rng, words).replace('(', '').replace(')', '')) for i in range(40))
+        text = 'BT /F1 10 Tf 50 750 Td 12 TL {} ET'.format(lines)
+        objects[n] = ('<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] '
+                      '/Resources << /Font << /F1 3 0 R >> >> /Contents {} 0 R >>'.format(n + 1))
+        objects[n + 1] = '<< /Length {} >>\nstream\n{}\nendstream'.format(len(text), text)
+        kids.append('{} 0 R'.format(n))
+        total += len(text) + 200
+        n += 2
+    objects[2] = '<< /Type /Pages /Kids [{}] /Count {} >>'.format(' '.join(kids), len(kids))
+
+    out = bytearray(b'%PDF-1.4\n')
+    offsets = {}
+    for i in sorted(objects):
+        offsets[i] = len(out)
+        out += '{} 0 obj\n{}\nendobj\n'.format(i, objects[i]).encode()
+    xref = len(out)
+    out += 'xref\n0 {}\n0000000000 65535 f \n'.format(n).encode()
+    for i in range(1, n):
+        out += '{:010d} 00000 n \n'.format(offsets[i]).encode()
+    out += 'trailer\n<< /Size {} /Root 1 0 R >>\nstartxref\n{}\n%%EOF\n'.format(n, xref).encode()
+    with open(path, 'wb') as f:
+        f.write(out)
+
+def size_name(size):
+    for unit, name in [(GB, 'GB'), (MB, 'MB'), (KB, 'KB')]:
+        if size >= unit:
+            return '{}{}'.format(size // unit, name)
+    return '{}B'.format(size)
+
+#
+# Generate the corpus (unless the directory already holds the same one)
+# and return its manifest: {'size': ..., 'seed': ..., 'files': [{'path',
+# 'kind', 'bytes'}, ...]} with paths relative to the corpus directory.
+#
+def generate(directory, size='small', seed=SEED):
+    directory = Path(directory)
+    manifest_path = directory / 'manifest.json'
+    if manifest_path.exists():
+        manifest = json.loads(manifest_path.read_text())
+        if manifest.get('size') == size and manifest.get('seed') == seed:
+            return manifest
+
+    directory.mkdir(parents=True, exist_ok=True)
+    files = []
+    for kind, sizes in SIZES[size].items():
+        if kind == 'many':
+            continue
+        for file_size in sizes:
+            # Every file gets its own generator, so adding a file to a
+            # size class doesn't change the others
+            rng = random.Random('{}-{}-{}'.format(seed, kind, file_size))
+            words = make_words(rng)
+            path = directory / '{}-{}{}'.format(kind, size_name(file_size), EXTENSIONS[kind])
+            print('Generating {} ({})'.format(path.name, size_name(file_size)))
+
+            if kind == 'text':
+                write_lines(path, file_size, rng, [prose_line(rng, words) for i in range(LINE_POOL)])
+            elif kind == 'log':
+                write_lines(path, file_size, rng, [log_line(rng, words, i) for i in range(LINE_POOL)])
+            elif kind == 'csv':
+                write_lines(path, file_size, rng, [csv_line(rng, words) for i in range(LINE_POOL)],
+                            header='id,word,count,value,flag,comment', numbered=True)
+            elif kind == 'pdf':
+                write_pdf(path, file_size, rng, words)
+            elif kind == 'binary':
+                write_binary(path, file_size, rng)
+            files.append({'path': path.name, 'kind': kind, 'bytes': path.stat().st_size})
+
+    count, file_size = SIZES[size]['many']
+    many = directory / 'many'
+    many.mkdir(exist_ok=True)
+    rng = random.Random('{}-many'.format(seed))
+    words = make_words(rng)
+    pool = [prose_line(rng, words) for i in range(LINE_POOL)]
+    print('Generating {} small files'.format(count))
+    for i in range(count):
+        path = many / 'file-{:05d}.txt'.format(i)
+        write_lines(path, file_size, rng, pool)
+        files.append({'path': os.path.join('many', path.name), 'kind': 'many', 'bytes': path.stat().st_size})
+
+    manifest = {'size': size, 'seed': seed, 'files': files}
+    manifest_path.write_text(json.dumps(manifest, indent=2))
+    return manifest
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate the benchmark corpus')
+    parser.add_argument('directory', help='Where to write the corpus')
+    parser.add_argument('--size', choices=sorted(SIZES), default='small', help='Corpus size (default: small)')
+    parser.add_argument('--seed', type=int, default=SEED, help='Random seed')
+    args = parser.parse_args()
+
+    manifest = generate(args.directory, args.size, args.seed)
+    print('{} files, {:.1f} MB'.format(len(manifest['files']), sum(f['bytes'] for f in manifest['files']) / MB))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+#
+# End-to-end sync load test. Generates a tree of small files, starts a
+# stand-in server in this process (see knps.standin_server) and runs
+# `knps --sync` against it as a separate process with its own HOME, the
+# way a user would.
+#
+#   python benchmarks/load_test.py --files 10000
+#   python benchmarks/load_test.py --files 1000000 --jobs 4 --latency-ms 20 --max-kbps 2048
+#
+# Three scenarios are run in order:
+#
+#   initial   first sync of the whole tree
+#   noop      sync again with nothing changed
+#   failures  change --change-fraction of the files, sync while the server
+#             fails --error-rate of uploads, then sync again with it
+#             healthy. Reports how many changed files reached the server,
+#             how many were sent twice, and how long recovery took.
+#
+# Each scenario reports wall time, files/s and the bytes on the wire.
+#
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO / 'src'))
+
+from knps.standin_server import Faults, make_server
+
+FILES_PER_DIR = 1000
+USERNAME = 'loadtest'
+
+#
+# A tree of small text files (a few hundred bytes to a few KB of text),
+# FILES_PER_DIR to a directory. Reused if it already has the right count.
+#
+def generate_tree(directory, files, seed=0):
+    directory = Path(directory)
+    marker = directory / '.loadtest.json'
+    if marker.exists() and json.loads(marker.read_text()) == {'files': files, 'seed': seed}:
+        return
+
+    shutil.rmtree(directory, ignore_errors=True)
+    rng = random.Random(seed)
+    words = [''.join(rng.choices('etaoinshrdlcumwfgypb', k=rng.randint(2, 9))) for i in range(1000)]
+    lines = [' '.join(rng.choices(words, k=rng.randint(4, 14))) for i in range(2000)]
+
+    print('Generating {} files in {}'.format(files, directory))
+    for i in range(files):
+        d = directory / 'd{:04d}'.format(i // FILES_PER_DIR)
+        if i % FILES_PER_DIR == 0:
+            d.mkdir(parents=True)
+        with open(d / 'f{:07d}.txt'.format(i), 'w') as f:
+            f.write('file {}\n'.format(i))
+            f.write('\n'.join(rng.choices(lines, k=rng.randint(2, 40))))
+            f.write('\n')
+    marker.write_text(json.dumps({'files': files, 'seed': seed}))
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.home = tempfile.mkdtemp(prefix='knps-load-home-')
+        self.faults = Faults(args.latency_ms, args.jitter_ms, 0, args.max_kbps, seed=1)
+        self.server = make_server('127.0.0.1', 0, blob_dir=os.path.join(self.home, 'blobs'), faults=self.faults)
+        self.state = self.server.RequestHandlerClass.state
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.env = dict(os.environ, HOME=self.home, PYTHONPATH=str(REPO / 'src'))
+        if args.no_spool:
+            self.env['KNPS_USE_SPOOL'] = 'False'
+        self.results = []
+
+    def knps(self, *args):
+        started = time.perf_counter()
+        proc = subprocess.run([sys.executable, '-c', 'from knps.knps_cli import main; main()'] + list(args),
+                              env=self.env, capture_output=True, text=True)
+        seconds = time.perf_counter() - started
+        if self.args.verbose or proc.returncode:
+            print(proc.stdout[-2000:], proc.stderr[-2000:])
+        return proc, seconds
+
+    def setup(self):
+        shutil.rmtree(Path(self.args.tree, '.knps'), ignore_errors=True)
+        self.knps('--server', '127.0.0.1:{}'.format(self.server.server_address[1]))
+        self.knps('--login_temp', USERNAME)
+        self.knps('--watch', str(self.args.tree))
+
+    def sync(self):
+        args = ['--sync']
+        if self.args.jobs > 1:
+            args += ['--jobs', str(self.args.jobs)]
+        return self.knps(*args)
+
+    def record(self, scenario, files, seconds, stats, **extra):
+        result = dict({
+            'scenario': scenario,
+            'files': files,
+            'seconds': seconds,
+            'files_per_s': files / seconds if seconds and files else None,
+            'observations': stats['observations'],
+            'bytes_received': stats['bytes_received'],
+            'bytes_sent': stats['bytes_sent'],
+            'requests': stats['requests'],
+            'failures_injected': stats['failures_injected'],
+        }, **extra)
+        self.results.append(result)
+
+        print('{:<9} {:>9} files {:>8.1f}s {:>9} files/s  {:>8.1f} MB up {:>7.2f} MB down  {:>6} requests  {:>5} injected failures'.format(
+            scenario, files, seconds, '{:.0f}'.format(result['files_per_s']) if result['files_per_s'] else '-',
+            stats['bytes_received'] / 1e6, stats['bytes_sent'] / 1e6, stats['requests'], stats['failures_injected']))
+        for key, value in extra.items():
+            print('          {}: {}'.format(key, value))
+
+    def run(self):
+        files = self.args.files
+        self.setup()
+
+        self.state.reset()
+        proc, seconds = self.sync()
+        self.record('initial', files, seconds, self.state.snapshot())
+
+        self.state.reset()
+        proc, seconds = self.sync()
+        self.record('noop', 0, seconds, self.state.snapshot())
+
+        # Change some files, then sync them while the server is flaky
+        rng = random.Random(2)
+        changed = rng.sample(range(files), max(1, int(files * self.args.change_fraction)))
+        for i in changed:
+            path = Path(self.args.tree, 'd{:04d}'.format(i // FILES_PER_DIR), 'f{:07d}.txt'.format(i))
+            with open(path, 'a') as f:
+                f.write('changed {}\n'.format(time.time()))
+
+        self.state.reset()
+        self.faults.update({'error_rate': self.args.error_rate})
+        proc, failing_seconds = self.sync()
+        failing = self.state.snapshot()
+        self.faults.update({'error_rate': 0})
+        proc, recovery_seconds = self.sync()
+        total = self.state.snapshot()
+
+        self.record('failures', len(changed), failing_seconds + recovery_seconds, total,
+                    error_rate=self.args.error_rate,
+                    delivered_while_failing=failing['observations'],
+                    delivered_after_recovery=total['observations'] - failing['observations'],
+                    recovery_seconds=round(recovery_seconds, 2),
+                    missing=max(0, len(changed) - total['observations']),
+                    duplicates=max(0, total['observations'] - len(changed)))
+
+    def close(self):
+        self.server.shutdown()
+        shutil.rmtree(self.home, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end knps --sync load test against a local stand-in server')
+    parser.add_argument('--files', type=int, default=10000, help='Files in the generated tree')
+    parser.add_argument('--tree', help='Where to generate the tree (default: a directory under the temp dir)')
+    parser.add_argument('--jobs', type=int, default=1, help='Passed to knps --sync --jobs')
+    parser.add_argument('--latency-ms', type=float, default=0, help='Server latency per upload')
+    parser.add_argument('--jitter-ms', type=float, default=0, help='Random extra server latency')
+    parser.add_argument('--max-kbps', type=float, default=0, help='Server upload throughput limit (0: none)')
+    parser.add_argument('--error-rate', type=float, default=0.5, help='Fraction of uploads failed in the failures scenario')
+    parser.add_argument('--change-fraction', type=float, default=0.05, help='Fraction of files changed in the failures scenario')
+    parser.add_argument('--no-spool', action='store_true', help='Run the client with the upload spool off')
+    parser.add_argument('--json', help='Write the results to this file')
+    parser.add_argument('--verbose', action='store_true', help='Show knps output')
+    args = parser.parse_args()
+
+    if args.tree is None:
+        args.tree = os.path.join(tempfile.gettempdir(), 'knps-load-{}'.format(args.files))
+    generate_tree(args.tree, args.files)
+
+    test = LoadTest(args)
+    try:
+        test.run()
+    finally:
+        test.close()
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(test.results, indent=2))
+
+if __name__ == '__main__':
+    main()
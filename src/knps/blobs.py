@@ -0,0 +1,193 @@
+import hashlib
+import json
+import os
+import re
+import threading
+from pathlib import Path
+
+import requests
+
+# Blob bodies are streamed in blocks of this size
+BLOB_BLOCK_SIZE = 1024 * 1024
+
+# Hashes per "which of these do you have?" request
+MISSING_BATCH = 1000
+
+# Attempts at one blob before giving up; each retry resumes where the
+# server says the last one stopped
+UPLOAD_ATTEMPTS = 3
+
+HASH_RE = re.compile(r'^[0-9a-f]{32}$')
+
+class BlobError(Exception):
+    pass
+
+#
+# The blobs making up a file, as a list of (hash, offset, size): its
+# content-defined chunks if it has them, otherwise the whole file.
+#
+def file_blobs(file_hash, file_size, chunks=None):
+    if not chunks:
+        return [(file_hash, 0, file_size)]
+
+    blobs = []
+    offset = 0
+    for chunk_hash, size in chunks:
+        blobs.append((chunk_hash, offset, size))
+        offset += size
+    return blobs
+
+def iter_file_range(path, offset, size, block_size=BLOB_BLOCK_SIZE):
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while size > 0:
+            block = f.read(min(block_size, size))
+            if not block:
+                raise BlobError('{} is shorter than expected'.format(path))
+            size -= len(block)
+            yield block
+
+#
+# Client side of content-addressed storage. Blobs are named by the MD5 of
+# their bytes, so the server is asked which it is missing and only those
+# are sent, each as a raw streamed (chunked) request body. A blob the
+# server has part of is resumed from where it got to.
+#
+#   POST {server}/blobs/missing/{user}      hashes=[...]  -> {'missing': [...]}
+#   GET  {server}/blobs/{user}/{hash}                     -> {'offset': bytes held}
+#   PUT  {server}/blobs/{user}/{hash}?offset=N&size=S     body: bytes N..S
+#
+class BlobUploader:
+    def __init__(self, base_url, username, access_token):
+        self.base_url = base_url
+        self.username = username
+        self.access_token = access_token
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = 'Bearer {}'.format(access_token)
+        self.counts = {'blobs': 0, 'bytes': 0, 'resumed': 0}
+
+    def __blob_url__(self, blob_hash):
+        return '{}/blobs/{}/{}'.format(self.base_url, self.username, blob_hash)
+
+    def missing(self, hashes):
+        hashes = list(dict.fromkeys(hashes))
+        missing = []
+        for i in range(0, len(hashes), MISSING_BATCH):
+            response = self.session.post('{}/blobs/missing/{}'.format(self.base_url, self.username),
+                                         files={'hashes': json.dumps(hashes[i:i + MISSING_BATCH])},
+                                         data={'username': self.username, 'access_token': self.access_token})
+            response.raise_for_status()
+            missing.extend(response.json()['missing'])
+        return missing
+
+    def __offset__(self, blob_hash):
+        response = self.session.get(self.__blob_url__(blob_hash))
+        response.raise_for_status()
+        return response.json().get('offset', 0)
+
+    #
+    # Send size bytes of path starting at offset as blob_hash. Returns once
+    # the server has the whole blob; raises BlobError if it can't get it
+    # there in UPLOAD_ATTEMPTS tries.
+    #
+    def upload(self, path, blob_hash, offset, size):
+        sent = 0
+        error = None
+        for attempt in range(UPLOAD_ATTEMPTS):
+            try:
+                held = self.__offset__(blob_hash) if attempt else 0
+                if attempt and held >= size:
+                    break
+                if held:
+                    self.counts['resumed'] += 1
+
+                response = self.session.put(self.__blob_url__(blob_hash),
+                                            params={'offset': held, 'size': size},
+                                            data=iter_file_range(path, offset + held, size - held))
+                if response.status_code == 409:
+                    # The server holds a different amount than we thought;
+                    # ask again and carry on from there
+                    error = 'offset mismatch'
+                    continue
+                if response.status_code >= 400:
+                    raise BlobError('{}: {}'.format(response.status_code, response.text.strip()))
+                sent += size - held
+                break
+            except requests.RequestException as e:
+                error = str(e)
+        else:
+            raise BlobError('Could not upload {} of {}: {}'.format(blob_hash, path, error))
+
+        self.counts['blobs'] += 1
+        self.counts['bytes'] += sent
+
+    def close(self):
+        self.session.close()
+
+#
+# Server side, for the stand-in server: blobs are files named by hash,
+# with partial uploads kept as <hash>.partial until they are complete and
+# their MD5 checks out.
+#
+class BlobStore:
+    def __init__(self, directory):
+        self.dir = Path(directory)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+
+    def __path__(self, blob_hash, partial=False):
+        if not HASH_RE.match(blob_hash):
+            raise BlobError('Bad blob hash: {}'.format(blob_hash))
+        return self.dir / (blob_hash + '.partial' if partial else blob_hash)
+
+    def has(self, blob_hash):
+        return self.__path__(blob_hash).exists()
+
+    def missing(self, hashes):
+        return [x for x in hashes if not self.has(x)]
+
+    def offset(self, blob_hash):
+        path = self.__path__(blob_hash)
+        if path.exists():
+            return path.stat().st_size
+        partial = self.__path__(blob_hash, partial=True)
+        return partial.stat().st_size if partial.exists() else 0
+
+    #
+    # Append the blocks of body to blob_hash's partial upload, which must
+    # currently hold exactly offset bytes. Whatever arrives is kept, even
+    # if the body is cut short, so the client can resume. Returns the
+    # number of bytes now held; raises BlobError on a mismatched offset or
+    # if the completed blob doesn't match its hash.
+    #
+    def write(self, blob_hash, offset, size, body):
+        with self.lock:
+            if self.has(blob_hash):
+                for block in body:
+                    pass
+                return size
+
+            partial = self.__path__(blob_hash, partial=True)
+            held = partial.stat().st_size if partial.exists() else 0
+            if held != offset:
+                raise BlobError('offset mismatch: have {}'.format(held))
+
+            with open(partial, 'ab') as f:
+                try:
+                    for block in body:
+                        f.write(block)
+                finally:
+                    f.flush()
+                    os.fsync(f.fileno())
+                held = f.tell()
+
+            if held >= size:
+                md5 = hashlib.md5()
+                with open(partial, 'rb') as f:
+                    for block in iter(lambda: f.read(BLOB_BLOCK_SIZE), b''):
+                        md5.update(block)
+                if held != size or md5.hexdigest() != blob_hash:
+                    partial.unlink()
+                    raise BlobError('blob does not match its hash')
+                os.replace(partial, self.__path__(blob_hash))
+            return held
@@ -0,0 +1,148 @@
+import hashlib
+import random
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+#
+# FastCDC-style content-defined chunking. Chunk boundaries are picked from
+# the content itself (wherever a rolling gear hash has its top bits
+# clear), so an insertion or edit only changes the chunks around it and
+# two versions of a large binary file share most of their chunk hashes.
+#
+# The gear hash is h = (h << 1) + GEAR[byte] on 32 bits, so it only ever
+# depends on the last 32 bytes. That lets the NumPy version compute it for
+# a whole block at once; the pure-Python fallback rolls it byte by byte
+# and finds exactly the same boundaries.
+#
+MIN_SIZE = 16 * 1024
+AVG_SIZE = 64 * 1024
+MAX_SIZE = 256 * 1024
+
+# Normalized chunking: a harder condition before the average size and an
+# easier one after it, which keeps chunk sizes close to the average
+MASK_S = 0xFFFFC000   # top 18 bits
+MASK_L = 0xFFFC0000   # top 14 bits
+
+WINDOW = 32
+HASH_MASK = 0xFFFFFFFF
+
+_rng = random.Random(0x6b6e7073)
+GEAR = [_rng.getrandbits(32) for i in range(256)]
+GEAR_NP = np.array(GEAR, dtype=np.uint32) if np is not None else None
+
+#
+# Gear hash after every byte of block, given the hash before it. Returns
+# (candidates_s, candidates_l, h): the offsets in block after which the
+# MASK_S / MASK_L conditions hold, and the hash at the end.
+#
+def _candidates_python(block, h):
+    cand_s = []
+    cand_l = []
+    gear = GEAR
+    for i, b in enumerate(block):
+        h = ((h << 1) + gear[b]) & HASH_MASK
+        if not h & MASK_L:
+            cand_l.append(i)
+            if not h & MASK_S:
+                cand_s.append(i)
+    return cand_s, cand_l, h
+
+def _candidates_numpy(block, tail):
+    # tail is the (up to) WINDOW - 1 bytes before block; without them the
+    # first hashes would be missing older bytes' contributions
+    data = np.frombuffer(bytes(tail) + bytes(block), dtype=np.uint8)
+    h = GEAR_NP[data]
+
+    # Sum GEAR[b[i-k]] << k over the window by doubling
+    span = 1
+    while span < WINDOW:
+        h[span:] += h[:-span] << np.uint32(span)
+        span *= 2
+
+    h = h[len(tail):]
+    cand_l = np.flatnonzero((h & np.uint32(MASK_L)) == 0)
+    cand_s = cand_l[(h[cand_l] & np.uint32(MASK_S)) == 0]
+    return cand_s, cand_l
+
+#
+# Streaming chunker: feed it the file a block at a time with update() (it
+# keeps at most MAX_SIZE bytes plus one block), then finish() returns the
+# list of (md5 hex, size) chunks.
+#
+class Chunker:
+    def __init__(self, use_numpy=True):
+        self.use_numpy = use_numpy and np is not None
+        self.h = 0
+        self.tail = b''
+
+        self.pending = bytearray()     # bytes not yet in an emitted chunk
+        self.pending_start = 0         # file offset of the current chunk
+        self.offset = 0                # where that is in pending
+        self.cand_s = []               # candidate cut offsets (absolute, inclusive)
+        self.cand_l = []
+        self.chunks = []
+
+    def update(self, block):
+        block = bytes(block)
+        if not block:
+            return
+        base = self.pending_start + len(self.pending) - self.offset
+
+        if self.use_numpy:
+            cand_s, cand_l = _candidates_numpy(block, self.tail)
+            self.cand_s.extend((cand_s + base).tolist())
+            self.cand_l.extend((cand_l + base).tolist())
+            self.tail = (self.tail + block)[-(WINDOW - 1):]
+        else:
+            cand_s, cand_l, self.h = _candidates_python(block, self.h)
+            self.cand_s.extend(x + base for x in cand_s)
+            self.cand_l.extend(x + base for x in cand_l)
+
+        self.pending.extend(block)
+        self.__cut__(final=False)
+
+    def __emit__(self, size):
+        with memoryview(self.pending) as view:
+            self.chunks.append((hashlib.md5(view[self.offset:self.offset + size]).hexdigest(), size))
+        self.offset += size
+        self.pending_start += size
+
+    #
+    # Cut as many chunks as the data so far decides.
+    #
+    def __cut__(self, final):
+        s_i = 0
+        l_i = 0
+        while self.offset < len(self.pending):
+            start = self.pending_start
+            end = start + len(self.pending) - self.offset
+            if not final and end < start + MAX_SIZE:
+                break
+
+            cut = None
+            while s_i < len(self.cand_s) and self.cand_s[s_i] + 1 < start + MIN_SIZE:
+                s_i += 1
+            if s_i < len(self.cand_s) and self.cand_s[s_i] + 1 < start + AVG_SIZE:
+                cut = self.cand_s[s_i] + 1
+            else:
+                while l_i < len(self.cand_l) and self.cand_l[l_i] + 1 < start + AVG_SIZE:
+                    l_i += 1
+                if l_i < len(self.cand_l) and self.cand_l[l_i] + 1 <= start + MAX_SIZE:
+                    cut = self.cand_l[l_i] + 1
+
+            if cut is None:
+                cut = min(start + MAX_SIZE, end)
+            self.__emit__(cut - start)
+
+        # Forget bytes and candidates inside chunks already emitted
+        del self.pending[:self.offset]
+        self.offset = 0
+        self.cand_s = [x for x in self.cand_s[s_i:] if x >= self.pending_start]
+        self.cand_l = [x for x in self.cand_l[l_i:] if x >= self.pending_start]
+
+    def finish(self):
+        self.__cut__(final=True)
+        return self.chunks
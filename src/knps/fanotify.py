@@ -0,0 +1,91 @@
+import ctypes
+import ctypes.util
+import os
+import struct
+import sys
+
+#
+# Minimal ctypes binding for Linux fanotify, which reports every open and
+# close on a mount along with the pid responsible. It needs root
+# (CAP_SYS_ADMIN); use available() before relying on it.
+#
+FAN_CLOSE_WRITE = 0x00000008
+FAN_CLOSE_NOWRITE = 0x00000010
+FAN_OPEN = 0x00000020
+
+FAN_CLOEXEC = 0x00000001
+FAN_CLASS_NOTIF = 0x00000000
+FAN_MARK_ADD = 0x00000001
+FAN_MARK_MOUNT = 0x00000010
+
+AT_FDCWD = -100
+FAN_NOFD = -1
+
+# struct fanotify_event_metadata
+EVENT_FORMAT = '=IBBHQii'
+EVENT_SIZE = struct.calcsize(EVENT_FORMAT)
+
+READ_SIZE = 64 * 1024
+
+_libc = None
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+        _libc.fanotify_init.argtypes = [ctypes.c_uint, ctypes.c_uint]
+        _libc.fanotify_mark.argtypes = [ctypes.c_int, ctypes.c_uint, ctypes.c_uint64, ctypes.c_int, ctypes.c_char_p]
+    return _libc
+
+def available():
+    if not sys.platform.startswith('linux') or os.geteuid() != 0:
+        return False
+    try:
+        return hasattr(_get_libc(), 'fanotify_init')
+    except OSError:
+        return False
+
+class Fanotify:
+    def __init__(self, dirs):
+        libc = _get_libc()
+        self.prefixes = tuple(os.path.join(os.path.abspath(d), '') for d in dirs)
+        self.fd = libc.fanotify_init(FAN_CLASS_NOTIF | FAN_CLOEXEC, os.O_RDONLY | os.O_LARGEFILE)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+        mask = FAN_OPEN | FAN_CLOSE_WRITE | FAN_CLOSE_NOWRITE
+        for d in dirs:
+            if libc.fanotify_mark(self.fd, FAN_MARK_ADD | FAN_MARK_MOUNT, mask, AT_FDCWD, os.fsencode(d)) < 0:
+                err = ctypes.get_errno()
+                os.close(self.fd)
+                raise OSError(err, os.strerror(err), d)
+
+    #
+    # Yield (pid, path, mode) for each open or close of a file under the
+    # watched directories, mode being 'read' or 'writable' (closed after
+    # being opened for writing). Blocks between events. Marks are per
+    # mount, so events elsewhere on the same mount are read and dropped
+    # here.
+    #
+    def events(self):
+        while True:
+            data = os.read(self.fd, READ_SIZE)
+            offset = 0
+            while offset + EVENT_SIZE <= len(data):
+                event_len, vers, reserved, metadata_len, mask, fd, pid = struct.unpack_from(EVENT_FORMAT, data, offset)
+                offset += event_len
+                if fd == FAN_NOFD:
+                    continue
+                try:
+                    path = os.readlink('/proc/self/fd/{}'.format(fd))
+                except OSError:
+                    continue
+                finally:
+                    os.close(fd)
+
+                if path.startswith(self.prefixes):
+                    yield pid, path, 'writable' if mask & FAN_CLOSE_WRITE else 'read'
+
+    def close(self):
+        os.close(self.fd)
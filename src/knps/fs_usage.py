@@ -0,0 +1,141 @@
+import re
+import time
+from collections import namedtuple
+from pathlib import Path
+
+# Lines for these calls (or from these daemons) carry no provenance
+BLACKLIST = ['stat64', 'filecoordinationd', 'getattrlist', 'fsgetpath', 'getxattr', 'fsctl', 'statfs64']
+BLACKLIST_RE = re.compile('|'.join(re.escape(x) for x in BLACKLIST))
+
+# Processes whose file activity is noise
+IGNORED_PROCESSES = ['Sublime Text', 'bird', 'quicklookd']
+
+OPEN_FLAGS_RE = re.compile(r'^\(.+\)$')
+
+FsEvent = namedtuple('FsEvent', ['timestamp', 'action', 'path', 'open_type', 'process_name', 'thread_id'])
+
+#
+# Matches paths under any of the watched directories. The trie is keyed by
+# path component, and a path matches if any suffix of it starting at a
+# component boundary walks to the end of a watched directory, the same
+# as the old "watched dir appears anywhere in the path" regex (which let
+# /private/tmp/x match a watched /tmp/x on macOS).
+#
+class PathTrie:
+    END = object()
+
+    def __init__(self, dirs):
+        self.root = {}
+        for d in dirs:
+            node = self.root
+            for part in [x for x in str(d).split('/') if x]:
+                node = node.setdefault(part, {})
+            node[self.END] = True
+
+    def match(self, path):
+        parts = path.split('/')
+        for start in range(len(parts)):
+            node = self.root
+            for part in parts[start:]:
+                node = node.get(part)
+                if node is None:
+                    break
+                if self.END in node:
+                    return True
+        return False
+
+#
+# Turns `fs_usage -w -f filesys` output into FsEvents for files under the
+# watched directories. Each line is split once; lines for blacklisted
+# calls, ignored processes and unwatched paths give None.
+#
+class FsUsageParser:
+    def __init__(self, dirs):
+        self.trie = PathTrie(dirs)
+
+    def parse(self, line):
+        if BLACKLIST_RE.search(line):
+            return None
+
+        data = line.split()
+        if len(data) < 3:
+            return None
+
+        path = None
+        open_flags = None
+        for token in data[2:-1]:
+            if path is None and '/' in token and self.trie.match(token):
+                path = token
+            elif open_flags is None and OPEN_FLAGS_RE.match(token):
+                open_flags = token
+        if path is None:
+            return None
+
+        # After the path come the elapsed time, a W if the call waited, and
+        # the process name (which may contain spaces) dot thread id
+        tail = line[line.rindex(path) + len(path):].split()
+        while tail and (tail[0] == 'W' or tail[0].replace('.', '', 1).isdigit()):
+            tail.pop(0)
+        process = ' '.join(tail)
+        if '.' not in process:
+            return None
+        process_name, thread_id = process.rsplit('.', 1)
+        if any(name in process_name for name in IGNORED_PROCESSES):
+            return None
+
+        name = Path(path).name
+        if name.startswith('~$') or name.endswith('.swp'):
+            return None
+
+        action = data[1]
+        open_type = None
+        if (action == 'open' or action == 'access') and open_flags:
+            if open_flags[2] == 'W':
+                open_type = 'write'
+            elif open_flags[1] == 'R':
+                open_type = 'read'
+
+        return FsEvent(data[0], action, path, open_type, process_name, thread_id)
+
+#
+# 'read', 'write' or None (unknown; decided later from the file's mtime)
+# for an event, the way the fs_usage monitor has always classified them.
+#
+def event_mode(event):
+    if 'WrData' in event.action or event.open_type == 'write':
+        return 'write'
+    if 'RdData' in event.action or event.open_type == 'read':
+        return 'read'
+    return None
+
+#
+# Record/replay, so the parser can be benchmarked (and debugged) on any
+# platform from a trace captured on a Mac.
+#
+class TraceRecorder:
+    def __init__(self, path):
+        self.f = open(path, 'wt')
+
+    def write(self, line):
+        self.f.write(line)
+        if not line.endswith('\n'):
+            self.f.write('\n')
+
+    def close(self):
+        self.f.close()
+
+#
+# Feed every line of a recorded trace to handle(line) as fast as it will
+# go. Returns (lines, events, seconds), counting lines for which handle()
+# returned something other than None as events.
+#
+def replay(path, handle):
+    lines = 0
+    events = 0
+    start = time.perf_counter()
+    with open(path, 'rt', errors='replace') as f:
+        for line in f:
+            lines += 1
+            if handle(line.rstrip('\n')) is not None:
+                events += 1
+    return lines, events, time.perf_counter() - start
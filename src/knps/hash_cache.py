@@ -0,0 +1,229 @@
+import json
+import sqlite3
+import threading
+from pathlib import Path
+
+#
+# Version of the data stored in the cache. Bump this whenever the way we
+# compute any cached value changes (hash algorithm, line hashing rules,
+# shingling parameters, ...). Entries written by a different version are
+# dropped the first time the cache is opened.
+#
+CACHE_VERSION = 3
+
+# Commit pending writes after this many stores
+COMMIT_EVERY = 500
+
+#
+# A persistent cache of per-file analysis results (whole-file hash, file
+# type, line hashes, shingles, ...). Entries are keyed by the file's path
+# and validated against (device, inode, size, mtime_ns), so a cached value
+# is only ever returned for a file that has not changed since it was
+# computed.
+#
+class HashCache:
+    def __init__(self, path):
+        self.path = Path(path)
+        self.lock = threading.RLock()
+        self.pending = 0
+        self.hits = 0
+        self.misses = 0
+
+        self.conn = sqlite3.connect(str(self.path), timeout=60, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.__create_tables__()
+        self.__check_version__()
+
+    def __create_tables__(self):
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS meta ('
+                              'key TEXT PRIMARY KEY, value TEXT)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS files ('
+                              'path TEXT PRIMARY KEY, device INTEGER, inode INTEGER, '
+                              'size INTEGER, mtime_ns INTEGER, file_hash TEXT, extra TEXT)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS content ('
+                              'file_hash TEXT, kind TEXT, value TEXT, PRIMARY KEY (file_hash, kind))')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS chunks ('
+                              'file_hash TEXT, seq INTEGER, chunk_hash BLOB, size INTEGER, '
+                              'PRIMARY KEY (file_hash, seq)) WITHOUT ROWID')
+
+    def __get_meta__(self, key, default=None):
+        row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def __set_meta__(self, key, value):
+        self.conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, str(value)))
+
+    def __check_version__(self):
+        with self.lock, self.conn:
+            version = self.__get_meta__('cache_version')
+            if version != str(CACHE_VERSION):
+                self.conn.execute('DELETE FROM files')
+                self.conn.execute('DELETE FROM content')
+                self.conn.execute('DELETE FROM chunks')
+                self.__set_meta__('cache_version', CACHE_VERSION)
+
+    @staticmethod
+    def __stat_key__(stats):
+        return (stats.st_dev, stats.st_ino, stats.st_size, stats.st_mtime_ns)
+
+    #
+    # Return everything cached for this file as a dict, or None if there
+    # is no entry or the file has changed since the entry was written.
+    #
+    def lookup(self, path, stats):
+        path = str(path)
+        with self.lock:
+            row = self.conn.execute('SELECT device, inode, size, mtime_ns, file_hash, extra '
+                                    'FROM files WHERE path = ?', (path,)).fetchone()
+
+        if row is None or tuple(row[:4]) != self.__stat_key__(stats):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        fields = json.loads(row[5]) if row[5] else {}
+        if row[4] is not None:
+            fields['file_hash'] = row[4]
+        return fields
+
+    def get(self, path, stats, field):
+        fields = self.lookup(path, stats)
+        if fields is None:
+            return None
+        return fields.get(field)
+
+    #
+    # Add fields to the entry for this file. Fields already cached for the
+    # same version of the file are kept; a stale entry is replaced.
+    #
+    def store(self, path, stats, **fields):
+        path = str(path)
+        key = self.__stat_key__(stats)
+
+        with self.lock:
+            row = self.conn.execute('SELECT device, inode, size, mtime_ns, file_hash, extra '
+                                    'FROM files WHERE path = ?', (path,)).fetchone()
+            merged = {}
+            if row is not None and tuple(row[:4]) == key:
+                merged = json.loads(row[5]) if row[5] else {}
+                if row[4] is not None:
+                    merged['file_hash'] = row[4]
+            merged.update(fields)
+
+            file_hash = merged.pop('file_hash', None)
+            extra = json.dumps(merged) if merged else None
+            self.conn.execute('INSERT OR REPLACE INTO files '
+                              '(path, device, inode, size, mtime_ns, file_hash, extra) '
+                              'VALUES (?, ?, ?, ?, ?, ?, ?)', (path,) + key + (file_hash, extra))
+
+            self.pending += 1
+            if self.pending >= COMMIT_EVERY:
+                self.flush()
+
+    #
+    # Results that depend only on a file's bytes (e.g. PDF line hashes) can
+    # also be cached by file hash, so a copied, moved or touched file
+    # isn't analyzed again.
+    #
+    def lookup_content(self, file_hash, kind):
+        with self.lock:
+            row = self.conn.execute('SELECT value FROM content WHERE file_hash = ? AND kind = ?',
+                                    (file_hash, kind)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def store_content(self, file_hash, kind, value):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO content (file_hash, kind, value) VALUES (?, ?, ?)',
+                              (file_hash, kind, json.dumps(value)))
+            self.pending += 1
+            if self.pending >= COMMIT_EVERY:
+                self.flush()
+
+    #
+    # A file's content-defined chunks, as a list of (md5 hex, size), are
+    # kept a row each, by file hash. A very large file has hundreds of
+    # thousands, which would bloat its entry in files.
+    #
+    def lookup_chunks(self, file_hash):
+        with self.lock:
+            rows = self.conn.execute('SELECT chunk_hash, size FROM chunks WHERE file_hash = ? ORDER BY seq',
+                                     (file_hash,)).fetchall()
+        return [(chunk_hash.hex(), size) for chunk_hash, size in rows] if rows else None
+
+    def store_chunks(self, file_hash, chunks):
+        with self.lock:
+            self.conn.execute('DELETE FROM chunks WHERE file_hash = ?', (file_hash,))
+            self.conn.executemany('INSERT INTO chunks (file_hash, seq, chunk_hash, size) VALUES (?, ?, ?, ?)',
+                                  ((file_hash, seq, bytes.fromhex(chunk_hash), size)
+                                   for seq, (chunk_hash, size) in enumerate(chunks)))
+            self.pending += 1
+            if self.pending >= COMMIT_EVERY:
+                self.flush()
+
+    def invalidate(self, path):
+        with self.lock:
+            self.conn.execute('DELETE FROM files WHERE path = ?', (str(path),))
+            self.pending += 1
+
+    #
+    # The counters are added to in SQL, so several processes sharing the
+    # cache (e.g. --jobs workers) don't overwrite each other's counts.
+    #
+    def __add_meta__(self, key, n):
+        self.conn.execute('INSERT OR IGNORE INTO meta (key, value) VALUES (?, 0)', (key,))
+        self.conn.execute('UPDATE meta SET value = CAST(value AS INTEGER) + ? WHERE key = ?', (n, key))
+
+    def flush(self):
+        with self.lock:
+            if self.hits:
+                self.__add_meta__('hits', self.hits)
+            if self.misses:
+                self.__add_meta__('misses', self.misses)
+            self.hits = 0
+            self.misses = 0
+
+            self.conn.commit()
+            self.pending = 0
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.conn.close()
+
+    def clear(self):
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM files')
+            self.conn.execute('DELETE FROM content')
+            self.conn.execute('DELETE FROM chunks')
+            self.__set_meta__('hits', 0)
+            self.__set_meta__('misses', 0)
+            self.hits = 0
+            self.misses = 0
+        with self.lock:
+            self.conn.execute('VACUUM')
+
+    def stats(self):
+        with self.lock:
+            self.flush()
+            entries = self.conn.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+            content_entries = self.conn.execute('SELECT COUNT(*) FROM content').fetchone()[0]
+            hits = int(self.__get_meta__('hits', 0))
+            misses = int(self.__get_meta__('misses', 0))
+
+        disk_bytes = 0
+        for suffix in ['', '-wal', '-shm']:
+            p = Path(str(self.path) + suffix)
+            if p.exists():
+                disk_bytes += p.stat().st_size
+
+        return {
+            'path': str(self.path),
+            'version': CACHE_VERSION,
+            'entries': entries,
+            'content_entries': content_entries,
+            'hits': hits,
+            'misses': misses,
+            'disk_bytes': disk_bytes,
+        }
@@ -1,93 +1,280 @@
 import hashlib
+import io
 from pathlib import Path
 import argparse
-import configparser
 from datetime import date
 from datetime import datetime
 from datetime import timezone
 import json
-import distutils.util
 import os
-import requests
-import json
+import sys
 import csv
-import PyPDF2
+import locale
 import re
 import codecs
 import random
 import time
-import webbrowser
-import yaml
 import subprocess
-import uuid
-import socket
 import threading
-import psutil
+import itertools
+import collections
+import queue
+import atexit
+import base64
+import zlib
+from contextlib import nullcontext
 import mimetypes
-from binaryornot.check import is_binary
-
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
 import logging
 
-import pkg_resources
-
+#
+# Imports that are slow (requests, numpy, yaml, psutil, watchdog,
+# binaryornot, PyPDF2) are made by the functions that need them, so
+# commands like --status and --version start quickly.
+#
 from knps.settings import (
     CACHE_FILE_PROCESSING,
+    CSV_SEEK_SAMPLE_MB,
     KNPS_SERVER_DEV,
-    KNPS_SERVER_PROD
+    KNPS_SERVER_PROD,
+    LOG_ASYNC,
+    MINHASH_OPH_BYTES,
+    PAYLOAD_ENCODING,
+    PDF_MEMORY_MB,
+    PDF_TIMEOUT_SECONDS,
+    PDF_WORKERS,
+    SPOOL_MAX_MB,
+    SPOOL_RATE_KBPS,
+    USE_HASH_CACHE,
+    USE_SPOOL
 )
+from knps.hash_cache import HashCache
+from knps.manifest import SyncManifest
+from knps.fs_usage import FsUsageParser, TraceRecorder, event_mode, replay
+from knps.pdf_extract import PdfExtractError, PdfExtractor
+from knps.payload import MultipartStream, choose_encoding, decode_payload, open_compressed_writer, supported_encodings, write_json_array
+from knps.profiler import SyncProfile
+from knps.processed_files import ProcessedFiles
+from knps.procfs import ProcScanner, read_cmdline, read_stat, start_timestamp
+from knps.spool import DrainLock, Spool, SpoolFull
+from knps.walk import IgnoreRules, iter_files
+from knps.work_queue import WorkQueue
 
 CFG_DIR = '.knps'
 CFG_FILE = 'knps.cfg'
 
 DB_FILE = '.knpsdb'
 DIR_DB_FILE = '.knps_dir_db'
+HASH_CACHE_FILE = '.knps_hash_cache'
+MANIFEST_FILE = '.knps_manifest'
+PROCESSED_FILE = '.knps_processed'
+QUEUE_FILE = '.knps_queue'
+SPOOL_DIR = '.knps_spool'
 
 PROCESS_SYNC_AGE_SECONDS = 10
+PROCESS_MONITOR_REPORT_SECONDS = 60
+FANOTIFY_PID_CACHE_SIZE = 10000
+PROCESS_FORGET_SECONDS = 600
+# How often --proc_logger polls psutil where there's no /proc
+PROC_LOGGER_POLL_SECONDS = 1
+
+READ_BLOCK_SIZE = 1024 * 1024
+BINARY_SNIFF_BYTES = 1024
+MINHASH_BATCH_SIZE = 16384
+LINE_BATCH_SIZE = 4096
+
+# Seek-sampled CSV files: rows read in order before seeking (where the
+# progressive schedule reaches every 1000th row), then one line per stride
+CSV_HEAD_ROWS = 100000
+CSV_SEEK_STRIDE_BYTES = 1024 * 1024
+
+# With --store and a server that predates blob uploads, file contents are
+# sent inline (base64 in the observation) for files up to this size
+INLINE_CONTENT_MAX_BYTES = 10 * 1000 * 1000
+
+# Files at least this big get content-defined chunk hashes whatever their
+# type (binary files always do)
+CHUNK_LARGE_FILE_BYTES = 64 * 1024 * 1024
+
+# Observed chunks that may wait for upload while the next one is hashed
+SYNC_PIPELINE_DEPTH = 2
+
+# TODO chunks written to the work queue per transaction
+TODO_ENQUEUE_BATCH = 1000
+
+# Sync daemon: a file is synced once it has had no events for this long;
+# chunks left on the TODO list are retried every DAEMON_TODO_SECONDS
+DAEMON_DEBOUNCE_SECONDS = 2
+DAEMON_POLL_SECONDS = 0.5
+DAEMON_TODO_SECONDS = 60
+SYNC_EVENT_TYPES = ['created', 'modified', 'moved', 'deleted', 'closed']
+
+# Async Logger delivery: records waiting beyond LOG_QUEUE_SIZE are dropped;
+# a batch is sent when it reaches LOG_BATCH_RECORDS records or
+# LOG_BATCH_BYTES bytes, or its first record is LOG_BATCH_SECONDS old
+LOG_QUEUE_SIZE = 100000
+LOG_BATCH_RECORDS = 500
+LOG_BATCH_BYTES = 1024 * 1024
+LOG_BATCH_SECONDS = 1.0
+LOG_FLUSH_TIMEOUT = 10
+
+# A server whose /capabilities can't be fetched is asked again after this
+CAPABILITIES_RETRY_SECONDS = 60
+
+# Spool replay: retry an unreachable server after SPOOL_RETRY_SECONDS,
+# doubling up to SPOOL_MAX_RETRY_SECONDS
+SPOOL_MAX_ATTEMPTS = 5
+SPOOL_POLL_SECONDS = 1
+SPOOL_RETRY_SECONDS = 5
+SPOOL_MAX_RETRY_SECONDS = 300
 
 ###################################################
 # Some util functions
 ###################################################
+
+#
+# The version is looked up once per process: asking git takes a
+# subprocess or two, and it is needed for every upload.
+#
+VERSIONS = {}
 def get_version(file_loc = __file__):
     cwdir = os.path.dirname(os.path.realpath(file_loc))
-
-    proj_ver = subprocess.run(["git", "describe", "--tags", "--long"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, cwd=cwdir).stdout.strip()
+    if cwdir in VERSIONS:
+        return VERSIONS[cwdir]
+
+    # Only a source checkout has a development version; don't spawn git
+    # for an installed package
+    proj_ver = None
+    if any(Path(d, '.git').exists() for d in [cwdir, *Path(cwdir).parents]):
+        proj_ver = subprocess.run(["git", "describe", "--tags", "--long"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, cwd=cwdir).stdout.strip()
     if proj_ver:
-        rev_count = subprocess.run(["git", "log", "--oneline"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, cwd=cwdir).stdout.strip()
-        rev_count = len(rev_count.split("\n"))
-        return f'{proj_ver}-{rev_count}-development'
+        rev_count = subprocess.run(["git", "rev-list", "--count", "HEAD"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, cwd=cwdir).stdout.strip()
+        version = f'{proj_ver}-{rev_count}-development'
     else:
-        proj_ver = pkg_resources.require('knps-cli')[0].version
-        return f'v{proj_ver}-release'
+        try:
+            # Written by setuptools_scm when the package is built
+            from knps._version import version as release
+        except ImportError:
+            from importlib.metadata import version as package_version
+            release = package_version("knps-cli")
+        version = f'v{release}-release'
+
+    VERSIONS[cwdir] = version
+    return version
+
+HOSTNAME = None
+def get_hostname():
+    global HOSTNAME
+    if HOSTNAME is None:
+        import socket
+        HOSTNAME = socket.gethostname()
+    return HOSTNAME
 
+#
+# distutils.util.strtobool, without importing distutils
+#
+def strtobool(value):
+    value = value.lower()
+    if value in ('y', 'yes', 't', 'true', 'on', '1'):
+        return True
+    if value in ('n', 'no', 'f', 'false', 'off', '0'):
+        return False
+    raise ValueError("invalid truth value {!r}".format(value))
 
+#
+# numpy is optional (it vectorizes MinHash) and slow to import, so it is
+# imported the first time a MinHash is made. np is None if it isn't
+# installed.
+#
+np = None
+NUMPY_CHECKED = False
+def load_numpy():
+    global np, NUMPY_CHECKED
+    if not NUMPY_CHECKED:
+        try:
+            import numpy as np
+        except ImportError:
+            np = None
+        NUMPY_CHECKED = True
+    return np
+
+#
+# With --sync --profile, SYNC_PROFILE records how long each stage of the
+# sync takes (see knps.profiler). Otherwise it is None and profile_stage()
+# costs one function call.
+#
+SYNC_PROFILE = None
+NO_STAGE = nullcontext()
+def profile_stage(name):
+    if SYNC_PROFILE is None:
+        return NO_STAGE
+    return SYNC_PROFILE.stage(name)
+
+def profile_timed(name, function):
+    if SYNC_PROFILE is None:
+        return function
+    return SYNC_PROFILE.timed(name, function)
+
+def profile_read(nbytes):
+    if SYNC_PROFILE is not None:
+        SYNC_PROFILE.add_read(nbytes)
+
+#
+# The persistent hash cache is opened lazily, once per process. Forked
+# workers must not reuse the parent's sqlite connection, so it is
+# reopened whenever the pid changes.
+#
+PERSISTENT_HASH_CACHE = None
+PERSISTENT_HASH_CACHE_PID = None
+def get_hash_cache():
+    global PERSISTENT_HASH_CACHE, PERSISTENT_HASH_CACHE_PID
+
+    if not USE_HASH_CACHE:
+        return None
+
+    if PERSISTENT_HASH_CACHE is None or PERSISTENT_HASH_CACHE_PID != os.getpid():
+        PERSISTENT_HASH_CACHE = HashCache(Path(Path.home(), HASH_CACHE_FILE))
+        PERSISTENT_HASH_CACHE_PID = os.getpid()
+        atexit.register(flush_hash_cache)
+
+    return PERSISTENT_HASH_CACHE
+
+def flush_hash_cache():
+    if PERSISTENT_HASH_CACHE is not None and PERSISTENT_HASH_CACHE_PID == os.getpid():
+        PERSISTENT_HASH_CACHE.flush()
 
 HASH_CACHE = {}
 def hash_file(fname, stats=None):
-    if not stats:
-        try:
-            p = Path(fname)
-            stats = p.stat()
-            key = f'{fname}-{stats.st_mtime}'
-
-            if key not in HASH_CACHE:
-                hash_md5 = hashlib.md5()
-                with open(fname, "rb") as f:
-                    for chunk in iter(lambda: f.read(4096), b""):
-                        hash_md5.update(chunk)
-                HASH_CACHE[key] = hash_md5.hexdigest()
-        except FileNotFoundError:
-            key = f'{fname}-None'
-            HASH_CACHE[key] = None
+    try:
+        if not stats:
+            stats = os.stat(fname)
+    except FileNotFoundError:
+        return None
+
+    key = (fname, stats.st_size, stats.st_mtime_ns)
+    if key not in HASH_CACHE:
+        cache = get_hash_cache()
+        file_hash = cache.get(fname, stats, 'file_hash') if cache else None
+
+        if file_hash is None:
+            hash_md5 = hashlib.md5()
+            with profile_stage('md5'), open(fname, "rb") as f:
+                for chunk in iter(lambda: f.read(4096), b""):
+                    hash_md5.update(chunk)
+            file_hash = hash_md5.hexdigest()
+            profile_read(stats.st_size)
+
+            if cache:
+                cache.store(fname, stats, file_hash=file_hash)
+
+        HASH_CACHE[key] = file_hash
     return HASH_CACHE[key]
 
 def get_file_data(fname):
-    p = Path(fname)
-    if not p.exists():
+    try:
+        stats = os.stat(fname)
+    except FileNotFoundError:
         return {}
 
-    stats = p.stat()
     file_data = {
         'file_name': fname,
         'file_hash': hash_file(fname, stats),
@@ -101,89 +288,226 @@ def get_file_data(fname):
 #
 def hash_file_lines(fname, file_type):
     hashes = []
-    text = ""
 
     if file_type == "application/pdf":
-        return hash_pdf_file_lines(fname)
+        return hash_pdf_file_lines(fname) or []
 
     if file_type == "text/csv":
         return hash_csv_file_lines(fname)
 
+    from binaryornot.check import is_binary
     if not is_binary(fname):
         with open(fname, "rt") as f:
             for line in f:
-                text = text + " " + line
                 line = line.strip().encode()
                 hashes.append(hashlib.md5(line).hexdigest())
 
     return hashes
 
 def getShinglesFname(fname, file_type):
-    text = ""
-    if file_type != "text/csv":
-        with open(fname, "rt") as f:
-            for line in f:
-                text = text + " " + line
-    return getShingles(text, fname, file_type)
+    if file_type == "text/csv":
+        return getShingles("", fname, file_type)
 
-def hash_csv_file_lines(fname):
-    hashes = []
+    shingler = ShingleHasher()
     with open(fname, "rt") as f:
-        i = 0
-        next_read = 0
         for line in f:
-            if i == next_read:
-                hashes.append(hashlib.md5(line.strip().encode()).hexdigest())
-
-                if i < 100:
-                    next_read += 1
-                elif i < 1000:
-                    next_read += 5
-                elif i < 10000:
-                    next_read += 50
-                elif i < 100000:
-                    next_read += 500
-                else:
-                    next_read += 1000
+            shingler.feed(line)
+    return shingler.signature()
 
-            i += 1
+#
+# CSV files are sampled progressively: every row at first, then every
+# 5th, 50th, 500th and finally every 1000th row.
+#
+def csv_sample_step(i):
+    if i < 100:
+        return 1
+    elif i < 1000:
+        return 5
+    elif i < 10000:
+        return 50
+    elif i < 100000:
+        return 500
+    else:
+        return 1000
 
-    return hashes
+#
+# The sampled lines of a CSV file, stripped and encoded. Both the line
+# hashes and the shingles of a CSV file come from this one sample.
+#
+def iter_csv_sample(lines):
+    i = 0
+    next_read = 0
+    for line in lines:
+        if i == next_read:
+            yield line.strip().encode()
+            next_read += csv_sample_step(i)
+        i += 1
+
+def is_huge_csv(size):
+    return CSV_SEEK_SAMPLE_MB > 0 and size >= CSV_SEEK_SAMPLE_MB * 1024 * 1024
+
+#
+# Sampling for huge CSV files. The first CSV_HEAD_ROWS rows are sampled
+# as usual; after that, rather than reading on, we seek every
+# CSV_SEEK_STRIDE_BYTES, skip to the start of the next line and take that
+# line. The I/O is proportional to the sample, not the file, and the
+# offsets depend only on the file size, so an unchanged file always gives
+# the same sample.
+#
+def iter_csv_seek_sample(fname):
+    encoding = locale.getpreferredencoding(False)
+    size = os.path.getsize(fname)
+
+    with open(fname, 'rb') as f:
+        def head():
+            for i in range(CSV_HEAD_ROWS):
+                line = f.readline()
+                if not line:
+                    return
+                yield line.decode(encoding, errors='replace')
+        yield from iter_csv_sample(head())
+
+        last_line = f.tell()
+        for offset in range(last_line + CSV_SEEK_STRIDE_BYTES, size, CSV_SEEK_STRIDE_BYTES):
+            # Start one byte early so a line beginning right at offset counts
+            f.seek(offset - 1)
+            f.readline()
+            if f.tell() <= last_line:
+                # Still inside the line sampled last time
+                continue
+            last_line = f.tell()
+            line = f.readline()
+            if not line:
+                break
+            yield line.decode(encoding, errors='replace').strip().encode()
+
+def sample_csv_file(fname):
+    if is_huge_csv(os.path.getsize(fname)):
+        yield from iter_csv_seek_sample(fname)
+    else:
+        with open(fname, "rt") as f:
+            yield from iter_csv_sample(f)
+
+#
+# Line hashes and shingle fingerprints of a CSV sample, in one pass
+#
+def hash_csv_sample(sample, fingerprint_bytes = 8):
+    line_hashes = []
+    fingerprints = []
+    for line in sample:
+        line_hashes.append(hashlib.md5(line).hexdigest())
+        fingerprints.append(int.from_bytes(hashlib.sha256(line).digest()[:fingerprint_bytes], 'little'))
+    return line_hashes, fingerprints
+
+def hash_csv_file_lines(fname):
+    return [hashlib.md5(line).hexdigest() for line in sample_csv_file(fname)]
+
+#
+# PDF line hashes are extracted by isolated worker processes with a time
+# and memory budget (see knps.pdf_extract), and cached by file hash, so a
+# given PDF is only ever parsed once. A PDF that can't be parsed is
+# cached as such; one that timed out, ran out of memory or lost its
+# worker is tried again on the next sync: None is returned for it, rather
+# than an empty list.
+#
+# Each --jobs worker process has its own extractor, so they share the
+# PDF_WORKERS budget between them.
+#
+PDF_EXTRACTOR = None
+POOL_JOBS = 1
+def get_pdf_extractor():
+    global PDF_EXTRACTOR
+    if PDF_EXTRACTOR is None or PDF_EXTRACTOR.pid != os.getpid():
+        workers = PDF_WORKERS or min(os.cpu_count() or 1, 4)
+        PDF_EXTRACTOR = PdfExtractor(max(1, workers // POOL_JOBS), PDF_TIMEOUT_SECONDS, PDF_MEMORY_MB)
+    return PDF_EXTRACTOR
+
+def hash_pdf_file_lines(fname, file_hash=None):
+    if file_hash is None:
+        file_hash = hash_file(fname)
+
+    cache = get_hash_cache()
+    cached = cache.lookup_content(file_hash, 'pdf_line_hashes') if cache else None
+    if cached is not None:
+        return cached['hashes']
 
-## This is very slow
-## near-miss detection (hash-shingling)
-def hash_pdf_file_lines(fname):
-    hashes = []
-    pdfFileObj = open(fname, 'rb')
-    pdfReader = PyPDF2.PdfFileReader(pdfFileObj, strict=False)
     try:
-        for pageNumber in range(pdfReader.getNumPages()):
-            pageObj = pdfReader.getPage(pageNumber)
-            # hashes.append(hashlib.md5(pageObj.extractText().strip().encode()).hexdigest())
-            lines = pageObj.extractText().splitlines()
-            for line in lines:
-                line = line.strip().encode()
-                hashes.append(hashlib.md5(line).hexdigest())
-        pdfFileObj.close()
-    except PyPDF2.utils.PdfReadError as e:
-        # PyPDF2 has trouble with some PDFs
+        with profile_stage('pdf'):
+            result = {'hashes': get_pdf_extractor().line_hashes(os.path.abspath(fname))}
+    except PdfExtractError as e:
         print("Problem hashing PDF lines: ", e)
+        if e.transient:
+            return None
+        result = {'hashes': [], 'error': str(e)}
 
-    return hashes
+    if cache:
+        cache.store_content(file_hash, 'pdf_line_hashes', result)
+    return result['hashes']
 
 # def send_synclist_thread(user, observationList, comment=None):
 def observeAndSyncThread(user, file_loc):
     user.observeAndSync(file_loc)
 
 #
-# Transmit observations to the server
+# Transmit observations to the server. Unless the spool is disabled, the
+# payload is written to the user's on-disk spool and sent from there by a
+# SpoolReplayer, so collection doesn't depend on the server being up.
+# Returns the server's response, {} once spooled, or {'error': ...} if
+# the spool is full.
+#
+# The spooled payload is encoded exactly as it will be sent, streamed
+# into the spool, and sent as it is. It lists the files it holds, so if
+# the server rejects it they can be synced again.
 #
 def send_synclist(user, observationList, file_loc, comment=None):
     knps_version = get_version(file_loc)
     install_id = user.get_install_id()
-    hostname = socket.gethostname()
+    hostname = get_hostname()
     print("KNPS Version: ", knps_version)
 
+    def observations():
+        for file_name, file_hash, file_type, line_hashes, optionalItems, file_info in observationList:
+            metadata = {
+                'username': user.username,
+                'file_name': file_name,
+                'file_hash': file_hash,
+                'filetype': file_type,
+                'line_hashes': line_hashes,
+                'file_size': file_info['file_size'],
+                'modified': file_info['modified'],
+                'knps_version': knps_version,
+                'install_id': install_id,
+                'hostname': hostname,
+                'optionalItems': optionalItems
+            }
+            yield {'metadata': metadata}
+
+    if USE_SPOOL:
+        # If the server can't be asked, compress anyway; the replayer
+        # decompresses for a server that turns out not to support it
+        encoding = choose_encoding(get_server_capabilities(user).get('encodings', supported_encodings()), PAYLOAD_ENCODING)
+        with profile_stage('json'):
+            payload = write_json_array(observations(), encoding)
+        header = {'kind': 'synclist', 'encoding': encoding,
+                  'files': [[observation[0], observation[1]] for observation in observationList]}
+        return spool_payload(user, header, payload)
+    return post_synclist(user, observations())
+
+def post_synclist(user, observations):
+    # Compress the observations if the server says it can take them
+    encoding = choose_encoding(get_server_capabilities(user).get('encodings', []), PAYLOAD_ENCODING)
+    with profile_stage('json'):
+        payload = write_json_array(observations, encoding)
+    with payload:
+        return post_synclist_payload(user, payload, encoding)
+
+#
+# Send a JSON array of observations, already encoded (a file object or
+# bytes)
+#
+def post_synclist_payload(user, payload, encoding):
+    import requests
+
     url = "{}/synclist/{}".format(user.get_server_url(), user.username)
 
     login = {
@@ -191,33 +515,73 @@ def send_synclist(user, observationList, file_loc, comment=None):
         'access_token': user.access_token
     }
 
-    obsList = []
-    for file_name, file_hash, file_type, line_hashes, optionalItems in observationList:
-        p = Path(file_name)
-        info = p.stat()
-
-        metadata = {
-            'username': user.username,
-            'file_name': file_name,
-            'file_hash': file_hash,
-            'filetype': file_type,
-            'line_hashes': line_hashes,
-            'file_size': info.st_size,
-            'modified': info.st_mtime,
-            'knps_version': knps_version,
-            'install_id': install_id,
-            'hostname': hostname,
-            'optionalItems': optionalItems
-        }
-        obsList.append({'metadata': metadata})
-
-    fDict = {'observations': json.dumps(obsList)}
+    if encoding and encoding not in get_server_capabilities(user).get('encodings', []):
+        if not isinstance(payload, bytes):
+            payload = payload.read()
+        payload = decode_payload(payload, encoding)
+        encoding = None
 
-    response = requests.post(url, files=fDict, data=login)
-    obj_data = response.json()
+    # Streamed, rather than built in memory with files=
+    if encoding:
+        login['encoding'] = encoding
+        body = MultipartStream(login, 'observations', 'observations.json', payload, 'application/octet-stream')
+    else:
+        body = MultipartStream(login, 'observations', 'observations', payload)
+
+    with profile_stage('http'):
+        response = requests.post(url, data=body, headers={'Content-Type': body.content_type})
+    return server_reply(response)
+
+#
+# The server's reply to an upload. A server error, timeout or rate limit
+# means try again later, so it raises; any other 4xx means the server
+# won't take this payload, and is returned as {'error': ...}.
+#
+def server_reply(response):
+    if response.status_code >= 500 or response.status_code in (408, 429):
+        response.raise_for_status()
+
+    try:
+        obj_data = response.json()
+    except ValueError:
+        if response.status_code >= 400:
+            return {'error': 'Rejected by the server ({}): {}'.format(response.status_code, response.text[:200])}
+        raise
+    if response.status_code >= 400 and not (isinstance(obj_data, dict) and 'error' in obj_data):
+        return {'error': 'Rejected by the server ({})'.format(response.status_code)}
 
     return obj_data
 
+#
+# Ask the server what it supports (e.g. compressed payloads). Servers that
+# predate /capabilities get the original uncompressed format. An answer is
+# kept for the life of the process; if the server couldn't be asked, the
+# original format is used for CAPABILITIES_RETRY_SECONDS before asking
+# again, so a long-running daemon doesn't stay on it for good.
+#
+SERVER_CAPABILITIES = {}
+def get_server_capabilities(user):
+    return get_capabilities(user.get_server_url())
+
+def get_capabilities(url):
+    capabilities, expires = SERVER_CAPABILITIES.get(url, (None, None))
+    if capabilities is None or (expires is not None and time.monotonic() >= expires):
+        import requests
+        expires = None
+        try:
+            with profile_stage('http'):
+                response = requests.get("{}/capabilities".format(url), timeout=10)
+            if response.status_code == 200:
+                capabilities = response.json()
+            elif response.status_code >= 500 or response.status_code in (408, 429):
+                capabilities, expires = {}, time.monotonic() + CAPABILITIES_RETRY_SECONDS
+            else:
+                capabilities = {}
+        except (requests.RequestException, ValueError):
+            capabilities, expires = {}, time.monotonic() + CAPABILITIES_RETRY_SECONDS
+        SERVER_CAPABILITIES[url] = (capabilities, expires)
+    return capabilities
+
 
 #
 # Transmit observations to the server
@@ -225,9 +589,17 @@ def send_synclist(user, observationList, file_loc, comment=None):
 def send_process_sync(user, process, file_loc=None, comment=None):
     knps_version = get_version(file_loc)
     install_id = user.get_install_id()
-    hostname = socket.gethostname()
+    hostname = get_hostname()
     print("KNPS Version: ", knps_version)
 
+    process = json.dumps(process, default=str)
+    if USE_SPOOL:
+        return spool_payload(user, {'kind': 'process'}, process.encode())
+    return post_process_sync(user, process)
+
+def post_process_sync(user, process):
+    import requests
+
     url = "{}/syncprocess/{}".format(user.get_server_url(), user.username)
 
     login = {
@@ -235,17 +607,209 @@ def send_process_sync(user, process, file_loc=None, comment=None):
         'access_token': user.access_token
     }
 
-    fDict = {'process': json.dumps(process, default=str)}
-    response = requests.post(url, files=fDict, data=login)
-    obj_data = response.json()
+    fDict = {'process': process}
+    with profile_stage('http'):
+        response = requests.post(url, files=fDict, data=login)
+    return server_reply(response)
 
-    return obj_data
+#
+# With --store, send the server the bytes of observed files it doesn't
+# already have (see knps.blobs): a file's content-defined chunks if it has
+# them, otherwise the whole file. Each observation whose bytes the server
+# now holds lists them, in order, in content_blobs. A file that has
+# changed since it was observed is left alone; the next sync observes it
+# again. Returns {} or {'error': ...}.
+#
+def upload_blobs(user, observationList):
+    import requests
+    from knps.blobs import BlobError, BlobUploader, file_blobs
+
+    files = {}
+    blobs = {}
+    cache = get_hash_cache()
+    for f, file_hash, file_type, line_hashes, optionalItems, file_info in observationList:
+        chunks = None
+        if optionalItems.get('chunk_count'):
+            chunks = file_info.get('chunks') or (cache.lookup_chunks(file_hash) if cache else None)
+        files[f] = file_blobs(file_hash, file_info['file_size'], chunks)
+        for blob_hash, offset, size in files[f]:
+            blobs.setdefault(blob_hash, (f, offset, size, file_info))
+
+    uploader = BlobUploader(user.get_server_url(), user.username, user.access_token)
+    changed = set()
+    try:
+        for blob_hash in uploader.missing(list(blobs)):
+            f, offset, size, file_info = blobs[blob_hash]
+            try:
+                stats = os.stat(f)
+            except OSError:
+                stats = None
+            if stats is None or (stats.st_size, stats.st_mtime_ns) != (file_info['file_size'], file_info['mtime_ns']):
+                changed.add(f)
+                continue
+            uploader.upload(f, blob_hash, offset, size)
+    except (requests.RequestException, BlobError, ValueError, KeyError) as e:
+        return {'error': 'Blob upload failed: {}'.format(e)}
+    finally:
+        uploader.close()
+
+    for f, file_hash, file_type, line_hashes, optionalItems, file_info in observationList:
+        if f in changed:
+            print("*** Not storing {}: changed since it was observed".format(f))
+        else:
+            optionalItems['content_blobs'] = [blob_hash for blob_hash, offset, size in files[f]]
+
+    counts = uploader.counts
+    print("Stored {} new blobs ({:.1f} MB, {} resumed) for {} files".format(
+        counts['blobs'], counts['bytes'] / (1000 * 1000), counts['resumed'], len(files) - len(changed)))
+    return {}
+
+#
+# A spool record is a line of JSON saying what it is, followed by the
+# payload: bytes, or a file object that is copied into the spool.
+#
+def spool_payload(user, header, payload=b''):
+    data = json.dumps(header).encode() + b'\n'
+    fileobj = None
+    if isinstance(payload, bytes):
+        data += payload
+    else:
+        fileobj = payload
+    try:
+        with profile_stage('spool'):
+            user.get_spool().append(data, fileobj)
+    except SpoolFull as e:
+        return {'error': str(e)}
+    finally:
+        if fileobj is not None:
+            fileobj.close()
+    return {}
+
+#
+# Split a spool record into its header and payload. Records spooled by
+# older versions are a zlib-compressed JSON document.
+#
+def parse_spool_record(data):
+    if data.startswith(b'{'):
+        header, payload = data.split(b'\n', 1)
+        return json.loads(header), payload
+
+    record = json.loads(zlib.decompress(data))
+    if record['kind'] == 'synclist':
+        return {'kind': 'synclist', 'encoding': None}, json.dumps(record['observations']).encode()
+    return {'kind': record['kind']}, record.get('process', '').encode()
+
+#
+# Sends spooled payloads, oldest first. A payload is only removed from the
+# spool once the server has accepted it. If the server can't be reached
+# the replayer backs off and tries again later; a payload the server
+# rejects SPOOL_MAX_ATTEMPTS times, counted in the spool so that short
+# runs add up, is moved aside to the rejected file so it can't hold up
+# everything behind it, and the files in it are
+# forgotten so the next sync observes them again. Sending is limited to
+# SPOOL_RATE_KBPS if that is set.
+#
+class SpoolReplayer:
+    def __init__(self, user):
+        self.user = user
+        self.spool = user.get_spool()
+        self.drain_lock = DrainLock(self.spool.dir)
+        self.sent = 0
+        self.rejected = 0
+
+        self.wake = threading.Event()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def __deliver__(self, header, payload):
+        if header['kind'] == 'synclist':
+            return post_synclist_payload(self.user, payload, header.get('encoding'))
+        elif header['kind'] == 'process':
+            return post_process_sync(self.user, payload.decode())
+        return {'error': 'Unknown spool record kind: {}'.format(header['kind'])}
+
+    def __reject__(self, data, header, error):
+        with open(Path(self.spool.dir, 'rejected'), 'ab') as f:
+            f.write(json.dumps({'error': error, 'record': base64.b64encode(data).decode()}).encode() + b'\n')
+        self.rejected += 1
+        if header.get('files'):
+            Watcher(self.user).requeueFiles(header['files'])
+
+    #
+    # Send everything in the spool. Returns True if the spool was emptied,
+    # False if the server couldn't be reached or another process is
+    # already draining it.
+    #
+    def drain(self):
+        import requests
+
+        if not self.drain_lock.acquire():
+            return False
+
+        try:
+            started = time.monotonic()
+            sent_bytes = 0
+            for position, data in self.spool.records():
+                if self.stopping.is_set() and self.thread is not None and threading.current_thread() is self.thread:
+                    return False
+
+                try:
+                    with profile_stage('json'):
+                        header, payload = parse_spool_record(data)
+                    response = self.__deliver__(header, payload)
+                except (requests.RequestException, ValueError) as e:
+                    print('Server unavailable ({}); payloads stay spooled'.format(type(e).__name__))
+                    return False
+
+                if 'error' in response:
+                    print('ERROR: {}'.format(response['error']))
+                    if self.spool.fail(position) < SPOOL_MAX_ATTEMPTS:
+                        return False
+                    self.__reject__(data, header, response['error'])
+                else:
+                    self.sent += 1
+                self.spool.ack(position)
+
+                if SPOOL_RATE_KBPS:
+                    sent_bytes += len(data)
+                    delay = sent_bytes / (SPOOL_RATE_KBPS * 1024) - (time.monotonic() - started)
+                    if delay > 0:
+                        time.sleep(delay)
+            return True
+        finally:
+            self.drain_lock.release()
+
+    def __run__(self):
+        backoff = SPOOL_RETRY_SECONDS
+        while not self.stopping.is_set():
+            if self.drain():
+                backoff = SPOOL_RETRY_SECONDS
+                self.wake.wait(SPOOL_POLL_SECONDS)
+            else:
+                self.wake.wait(backoff)
+                backoff = min(backoff * 2, SPOOL_MAX_RETRY_SECONDS)
+            self.wake.clear()
+
+    #
+    # Keep draining on a background thread until stop()
+    #
+    def start(self):
+        self.thread = threading.Thread(target=self.__run__, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join()
 
 #
 # Transmit observations to the server
 #
 def send_adornment(user, filename, comment):
-    url = "{}/adorn/{}".format(KNPS_SERVER_URL, user.username)
+    import requests
+
+    url = "{}/adorn/{}".format(user.get_server_url(), user.username)
 
     login = {
         'username': user.username,
@@ -263,7 +827,9 @@ def send_adornment(user, filename, comment):
 # Transmit observations to the server
 #
 def send_createdataset(user, id, title, desc, targetHash):
-    url = "{}/createdataset/{}".format(KNPS_SERVER_URL, user.username)
+    import requests
+
+    url = "{}/createdataset/{}".format(user.get_server_url(), user.username)
 
     login = {
         'username': user.username,
@@ -299,65 +865,235 @@ def hash_image(fname):
     return None
 
 def get_csv_file_shingles(fname, fingerprint_bytes):
-    hashes = []
-    with open(fname, "rt") as f:
-        i = 0
-        next_read = 0
-        for line in f:
-            if i == next_read:
-                hashes.append(int.from_bytes(hashlib.sha256(line.strip().encode()).digest()[:fingerprint_bytes], 'little'))
-
-                if i < 100:
-                    next_read += 1
-                elif i < 1000:
-                    next_read += 5
-                elif i < 10000:
-                    next_read += 50
-                elif i < 100000:
-                    next_read += 500
-                else:
-                    next_read += 1000
-
-            i += 1
-
-    return hashes
+    return [int.from_bytes(hashlib.sha256(line).digest()[:fingerprint_bytes], 'little')
+            for line in sample_csv_file(fname)]
 
 # This fucntion removes punctiation and whitespace.
 # The returns a list of tokens(words) and should not contain any lists or anything along those lines.
 def createShingleFingerprints(s, fname, file_type, shingle_length = 5, fingerprint_bytes = 8):
     if file_type == "text/csv":
         return get_csv_file_shingles(fname, fingerprint_bytes)
-    s = re.sub(r'[^\w\s]', '', s)
-    words = s.lower().split()
-    shingles = []
-    if len(words) <= shingle_length:
-        fingerprint = int.from_bytes(hashlib.sha256(words.__str__().encode()).digest()[:fingerprint_bytes], 'little')
-        return {fingerprint}
-    for i in range(len(words)-shingle_length):
-        fingerprint = int.from_bytes(hashlib.sha256(words[i:i+shingle_length].__str__().encode()).digest()[:fingerprint_bytes], 'little')
-        shingles.append(fingerprint)
-    return shingles
+    return list(iter_shingle_fingerprints(iter_shingle_words([s]), shingle_length, fingerprint_bytes))
+
+PUNCTUATION_RE = re.compile(r'[^\w\s]')
+
+#
+# Normalized words of a text, one line at a time: punctuation removed and
+# lower-cased. Line breaks are whitespace, so this yields exactly the
+# words of the whole text split at once.
+#
+def iter_shingle_words(lines):
+    for line in lines:
+        yield from PUNCTUATION_RE.sub('', line).lower().split()
+
+def shingle_fingerprint(words, fingerprint_bytes = 8):
+    return int.from_bytes(hashlib.sha256(str(words).encode()).digest()[:fingerprint_bytes], 'little')
+
+#
+# Fingerprint every window of shingle_length consecutive words, keeping
+# only the last shingle_length + 1 words in memory. Texts of at most
+# shingle_length words get a single fingerprint of all their words.
+#
+# NOTE: the final window is (and always has been) left out; keep it that
+# way so signatures stay comparable with those already on the server.
+#
+def iter_shingle_fingerprints(words, shingle_length = 5, fingerprint_bytes = 8):
+    window = collections.deque(maxlen=shingle_length + 1)
+    count = 0
+    for word in words:
+        window.append(word)
+        count += 1
+        if count > shingle_length:
+            yield shingle_fingerprint(list(window)[:shingle_length], fingerprint_bytes)
+
+    if count <= shingle_length:
+        yield shingle_fingerprint(list(window), fingerprint_bytes)
 
 ## So for each s
 ## This function should find shingles.
 def getShingles(s, fname, file_type, shingle_length = 5, num_shingles = 10, fingerprint_bytes = 8):
-    random.seed(0)
-    shingles = []
     all_shingles = createShingleFingerprints(s, fname, file_type, shingle_length, fingerprint_bytes)
+    return minhash(all_shingles, num_shingles, fingerprint_bytes)
+
+def minhash(all_shingles, num_shingles = 10, fingerprint_bytes = 8):
+    signature = MinHash(num_shingles, fingerprint_bytes)
+    for shingle in all_shingles:
+        signature.update(shingle)
+    return signature.signature()
 
-    if all_shingles:
+#
+# MinHash signature of a stream of shingle fingerprints: for each of
+# num_shingles random permutations, the fingerprint with the smallest
+# permuted value. When several fingerprints share the minimum the last
+# one seen wins.
+#
+# With NumPy available, fingerprints are buffered into uint64 arrays and
+# all permutations are evaluated for a whole batch at once. uint64
+# arithmetic wraps modulo 2**64, which is exactly the modulus used for
+# 8-byte fingerprints, so the results match the pure-Python path.
+#
+class MinHash:
+    def __init__(self, num_shingles = 10, fingerprint_bytes = 8):
+        rand = random.Random(0)
+        self.modulus = 256**fingerprint_bytes
+        self.permutations = []
         for i in range(num_shingles):
-            factor = int(random.random()*(256**fingerprint_bytes))
-            shift = int(random.random()*(256**fingerprint_bytes))
-            new_shingles = {}
-            for shingle in all_shingles:
-                new_shingles[(factor*shingle+shift)%(256**fingerprint_bytes)] = shingle
-            minimum = min(new_shingles.keys())
-            shingles.append(str(new_shingles[minimum]))
-    return shingles
+            factor = int(rand.random()*self.modulus)
+            shift = int(rand.random()*self.modulus)
+            self.permutations.append((factor, shift))
+
+        self.minimums = [None] * num_shingles
+        self.shingles = [None] * num_shingles
+
+        self.batch = []
+        self.vectorized = load_numpy() is not None and fingerprint_bytes <= 8 and num_shingles > 0
+        if self.vectorized:
+            self.factors = np.array([factor for factor, shift in self.permutations], dtype=np.uint64)[:, None]
+            self.shifts = np.array([shift for factor, shift in self.permutations], dtype=np.uint64)[:, None]
+
+    def update(self, shingle):
+        if self.vectorized:
+            self.batch.append(shingle)
+            if len(self.batch) >= MINHASH_BATCH_SIZE:
+                self.__flush__()
+            return
+
+        for i, (factor, shift) in enumerate(self.permutations):
+            value = (factor*shingle+shift) % self.modulus
+            if self.minimums[i] is None or value <= self.minimums[i]:
+                self.minimums[i] = value
+                self.shingles[i] = shingle
+
+    def __flush__(self):
+        if not self.batch:
+            return
+        fingerprints = np.array(self.batch, dtype=np.uint64)
+        self.batch = []
+
+        values = fingerprints * self.factors + self.shifts
+        if self.modulus < 2**64:
+            values &= np.uint64(self.modulus - 1)
+
+        # Index of the *last* minimum in each row, to match the scalar path
+        last = len(fingerprints) - 1 - values[:, ::-1].argmin(axis=1)
+        for i, j in enumerate(last):
+            value = int(values[i, j])
+            if self.minimums[i] is None or value <= self.minimums[i]:
+                self.minimums[i] = value
+                self.shingles[i] = int(fingerprints[j])
+
+    def signature(self):
+        if self.vectorized:
+            self.__flush__()
+        if self.shingles and self.shingles[0] is None:
+            return []
+        return [str(shingle) for shingle in self.shingles]
+
+#
+# One-permutation MinHash with densification, for very large documents:
+# a single permutation splits the hash space into num_shingles bins and
+# keeps the minimum of each bin, so each fingerprint is hashed once
+# instead of num_shingles times. Empty bins borrow the value of another
+# bin picked by a fixed probe sequence.
+#
+# The signatures are NOT comparable with MinHash signatures; observations
+# that use it are tagged with shingle_scheme = 'oph'.
+#
+class OnePermutationMinHash:
+    def __init__(self, num_shingles = 10, fingerprint_bytes = 8):
+        rand = random.Random(0)
+        self.modulus = 256**fingerprint_bytes
+        self.factor = int(rand.random()*self.modulus)
+        self.shift = int(rand.random()*self.modulus)
+        self.num_shingles = num_shingles
+        self.bin_width = -(-self.modulus // num_shingles)
+
+        self.minimums = [None] * num_shingles
+        self.shingles = [None] * num_shingles
+
+        self.batch = []
+        self.vectorized = load_numpy() is not None and fingerprint_bytes <= 8 and num_shingles > 0
+
+    def __add__(self, value, shingle):
+        b = value // self.bin_width
+        if self.minimums[b] is None or value <= self.minimums[b]:
+            self.minimums[b] = value
+            self.shingles[b] = shingle
+
+    def update(self, shingle):
+        if self.vectorized:
+            self.batch.append(shingle)
+            if len(self.batch) >= MINHASH_BATCH_SIZE:
+                self.__flush__()
+        else:
+            self.__add__((self.factor*shingle+self.shift) % self.modulus, shingle)
+
+    def __flush__(self):
+        if not self.batch:
+            return
+        fingerprints = np.array(self.batch, dtype=np.uint64)
+        self.batch = []
+
+        values = fingerprints * np.uint64(self.factor) + np.uint64(self.shift)
+        if self.modulus < 2**64:
+            values &= np.uint64(self.modulus - 1)
+        if self.bin_width < 2**64:
+            bins = values // np.uint64(self.bin_width)
+        else:
+            bins = np.zeros_like(values)
+
+        for b in np.unique(bins):
+            selected = np.flatnonzero(bins == b)
+            j = selected[len(selected) - 1 - values[selected][::-1].argmin()]
+            self.__add__(int(values[j]), int(fingerprints[j]))
+
+    def signature(self):
+        if self.vectorized:
+            self.__flush__()
+        if all(shingle is None for shingle in self.shingles):
+            return []
+
+        shingles = list(self.shingles)
+        for i in range(self.num_shingles):
+            attempt = 0
+            while shingles[i] is None:
+                attempt += 1
+                probe = random.Random(f'{i}-{attempt}').randrange(self.num_shingles)
+                shingles[i] = self.shingles[probe]
+        return [str(shingle) for shingle in shingles]
+
+#
+# Incremental shingling of a text fed one line at a time.
+#
+class ShingleHasher:
+    def __init__(self, shingle_length = 5, num_shingles = 10, fingerprint_bytes = 8, densified = False):
+        self.shingle_length = shingle_length
+        self.fingerprint_bytes = fingerprint_bytes
+        self.window = collections.deque(maxlen=shingle_length + 1)
+        self.count = 0
+        self.scheme = 'oph' if densified else 'minhash'
+        if densified:
+            self.minhash = OnePermutationMinHash(num_shingles, fingerprint_bytes)
+        else:
+            self.minhash = MinHash(num_shingles, fingerprint_bytes)
+
+    def feed(self, line):
+        for word in PUNCTUATION_RE.sub('', line).lower().split():
+            self.window.append(word)
+            self.count += 1
+            if self.count > self.shingle_length:
+                self.minhash.update(shingle_fingerprint(list(self.window)[:self.shingle_length], self.fingerprint_bytes))
+
+    def signature(self):
+        if self.count <= self.shingle_length:
+            self.minhash.update(shingle_fingerprint(list(self.window), self.fingerprint_bytes))
+            self.count = self.shingle_length + 1
+        return self.minhash.signature()
 
 ## use the mimetype
 def get_file_type(f):
+    from binaryornot.check import is_binary
+
     type, encoding = mimetypes.guess_type(f)
 
     if type:
@@ -369,6 +1105,288 @@ def get_file_type(f):
 
 
 ## check if the file is binary by trying to open it
+def is_binary_head(fname, head):
+    from binaryornot.helpers import is_binary_string
+
+    # Same test as binaryornot's is_binary(), applied to the first
+    # BINARY_SNIFF_BYTES of the file we have already read
+    try:
+        return fname.endswith('.pyc') or is_binary_string(head)
+    except (NameError, TypeError):
+        # binaryornot's Python 2 fallback, hit when chardet is confident
+        # but names no encoding, i.e. the bytes aren't text
+        return True
+
+#
+# A raw reader that hands every block it reads to a list of consumers,
+# so a file can be decoded as text and hashed in the same pass.
+#
+class TeeReader(io.RawIOBase):
+    def __init__(self, f, consumers):
+        self.f = f
+        self.consumers = consumers
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        with profile_stage('read'):
+            n = self.f.readinto(b)
+        if n:
+            profile_read(n)
+            block = memoryview(b)[:n]
+            for consume in self.consumers:
+                consume(block)
+        return n
+
+    def drain(self):
+        buf = bytearray(READ_BLOCK_SIZE)
+        while self.readinto(buf):
+            pass
+
+#
+# Identifies a file's list of content-defined chunks: the MD5 of its
+# chunk hashes and sizes, in order
+#
+def chunk_list_hash(chunks):
+    hash_md5 = hashlib.md5()
+    for chunk_hash, size in chunks:
+        hash_md5.update(bytes.fromhex(chunk_hash) + size.to_bytes(8, 'little'))
+    return hash_md5.hexdigest()
+
+#
+# Compute everything we observe about a file in a single read: the
+# whole-file hash, the binary sniff and file type, line hashes, shingles,
+# content-defined chunk hashes (binary and very large files) and
+# (with store, for servers without blob uploads) the base64 content. Produces the same values as
+# hash_file(), get_file_type(), hash_file_lines() and getShinglesFname().
+#
+# PDFs are the exception: once the file hash is known, their text is
+# extracted separately by hash_pdf_file_lines().
+#
+def analyze_file(fname, stats=None, store=False):
+    if stats is None:
+        stats = os.stat(fname)
+
+    hash_md5 = hashlib.md5()
+    consumers = [profile_timed('md5', hash_md5.update)]
+
+    content = None
+    if store and stats.st_size < INLINE_CONTENT_MAX_BYTES:
+        content = bytearray()
+        consumers.append(profile_timed('content', content.extend))
+
+    line_hashes = []
+    shingles = None
+    shingle_scheme = 'minhash'
+    incomplete = False
+
+    with open(fname, "rb", buffering=0) as raw:
+        with profile_stage('mimetype'):
+            file_type, encoding = mimetypes.guess_type(fname)
+            binary = None
+            if not file_type or file_type not in ("application/pdf", "text/csv"):
+                binary = is_binary_head(fname, raw.read(BINARY_SNIFF_BYTES))
+                raw.seek(0)
+            if not file_type:
+                file_type = 'binary/unknown' if binary else 'text/unknown'
+
+        chunker = None
+        if binary or stats.st_size >= CHUNK_LARGE_FILE_BYTES:
+            from knps.cdc import Chunker
+            chunker = Chunker()
+            consumers.append(profile_timed('chunking', chunker.update))
+
+        reader = TeeReader(raw, consumers)
+
+        if file_type == "application/pdf":
+            reader.drain()
+            line_hashes = hash_pdf_file_lines(fname, hash_md5.hexdigest())
+            if line_hashes is None:
+                line_hashes = []
+                incomplete = True
+
+        elif file_type == "text/csv":
+            if is_huge_csv(stats.st_size):
+                # The file hash still needs every byte, but only the
+                # sampled lines are found and decoded
+                reader.drain()
+                sample = iter_csv_seek_sample(fname)
+            else:
+                sample = iter_csv_sample(io.TextIOWrapper(io.BufferedReader(reader, READ_BLOCK_SIZE)))
+            with profile_stage('csv'):
+                line_hashes, fingerprints = hash_csv_sample(sample)
+                shingles = minhash(fingerprints)
+
+        elif not binary or file_type.startswith("text/"):
+            want_lines = not binary
+            shingler = None
+            if file_type.startswith("text/"):
+                densified = MINHASH_OPH_BYTES > 0 and stats.st_size >= MINHASH_OPH_BYTES
+                shingler = ShingleHasher(densified=densified)
+            text = io.TextIOWrapper(io.BufferedReader(reader, READ_BLOCK_SIZE))
+            # Lines are handled in batches so each step can be timed
+            # without a timer call per line
+            while True:
+                with profile_stage('decode'):
+                    lines = list(itertools.islice(text, LINE_BATCH_SIZE))
+                if not lines:
+                    break
+                if shingler:
+                    with profile_stage('shingling'):
+                        for line in lines:
+                            shingler.feed(line)
+                if want_lines:
+                    with profile_stage('line_hashes'):
+                        line_hashes.extend(hashlib.md5(line.strip().encode()).hexdigest() for line in lines)
+            if shingler:
+                shingles = shingler.signature()
+                shingle_scheme = shingler.scheme
+
+        else:
+            reader.drain()
+
+    if content is not None:
+        content = codecs.encode(bytes(content), "base64").decode("utf-8")
+
+    return {
+        'file_hash': hash_md5.hexdigest(),
+        'file_type': file_type,
+        'line_hashes': line_hashes,
+        'shingles': shingles,
+        'shingle_scheme': shingle_scheme,
+        'chunks': chunker.finish() if chunker else None,
+        'content': content,
+        'incomplete': incomplete,
+    }
+
+#
+# This is where we collect observation data.
+#
+# The input is a file path.
+#
+# The output is a tuple with 6 elements:
+# 1) The file path
+# 2) The file hash
+# 3) The file type
+# 4) Line hashes
+# 5) A dictionary of optional objects. This can vary according to
+#    the file type or whatever we like. IF YOU ARE ADDING NEW INFO
+#    DURING THE PROFILE STAGE, ADD IT TO THIS DICTIONARY!
+# 6) The size and modification times from the file's stat record
+#
+### TODO:
+### more ways to do partial hashes (based upon file type)
+
+def observe_file(f, store=False):
+    profile = SYNC_PROFILE
+    if profile is not None:
+        started = time.perf_counter()
+        bytes_read = profile.thread_bytes_read()
+
+    with profile_stage('stat'):
+        stats = os.stat(f)
+    cache = get_hash_cache()
+    with profile_stage('cache'):
+        cached = cache.lookup(f, stats) if cache else None
+
+    if cached and 'line_hashes' in cached and 'shingles' in cached and 'chunk_count' in cached and not store:
+        result = cached
+    else:
+        with profile_stage('analyze'):
+            result = analyze_file(f, stats, store)
+        chunks = result['chunks']
+        result['chunk_count'] = len(chunks) if chunks else None
+        result['chunk_list_hash'] = chunk_list_hash(chunks) if chunks else None
+        if cache and not result['incomplete']:
+            with profile_stage('cache'):
+                if chunks:
+                    cache.store_chunks(result['file_hash'], chunks)
+                cache.store(f, stats, file_hash=result['file_hash'], file_type=result['file_type'],
+                            line_hashes=result['line_hashes'], shingles=result['shingles'],
+                            shingle_scheme=result['shingle_scheme'], chunk_count=result['chunk_count'],
+                            chunk_list_hash=result['chunk_list_hash'])
+        HASH_CACHE[(f, stats.st_size, stats.st_mtime_ns)] = result['file_hash']
+
+    file_type = result['file_type']
+    optionalFields = {}
+    optionalFields["filetype"] = file_type
+
+    if result.get('content') is not None:
+        optionalFields["content"] = result['content']
+
+    ##CSV_Column_hashs
+    # if "csv" in file_type:
+    #     column_hashes = hash_CSV_columns(f)
+    #     optionalFields["column_hashes"] = column_hashes
+
+    # if file_type.startswith("text/") and file_type != "text/csv":
+    if file_type.startswith("text/"):
+        optionalFields["shingles"] = result['shingles']
+        if result.get('shingle_scheme', 'minhash') != 'minhash':
+            optionalFields["shingle_scheme"] = result['shingle_scheme']
+
+    # Content-defined chunks of binary and very large files. Only their
+    # number and a hash of the list are sent; the list itself is in the
+    # hash cache, for blob uploads.
+    if result.get('chunk_count'):
+        optionalFields["chunk_count"] = result['chunk_count']
+        optionalFields["chunk_list_hash"] = result['chunk_list_hash']
+
+    file_info = {'file_size': stats.st_size, 'modified': stats.st_mtime, 'mtime_ns': stats.st_mtime_ns}
+    # Without a cache the chunk list has to travel with the observation
+    if cache is None and result.get('chunks'):
+        file_info['chunks'] = result['chunks']
+    # Analysis was cut short (e.g. a PDF timed out); observe it again next sync
+    if result.get('incomplete'):
+        file_info['retry'] = True
+
+    if profile is not None:
+        profile.count('cache_hits' if result is cached else 'cache_misses')
+        profile.file_done(f, file_type, stats.st_size, time.perf_counter() - started,
+                          profile.thread_bytes_read() - bytes_read)
+    return (f, result['file_hash'], file_type, result['line_hashes'], optionalFields, file_info)
+
+#
+# Entry point for --jobs worker processes. Errors are returned rather
+# than raised so one bad file doesn't take down the rest of the chunk, and
+# the worker's cache writes are committed before the result is handed back.
+# With profile, the file's timings are handed back too, to be merged into
+# the syncing process's profile.
+#
+def observe_file_worker(f, store=False, profile=False):
+    global SYNC_PROFILE
+    SYNC_PROFILE = SyncProfile() if profile else None
+
+    try:
+        observation, error = observe_file(f, store), None
+    except Exception as e:
+        observation, error = None, str(e)
+    finally:
+        with profile_stage('cache'):
+            flush_hash_cache()
+    return f, observation, error, SYNC_PROFILE.export() if SYNC_PROFILE else None
+
+def init_pool_worker(jobs):
+    global POOL_JOBS
+    POOL_JOBS = jobs
+
+#
+# The pool of --jobs workers. The syncing process has uploader and spool
+# threads holding locks and SQLite connections, which a forked child would
+# inherit mid-use, so workers are started from a fresh forkserver (or
+# spawned, where there is no forkserver) instead of forked.
+#
+def make_process_pool(jobs):
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+    return ProcessPoolExecutor(max_workers=jobs, mp_context=context,
+                               initializer=init_pool_worker, initargs=(jobs,))
+
+
 
 
 class Error(Exception):
@@ -390,10 +1408,16 @@ class WrongUserError(Error):
 #
 class User:
     def __init__(self):
+        self.work_queue = None
+        self.spool = None
+        self.ignore_rules = {}
         self.load_db()
         self.username, self.access_token = self.get_current_user()
 
     def login(self, username=None):
+        import requests
+        import webbrowser
+
         # FOR TEMP LOGIN.
         if username:
             self.username = username
@@ -433,6 +1457,9 @@ class User:
                 print("You are now logged in as: {}".format(token_data['email']))
 
     def logout(self):
+        import requests
+        import webbrowser
+
         ROOTURL = self.get_server_url()
         url = ROOTURL + "/cli_logout"
 
@@ -482,7 +1509,7 @@ class User:
 
     def set_store(self, shouldStore):
         # TODO: do some validation here
-        self.db['__STORE__'] = bool(distutils.util.strtobool(shouldStore))
+        self.db['__STORE__'] = strtobool(shouldStore)
         self.save_db()
 
     def get_store(self):
@@ -493,6 +1520,7 @@ class User:
             self.load_db()
 
         if '__INSTALL_ID__' not in self.db:
+            import uuid
             self.db['__INSTALL_ID__'] = str(uuid.uuid1())
             self.save_db()
 
@@ -509,29 +1537,89 @@ class User:
     def get_dirs(self):
         return self.db[self.username].get('dirs', [])
 
+    #
+    # Lazily yields (path, DirEntry) for every watched file
+    #
+    def iter_files(self):
+        return iter_files(self.get_dirs())
+
     def get_files(self):
-        files = []
+        return [path for path, entry in self.iter_files()]
+
+    def count_files(self):
+        return sum(1 for x in self.iter_files())
+
+    #
+    # Is this path inside a watched directory and not ignored?
+    #
+    def is_watched(self, path):
         for d in self.get_dirs():
-            files += [os.path.join(r, file) for r,d,f in os.walk(d) if '.knps' not in r for file in f]
+            if os.path.commonpath([d, path]) == d:
+                return not self.get_ignore_rules(d).ignores_path(d, path)
+        return False
+
+    #
+    # The ignore rules for a watched directory. They are checked for every
+    # file event, so they are only read again when one of the .knpsignore
+    # files they come from changes.
+    #
+    def get_ignore_rules(self, d):
+        stamp = []
+        for p in IgnoreRules.sources(d):
+            try:
+                stats = os.stat(p)
+                stamp.append((stats.st_mtime_ns, stats.st_size))
+            except OSError:
+                stamp.append(None)
 
-        return files
+        cached = self.ignore_rules.get(d)
+        if cached is None or cached[0] != stamp:
+            cached = self.ignore_rules[d] = (stamp, IgnoreRules.for_root(d))
+        return cached[1]
+
+    #
+    # Pending observation chunks live in their own work queue rather than
+    # in the user DB. TODO lists left in the user DB by older versions are
+    # moved over the first time the queue is opened.
+    #
+    def get_work_queue(self):
+        if self.work_queue is None:
+            self.work_queue = WorkQueue(Path(Path.home(), QUEUE_FILE), self.username)
+
+            legacyTodos = self.db.get(self.username, {}).pop("todos", None)
+            if legacyTodos:
+                self.work_queue.enqueue_many(list(legacyTodos.values()))
+                self.save_db()
+
+        return self.work_queue
+
+    def get_spool(self):
+        if self.spool is None:
+            # Payloads are for the server that was current when they were spooled
+            server = re.sub(r'[^A-Za-z0-9.-]', '_', self.get_server())
+            self.spool = Spool(Path(Path.home(), SPOOL_DIR, self.username, server), SPOOL_MAX_MB * 1024 * 1024)
+        return self.spool
 
     def getNextTodoList(self):
-        todoDict = self.db[self.username].get("todos", {})
-        if len(todoDict) == 0:
-            return None
-        for k, v in todoDict.items():
-            return (k, v)
+        return self.get_work_queue().first()
+
+    def getTodoLists(self):
+        return self.get_work_queue().pending()
+
+    def getTodoCounts(self):
+        return self.get_work_queue().counts()
 
     def removeTodoList(self, todoKey):
-        todoDict = self.db[self.username].get("todos", {})
-        todoDict.pop(todoKey, None)
-        self.save_db()
+        self.get_work_queue().ack(todoKey)
 
     def addTodoList(self, todoList):
-        todoDict = self.db[self.username].setdefault("todos", {})
-        todoDict[datetime.now().microsecond] = todoList
-        self.save_db()
+        self.get_work_queue().enqueue(todoList)
+
+    def addTodoLists(self, todoLists):
+        self.get_work_queue().enqueue_many(todoLists)
+
+    def clearTodoLists(self):
+        self.get_work_queue().clear()
 
 #
 # This maintains a user's set of watched files and dirs
@@ -540,7 +1628,7 @@ class Watcher:
     def __init__(self, user):
         self.user = user
         self.config = None
-        self.db = None
+        self.processed = None
         self.knps_version = get_version()
 
     #
@@ -557,6 +1645,7 @@ class Watcher:
         cfg = self.__get_cfg__(dir)
         # The target shouldn't already have a .knps config dir
         if cfg.exists():
+            import configparser
             self.config = configparser.ConfigParser()
             self.config.read(self.__get_cfg__(dir))
 
@@ -579,6 +1668,7 @@ class Watcher:
         cfg_dir = d.joinpath(CFG_DIR)
         cfg_dir.mkdir(exist_ok=True)
 
+        import configparser
         self.config = configparser.ConfigParser()
         self.config.read(self.__get_cfg__(d))
         self.config.add_section('KNPS')
@@ -586,49 +1676,33 @@ class Watcher:
 
         self.config.write(self.__get_cfg__(d).open("w"))
 
-    def __load_local_db__(self):
-        p = Path(Path.home(), DIR_DB_FILE)
-        db_version = None
-        if p.exists():
-            try:
-                self.db = json.load(p.open())
-                db_version = self.db.get('__KNPS_VERSION__', None)
-            except Exception as e:
-                print(e)
-                pass
-
-        if not self.db or db_version != self.knps_version:
-            self.db = {'__KNPS_VERSION__': self.knps_version}
-
-        if self.user.username not in self.db:
-            self.db[self.user.username] = {}
-
-        if self.user.get_server() not in self.db[self.user.username]:
-            self.db[self.user.username][self.user.get_server()] = {}
-
-    def __save_local_db__(self):
-        json.dump(self.db, Path(Path.home(), DIR_DB_FILE).open('wt'), indent=2)
+    #
+    # The files already uploaded to the current server, opened on first
+    # use. Any ~/.knps_dir_db left by an older knps is imported into it.
+    #
+    def __get_processed__(self):
+        if self.processed is None:
+            self.processed = ProcessedFiles(Path(Path.home(), PROCESSED_FILE), self.user.username,
+                                            self.user.get_server(), legacy_path=Path(Path.home(), DIR_DB_FILE))
+        return self.processed
 
     def file_already_processed(self, f):
         if not CACHE_FILE_PROCESSING:
             return False
 
-        if not self.db:
-            self.__load_local_db__()
-
-        file_hash = hash_file(f)
-
-        return file_hash in self.db[self.user.username][self.user.get_server()] and f in self.db[self.user.username][self.user.get_server()][file_hash]
+        return self.__get_processed__().contains(f, hash_file(f))
 
-    def record_file_processing(self, f):
+    def record_file_processing(self, f, file_hash=None):
         if CACHE_FILE_PROCESSING:
-            if not self.db:
-                self.__load_local_db__()
+            self.__get_processed__().record([(f, file_hash or hash_file(f))])
 
-            file_hash = hash_file(f)
-            if file_hash not in self.db:
-                self.db[self.user.username][self.user.get_server()][file_hash] = {}
-            self.db[self.user.username][self.user.get_server()][file_hash][f] = 1
+    #
+    # Record a chunk of uploaded observations in one transaction, using
+    # the hashes computed when they were observed
+    #
+    def __record_processed__(self, observationList):
+        if CACHE_FILE_PROCESSING:
+            self.__get_processed__().record([(observation[0], observation[1]) for observation in observationList])
 
     #
     # Comment on an observed file
@@ -644,6 +1718,8 @@ class Watcher:
     # Create a Dataset for a given file.
     #
     def addDataset(self, configYamlFile):
+        import yaml
+
         #self.observeAndSync()
 
         with open(configYamlFile, "r") as stream:
@@ -654,11 +1730,17 @@ class Watcher:
     #
     # Collect some observations
     #
-    def observeAndSync(self, file_loc = None, process=None):
+    def observeAndSync(self, file_loc = None, process=None, jobs=1, full=False):
         if file_loc == None:
             file_loc = __file__
+
+        # A full resync starts over, observing every watched file
+        if full:
+            self.user.clearTodoLists()
+
         # If there are TODO items outstanding, great.
         todoPair = self.user.getNextTodoList()
+        file_hashes = {}
 
 
 
@@ -672,72 +1754,89 @@ class Watcher:
             print("No existing observation list. Formulating new one...")
             k = 50
 
-            file_list = self.user.get_files()
+            files = self.user.iter_files()
+            if SYNC_PROFILE is not None:
+                files = SYNC_PROFILE.iter_stage('walk', files)
+            file_list = self.__stat_entries__(files)
 
             if process and len(process['output_files']) + len(process['access_files']) > 0:
                 process_files = set.union(process['input_files'], process['output_files'], process['access_files'])
-                file_list = [value for value in process_files if value in file_list]
-
-            longTodoList = [x for x in file_list]
-            smallTodoLists = [longTodoList[i:i+k] for i in range(0, len(longTodoList), k)]
+                file_list = self.__stat_files__(f for f in process_files if self.user.is_watched(f))
 
-            for smallTodoList in smallTodoLists:
-                self.user.addTodoList(smallTodoList)
-            todoPair = self.user.getNextTodoList()
+            changedFiles = self.__changed_files__(file_list, file_hashes, full=full, find_deleted=not process)
+            while True:
+                smallTodoLists = [list(itertools.islice(changedFiles, k)) for i in range(TODO_ENQUEUE_BATCH)]
+                smallTodoLists = [x for x in smallTodoLists if x]
+                if not smallTodoLists:
+                    break
+                self.user.addTodoLists(smallTodoLists)
 
-        print("Processing observation list...")
+        todoChunks, todoFiles = self.user.getTodoCounts()
+        print("Processing observation list: {} files in {} chunks...".format(todoFiles, todoChunks))
 
         #
         # Now finish all outstanding TODO lists. Mark them
         # as done as we go.
         #
-        self.__load_local_db__()
-        file_hashes = {}
-        while todoPair is not None:
-            k, todoList = todoPair
+        # Chunks are observed on this thread and uploaded on another, so
+        # the next chunk is being hashed while the previous one is in
+        # flight. The queue bounds how far observation can run ahead.
+        #
+        executor = make_process_pool(jobs) if jobs > 1 else None
+        manifest = self.__get_manifest__()
+        replayer = self.__start_replayer__()
+        upload_queue = queue.Queue(maxsize=SYNC_PIPELINE_DEPTH)
+        upload_state = {'failed': threading.Event(), 'exception': None}
+        uploader = threading.Thread(target=self.__upload_chunks__,
+                                    args=(upload_queue, upload_state, manifest, file_loc),
+                                    daemon=True)
+        uploader.start()
+
+        for chunkNumber, (k, todoList) in enumerate(self.user.getTodoLists(), 1):
+            if upload_state['failed'].is_set():
+                break
+            print("Observing chunk {} of {}".format(chunkNumber, todoChunks))
 
             # Process what's on the TODO list, upload it a chunk at a time
             observationList = []
             todoChunk = todoList
             skipCount = 0
             uploadCount = 0
-            for f in todoChunk:
+            for f, observation, error in self.__observe_chunk__(todoChunk, executor):
                 print("Processing", f)
-                try:
-                    file_hashes[f] = hash_file(f)
+                if error is not None:
+                    print("*** Skipping: {}".format(error))
+                    skipCount += 1
+                    continue
 
-                    #if self.file_already_processed(f):
-                    #    print(" -- Already processed")
-                    #    continue
+                file_hashes[f] = observation[1]
+                observationList.append(observation)
+                uploadCount += 1
 
+            with profile_stage('cache'):
+                flush_hash_cache()
 
-                    observationList.append(self._observeFile_(f))
-                    uploadCount += 1
-                    self.record_file_processing(f)
-                except Exception as e:
-                    print("*** Skipping: {}".format(e))
-                    skipCount += 1
+            # Blocks while SYNC_PIPELINE_DEPTH chunks are already waiting
+            with profile_stage('upload_wait'):
+                upload_queue.put((k, observationList, uploadCount, skipCount))
 
-            print("Sending the synclist")
-            response = send_synclist(self.user, observationList, file_loc)
-            if 'error' in response:
-                print('ERROR: {}'.format(response['error']))
-                break
-            else:
-                print("Observed and uploaded", uploadCount, "items. Skipped", skipCount)
-                self.__save_local_db__()
+        upload_queue.put(None)
+        with profile_stage('upload_wait'):
+            uploader.join()
 
-                # Mark the TODO list as done
-                self.user.removeTodoList(k)
+        if executor:
+            executor.shutdown()
+        manifest.close()
 
-                # Get the next one if available
-                todoPair = self.user.getNextTodoList()
+        if upload_state['exception'] is not None:
+            self.__finish_replayer__(replayer)
+            raise upload_state['exception']
 
         # Now process the process
         if process and len(process['outputs']) + len(process['accesses']) > 0:
             knps_version = get_version(file_loc)
             install_id = self.user.get_install_id()
-            hostname = socket.gethostname()
+            hostname = get_hostname()
 
             process['input_files'] = [(x, file_hashes[x]) for x in process['input_files'] if x in file_hashes]
             process['output_files'] = [(x, file_hashes[x]) for x in process['output_files'] if x in file_hashes]
@@ -750,212 +1849,442 @@ class Watcher:
 
             send_process_sync(self.user, process, file_loc=file_loc)
 
+        self.__finish_replayer__(replayer)
+
     #
-    # This is where we collect observation data.
+    # With the spool on, uploads during a sync only reach the spool; a
+    # replayer sends them in the background, and whatever it hasn't sent
+    # by the end is sent before returning, if the server is reachable.
     #
-    # The input is a file path.
+    def __start_replayer__(self):
+        if not USE_SPOOL:
+            return None
+        replayer = SpoolReplayer(self.user)
+        replayer.start()
+        return replayer
+
+    def __finish_replayer__(self, replayer):
+        if replayer is None:
+            return
+        replayer.stop()
+        with profile_stage('upload_wait'):
+            drained = replayer.drain()
+        if not drained:
+            records, size = self.user.get_spool().pending()
+            if records:
+                print("{} payloads ({:.1f} MB) are spooled and will be sent when the server is reachable (knps --spool flush).".format(
+                    records, size / (1000 * 1000)))
+
     #
-    # The output is a tuple with 4 elements:
-    # 1) The username
-    # 2) The file path
-    # 3) The file hash
-    # 4) Line hashes
-    # 5) A dictionary of optional objects. This can vary according to
-    #    the file type or whatever we like. IF YOU ARE ADDING NEW INFO
-    #    DURING THE PROFILE STAGE, ADD IT TO THIS DICTIONARY!
+    # Upload side of the sync pipeline. A chunk's TODO list is only marked
+    # done (and its files recorded as uploaded) once the server has
+    # accepted it; after the first failure the remaining chunks are left
+    # on the TODO list for the next sync.
     #
-    ### TODO:
-    ### more ways to do partial hashes (based upon file type)
+    def __upload_chunks__(self, upload_queue, upload_state, manifest, file_loc):
+        import requests
 
-    def _observeFile_(self, f):
-        file_hash = hash_file(f)
-        file_type = get_file_type(f)
-        line_hashes = hash_file_lines(f, file_type)
-        optionalFields = {}
-        optionalFields["filetype"] = file_type
+        while True:
+            item = upload_queue.get()
+            if item is None:
+                break
+            if upload_state['failed'].is_set():
+                continue
 
-        if self.user.get_store():
-            if os.stat(f).st_size < 10 * 1000 * 1000:
-                optionalFields["content"] = codecs.encode(open(f, "rb").read(), "base64").decode("utf-8")
+            k, observationList, uploadCount, skipCount = item
+            try:
+                with profile_stage('blobs'):
+                    response = self.__store_blobs__(observationList)
+                if 'error' not in response:
+                    print("Sending the synclist")
+                    response = send_synclist(self.user, observationList, file_loc)
+                if 'error' in response:
+                    print('ERROR: {}'.format(response['error']))
+                    upload_state['failed'].set()
+                    continue
 
+                print("Observed and uploaded", uploadCount, "items. Skipped", skipCount)
+                with profile_stage('local_db'):
+                    self.__record_processed__(observationList)
+                with profile_stage('manifest'):
+                    manifest.mark_uploaded([(f, info['file_size'], info['mtime_ns'], file_hash)
+                                            for f, file_hash, file_type, line_hashes, optionalItems, info in observationList
+                                            if not info.get('retry')])
 
+                # Mark the TODO list as done
+                self.user.removeTodoList(k)
+            except requests.RequestException as e:
+                print('ERROR: {}. Will retry on the next sync.'.format(e))
+                upload_state['failed'].set()
+            except Exception as e:
+                upload_state['exception'] = e
+                upload_state['failed'].set()
 
-        ##CSV_Column_hashs
-        # if "csv" in file_type:
-        #     column_hashes = hash_CSV_columns(f)
-        #     optionalFields["column_hashes"] = column_hashes
+    #
+    # Observe and upload a specific set of files right away (used by the
+    # sync daemon). Unchanged files are skipped; chunks that can't be
+    # uploaded are put on the TODO list for the next sync. Returns False
+    # if any were.
+    #
+    def syncFiles(self, files, executor=None, file_loc=None):
+        import requests
 
-        # if file_type.startswith("text/") and file_type != "text/csv":
-        if file_type.startswith("text/"):
-            shingles = getShinglesFname(f, file_type)
-            optionalFields["shingles"] = shingles
-        return (f, file_hash, file_type, line_hashes, optionalFields)
+        if file_loc == None:
+            file_loc = __file__
 
+        changedFiles = list(self.__changed_files__(self.__stat_files__(files), {}, find_deleted=False))
+        manifest = self.__get_manifest__()
 
+        uploaded = True
+        k = 50
+        for i in range(0, len(changedFiles), k):
+            chunk = changedFiles[i:i+k]
+            observationList = []
+            for f, observation, error in self.__observe_chunk__(chunk, executor):
+                print("Processing", f)
+                if error is not None:
+                    print("*** Skipping: {}".format(error))
+                    continue
+                observationList.append(observation)
+            flush_hash_cache()
 
+            try:
+                response = self.__store_blobs__(observationList)
+                if 'error' not in response:
+                    response = send_synclist(self.user, observationList, file_loc)
+            except requests.RequestException as e:
+                response = {'error': str(e)}
 
-class Monitor:
-    def __init__(self, user):
-        self.user = user
-        self.watcher = Watcher(self.user)
-        self.config = None
-        self.db = None
-        self.knps_version = get_version()
+            if 'error' in response:
+                print('ERROR: {}. Will retry on the next sync.'.format(response['error']))
+                self.user.addTodoList(chunk)
+                uploaded = False
+                continue
 
-        self.dirs = self.user.get_dirs()
+            print("Observed and uploaded", len(observationList), "items.")
+            self.__record_processed__(observationList)
+            manifest.mark_uploaded([(f, info['file_size'], info['mtime_ns'], file_hash)
+                                    for f, file_hash, file_type, line_hashes, optionalItems, info in observationList
+                                    if not info.get('retry')])
 
-        self.proc_cache = {}
+        manifest.close()
+        return uploaded
 
-    def __get_process__(self, procname, threadid, filename):
-        proc_key = f'{procname}.{threadid}'
-        if proc_key not in self.proc_cache:
-            for proc in psutil.process_iter():
-                try:
-                    pinfo = proc.as_dict(attrs=['pid', 'name', 'cmdline', 'open_files'])
-                    # if pinfo['open_files'] != None:
-                    #     print(pinfo)
-                    if pinfo['name'] == procname and pinfo['open_files'] != None:
-                        for f in pinfo['open_files']:
-                            if filename in f.path:
-                                self.proc_cache[proc_key] = pinfo
-                        # self.proc_cache[proc_key] = pinfo
-                except psutil.NoSuchProcess:
-                    pass
+    #
+    # Work through the TODO list with syncFiles() (used by the sync daemon,
+    # which otherwise only gets to it at startup). Stops at the first chunk
+    # that can't be uploaded, which goes back on the list.
+    #
+    def syncTodoLists(self, executor=None, file_loc=None):
+        for k, todoList in list(self.user.getTodoLists()):
+            self.user.removeTodoList(k)
+            if not self.syncFiles(todoList, executor, file_loc):
+                break
 
-            if proc_key not in self.proc_cache:
-                return None
-        else:
-            return self.proc_cache[proc_key]
+    def forgetFiles(self, files):
+        manifest = self.__get_manifest__()
+        manifest.remove(files)
+        manifest.close()
 
+    #
+    # The server rejected the upload of these (path, file_hash) entries:
+    # forget they were uploaded and put them on the TODO list, so the next
+    # sync (or the daemon's next pass over the list) observes them again
+    #
+    def requeueFiles(self, entries):
+        self.forgetFiles([f for f, file_hash in entries])
+        self.user.addTodoList([f for f, file_hash in entries])
+        if CACHE_FILE_PROCESSING:
+            self.__get_processed__().forget(entries)
 
-    def run(self):
-        cmd = ['sudo', 'nice', 'fs_usage', '-f filesys', '-w', '-e', 'mds', 'fseventsd', 'mdworker_shared']
-        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        dir_regex = r'{}'.format('|'.join([x.lstrip('/') for x in self.dirs]))
+    def __get_manifest__(self):
+        return SyncManifest(Path(Path.home(), MANIFEST_FILE), self.user.username, self.user.get_server())
 
-        blacklist = ['stat64', 'filecoordinationd', 'getattrlist', 'fsgetpath', 'getxattr', 'fsctl', 'statfs64']
-        blacklist_regex = r'{}'.format('|'.join(blacklist))
+    def __stat_files__(self, file_list):
+        for f in file_list:
+            try:
+                with profile_stage('stat'):
+                    stats = os.stat(f)
+            except OSError:
+                continue
+            yield f, stats
 
-        procs = {}
+    def __stat_entries__(self, entries):
+        for f, entry in entries:
+            try:
+                with profile_stage('stat'):
+                    stats = entry.stat()
+            except OSError:
+                continue
+            yield f, stats
 
-        for line in proc.stdout:
-            dt = datetime.now()
+    #
+    # Compare (path, stats) pairs against the sync manifest and yield only
+    # the files that are new or changed since their last upload. Hashes of
+    # unchanged files are filled into file_hashes from the manifest. With
+    # find_deleted, files that have disappeared are dropped from the
+    # manifest.
+    #
+    def __changed_files__(self, file_list, file_hashes, full=False, find_deleted=True):
+        manifest = self.__get_manifest__()
+        counts = {'new': 0, 'changed': 0, 'unchanged': 0}
+
+        if find_deleted:
+            manifest.begin_scan()
+
+        for f, stats in file_list:
+            if find_deleted:
+                manifest.mark_seen(f)
+
+            with profile_stage('manifest'):
+                status, entry = manifest.classify(f, stats)
+            counts[status] += 1
+            if status == 'unchanged' and not full:
+                file_hashes[f] = entry['file_hash']
+            else:
+                yield f
+
+        deleted = manifest.end_scan() if find_deleted else 0
+        manifest.close()
+
+        print("Found {} new, {} changed, {} unchanged and {} deleted files.".format(
+            counts['new'], counts['changed'], counts['unchanged'], deleted))
+        if full:
+            print("Full resync: observing all {} files.".format(sum(counts.values())))
+
+    #
+    # Observe every file in a TODO chunk, yielding (file, observation, error)
+    # in chunk order. With an executor the files are observed in parallel
+    # worker processes.
+    #
+    def __observe_chunk__(self, todoChunk, executor=None):
+        store = self.__store_inline__()
+        if executor is None:
+            for f in todoChunk:
+                try:
+                    yield f, observe_file(f, store), None
+                except Exception as e:
+                    yield f, None, str(e)
+        else:
+            profile = SYNC_PROFILE is not None
+            for f, observation, error, timings in executor.map(observe_file_worker, todoChunk,
+                                                               itertools.repeat(store), itertools.repeat(profile)):
+                if timings is not None:
+                    SYNC_PROFILE.merge(timings)
+                yield f, observation, error
+
+    #
+    # This is where we collect observation data. See observe_file().
+    #
+    def _observeFile_(self, f):
+        return observe_file(f, self.__store_inline__())
 
-            for key, p in procs.items():
-                if 'last_update' in p and 'synced' not in p and len(p['outputs']) > 0:
+    #
+    # With --store, file contents go to the server as content-addressed
+    # blobs if it supports them, or else inline in the observation.
+    #
+    def __store_blobs__(self, observationList):
+        if self.user.get_store() and get_server_capabilities(self.user).get('blobs'):
+            return upload_blobs(self.user, observationList)
+        return {}
 
-                    diff = dt - p['last_update']
-                    if diff.seconds >= PROCESS_SYNC_AGE_SECONDS:
-                        print(f'Syncing {p["name"]}')
-                        procs[key]['synced'] = True
+    def __store_inline__(self):
+        return self.user.get_store() and not get_server_capabilities(self.user).get('blobs')
 
-                        self.watcher.observeAndSync(process=p)
 
+#
+# The processes a monitor has seen touch watched files, and how. Recording
+# a file is just a dict update; files are stat'ed and hashed on the
+# tracker's own thread when the process is synced, which happens
+# PROCESS_SYNC_AGE_SECONDS after its last new file, or as soon as it
+# exits.
+#
+# A file's mode is 'read', 'write' (known to have been written), 'writable'
+# (opened for writing: an output only if it changed while the process ran)
+# or None (unknown: an output if it changed, otherwise an input). A file
+# seen more than once keeps the strongest of its modes.
+#
+MODE_RANK = {'read': 0, None: 1, 'writable': 2, 'write': 3}
 
+class ProcessTracker:
+    def __init__(self, user, watcher):
+        self.user = user
+        self.watcher = watcher
+        self.lock = threading.Lock()
+        self.procs = {}
+        self.stopped = threading.Event()
+
+    def file_opened(self, key, name, path, mode, pid='', cmdline=None, timestamp=None):
+        dt = datetime.now()
+        with self.lock:
+            p = self.procs.get(key)
+            if p is None:
+                p = self.procs[key] = {'name': name,
+                                       'key': key,
+                                       'timestamp': timestamp or dt,
+                                       'cmdline': [],
+                                       'pid': '',
+                                       'files': {},
+                                       'exited': False}
+            if pid:
+                p['pid'] = pid
+            if cmdline:
+                p['cmdline'] = cmdline
+
+            if path not in p['files'] or MODE_RANK[mode] > MODE_RANK[p['files'][path]]:
+                p['files'][path] = mode
+                p['last_update'] = dt
+                p.pop('synced', None) # Need to sync again
+
+    def process_exited(self, key):
+        with self.lock:
+            if key in self.procs:
+                self.procs[key]['exited'] = True
+
+    def keys(self):
+        with self.lock:
+            return list(self.procs)
 
-            line = line.rstrip().decode()
-            if re.search(blacklist_regex, line):
+    #
+    # Hash the files a process touched and build the record that
+    # observeAndSync() expects.
+    #
+    def __make_process__(self, p):
+        process = {'name': p['name'],
+                   'key': p['key'],
+                   'timestamp': p['timestamp'],
+                   'inputs': set([]),
+                   'outputs': set([]),
+                   'accesses': set([]),
+                   'input_files': set([]),
+                   'output_files': set([]),
+                   'access_files': set([]),
+                   'cmdline': p['cmdline'],
+                   'pid': p['pid'],
+                   'file_data': {}}
+
+        for path, mode in p['files'].items():
+            if os.path.isdir(path):
                 continue
+            file_data = get_file_data(path)
+            if not file_data:
+                continue
+            file_hash = file_data['file_hash']
+            process['file_data'][file_hash] = file_data
+
+            modified = file_data['modified'] >= p['timestamp'].timestamp()
+            if mode == 'write' or (modified and mode in (None, 'writable')):
+                process['outputs'].add(file_hash)
+                process['output_files'].add(path)
+            elif mode == 'writable':
+                process['accesses'].add(file_hash)
+                process['access_files'].add(path)
+            else:
+                process['inputs'].add(file_hash)
+                process['input_files'].add(path)
+        return process
+
+    def __may_have_outputs__(self, p):
+        return any(MODE_RANK[mode] > MODE_RANK['read'] for mode in p['files'].values())
+
+    def sync_ready(self):
+        dt = datetime.now()
+        with self.lock:
+            ready = [p for p in self.procs.values()
+                     if 'synced' not in p and self.__may_have_outputs__(p)
+                     and (p['exited'] or (dt - p['last_update']).seconds >= PROCESS_SYNC_AGE_SECONDS)]
+            for p in ready:
+                p['synced'] = True
+
+            # Forget processes that are gone (or long idle) with nothing left to sync
+            for key, p in list(self.procs.items()):
+                idle = (dt - p['last_update']).seconds >= PROCESS_FORGET_SECONDS
+                if (p['exited'] or idle) and ('synced' in p or not self.__may_have_outputs__(p)):
+                    del self.procs[key]
+
+        for p in ready:
+            process = self.__make_process__(p)
+            if process['outputs']:
+                print(f'Syncing {p["name"]}')
+                self.watcher.observeAndSync(process=process)
+
+    def __run__(self):
+        while not self.stopped.wait(1):
+            self.sync_ready()
+
+    def start(self):
+        threading.Thread(target=self.__run__, daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
 
-            match = re.search(dir_regex, line)
-            if match:
-                line_breakdown = line.split(maxsplit = 6)
-                if any(substring in line_breakdown[-1] for substring in ["Sublime Text", "bird", "quicklookd"]):
-                    continue
+#
+# Process provenance on macOS, from `fs_usage`. Lines are parsed by
+# knps.fs_usage.FsUsageParser and each event is a cheap update to a
+# ProcessTracker, which does the hashing and syncing on its own thread.
+#
+class Monitor:
+    def __init__(self, user):
+        self.user = user
+        self.watcher = Watcher(self.user)
+        self.config = None
+        self.db = None
+        self.knps_version = get_version()
 
-                # print(line_breakdown)
-
-                data = re.split(r'\s+', line)
-                timestamp = data[0]
-                action = data[1]
-                process_name, thread_id = data[-1].rsplit('.', 1)
-                proc_key = f'{process_name}.{thread_id}'
-                pathname = [x for x in data if re.search(dir_regex, x)]
-                if len(pathname):
-                    pathname = pathname[0]
-                    path_obj = Path(pathname)
-
-                    if (os.path.isdir(pathname) or
-                        path_obj.name.startswith('~$') or
-                        path_obj.name.endswith('.swp$')):
-                        continue
-                else:
-                    pathname = None
-                    continue
+        self.dirs = self.user.get_dirs()
 
-                open_type = None
-
-                if action == 'open' or action == 'access':
-                    open_flags = [x for x in data if re.search(r'^\(.+\)$', x)]
-                    if len(open_flags):
-                        open_flags = open_flags[0]
-                        if open_flags[2] == 'W':
-                            open_type = 'write'
-                        elif open_flags[1] == 'R':
-                            open_type = 'read'
-
-
-                if proc_key not in procs:
-                    procs[proc_key] = {'name': process_name,
-                                        'key': proc_key,
-                                        'timestamp': dt,
-                                        'inputs': set([]),
-                                        'outputs': set([]),
-                                        'accesses': set([]),
-                                        'input_files': set([]),
-                                        'output_files': set([]),
-                                        'access_files': set([]),
-                                        'cmdline': [],
-                                        'pid': '',
-                                        'file_data': {}}
-
-
-                proc = self.__get_process__(process_name, thread_id, pathname)
-
-                if proc:
-                    procs[proc_key]['cmdline'] = proc['cmdline']
-                    procs[proc_key]['pid'] = proc['pid']
-                    procs[proc_key]['last_update'] = dt
-
-                # see if the 'accessed' files were modified, if so, they're outputs
-                modified_flag = False
-                try:
-                    last_modified = Path(pathname).stat().st_mtime
-                    if last_modified >= procs[proc_key]['timestamp'].timestamp():
-                        modified_flag = True
-                except:
-                    pass
+        from knps.proc_cache import ProcessInfoCache
+        self.proc_cache = ProcessInfoCache()
+        self.parser = FsUsageParser(self.dirs)
+        self.tracker = ProcessTracker(self.user, self.watcher)
 
-                # print(proc_key, action, open_type, pathname not in procs[proc_key]['outputs'])
+    def __get_process__(self, procname, threadid, filename):
+        return self.proc_cache.lookup(procname, threadid, filename)
 
-                file_data = get_file_data(pathname)
+    def __handle_line__(self, line, lookup=True):
+        event = self.parser.parse(line)
+        if event is None:
+            return None
 
-                if not file_data:
-                    continue
-                file_hash = file_data['file_hash']
-
-                procs[proc_key]['file_data'][file_hash] = file_data
-
-                if ('WrData' in action or open_type == 'write' or (modified_flag and not ('RdData' in action or open_type == 'read'))):
-                    procs[proc_key]['outputs'].add(file_hash)
-                    procs[proc_key]['output_files'].add(file_data['file_name'])
-                    procs[proc_key]['last_update'] = dt
-                    procs[proc_key].pop('synced', None) # Need to sync again
-                elif ('RdData' in action or open_type == 'read' or not modified_flag):
-                    procs[proc_key]['inputs'].add(file_hash)
-                    procs[proc_key]['input_files'].add(file_data['file_name'])
-                    procs[proc_key]['last_update'] = dt
-                    procs[proc_key].pop('synced', None) # Need to sync again
-                elif pathname not in procs[proc_key]['accesses'] and file_hash not in procs[proc_key]['inputs'] and file_hash not in procs[proc_key]['outputs']:
-                    procs[proc_key]['accesses'].add(file_hash)
-                    procs[proc_key]['access_files'].add(file_data['file_name'])
-                    procs[proc_key]['last_update'] = dt
-                    procs[proc_key].pop('synced', None) # Need to sync again
-
-
-                # print(f'{timestamp} - {action} - {pathname} - {process_name} - Thread: {thread_id}')
-                # print(line)
-                print(json.dumps(procs, indent=2, default=str))
+        proc_key = f'{event.process_name}.{event.thread_id}'
+        proc = self.__get_process__(event.process_name, event.thread_id, event.path) if lookup else None
+        if proc:
+            self.tracker.file_opened(proc_key, event.process_name, event.path, event_mode(event),
+                                     pid=proc['pid'], cmdline=proc['cmdline'])
+        else:
+            self.tracker.file_opened(proc_key, event.process_name, event.path, event_mode(event))
+        return event
+
+    def run(self, record=None):
+        cmd = ['sudo', 'nice', 'fs_usage', '-f filesys', '-w', '-e', 'mds', 'fseventsd', 'mdworker_shared']
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        recorder = TraceRecorder(record) if record else None
+
+        self.proc_cache.start()
+        self.tracker.start()
+
+        try:
+            for line in proc.stdout:
+                line = line.rstrip().decode(errors='replace')
+                if recorder:
+                    recorder.write(line)
+                self.__handle_line__(line)
+        except KeyboardInterrupt:
+            print("Done")
+        finally:
+            if recorder:
+                recorder.close()
+
+    #
+    # Run a trace recorded with --record through the parser and tracker as
+    # fast as possible, without process lookups or syncing, and report the
+    # throughput.
+    #
+    def replay(self, trace):
+        lines, events, seconds = replay(trace, lambda line: self.__handle_line__(line, lookup=False))
+        print("Replayed {} lines, {} events in {:.2f}s".format(lines, events, seconds))
+        print("   {:.0f} lines/s, {:.0f} events/s".format(lines / seconds if seconds else 0, events / seconds if seconds else 0))
+        print("   {} processes tracked".format(len(self.tracker.keys())))
 
 EVENT_TAGS = {('moved', True): 'DIR_MOVED',
               ('moved', False): 'FILE_MOVED',
@@ -967,7 +2296,26 @@ EVENT_TAGS = {('moved', True): 'DIR_MOVED',
               ('modified', False): 'FILE_MODIFIED',
 }
 
-class KNPSLoggingEventHandler(FileSystemEventHandler):
+#
+# Watch dirs recursively, passing every event to handler.on_any_event()
+# on the observer's thread. watchdog is imported here rather than at the
+# top, so only the commands that watch the file system load it.
+#
+def start_observer(dirs, handler):
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+
+    class EventHandler(FileSystemEventHandler):
+        def on_any_event(self, event):
+            handler.on_any_event(event)
+
+    observer = Observer()
+    for path in dirs:
+        observer.schedule(EventHandler(), path, recursive=True)
+    observer.start()
+    return observer
+
+class KNPSLoggingEventHandler:
     """Logs all the events captured."""
 
     def __init__(self, metadata):
@@ -1012,15 +2360,9 @@ class FileMonitor:
                          'knps_version': self.knps_version,
                          'knps_source': 'FileMonitor'}
 
-        self.observer = Observer()
-
     def run(self):
-        path = '/Users/mike/tmp/mrander_data'
         event_handler = KNPSLoggingEventHandler(self.metadata)
-        observer = Observer()
-        observer.schedule(event_handler, path, recursive=True)
-
-        observer.start()
+        observer = start_observer(self.dirs, event_handler)
         try:
             while True:
                 time.sleep(1)
@@ -1028,6 +2370,117 @@ class FileMonitor:
             observer.stop()
         observer.join()
 
+class SyncEventHandler:
+    """Hands file events to a SyncDaemon without doing any work itself."""
+
+    def __init__(self, daemon):
+        self.daemon = daemon
+
+    def on_any_event(self, event):
+        if event.is_directory or event.event_type not in SYNC_EVENT_TYPES:
+            return
+
+        if event.event_type == 'moved':
+            self.daemon.file_deleted(event.src_path)
+            self.daemon.file_changed(event.dest_path)
+        elif event.event_type == 'deleted':
+            self.daemon.file_deleted(event.src_path)
+        else:
+            self.daemon.file_changed(event.src_path)
+
+#
+# Continuous incremental sync. Events for each path are coalesced until
+# the file has been quiet for DAEMON_DEBOUNCE_SECONDS, so a large write
+# that fires dozens of events is observed once, after it finishes. Ready
+# files then go through the normal observe (on the --jobs worker pool)
+# and upload path.
+#
+class SyncDaemon:
+    def __init__(self, user, jobs=1):
+        self.user = user
+        self.watcher = Watcher(self.user)
+        self.jobs = jobs
+
+        self.dirs = self.user.get_dirs()
+
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.deleted = set()
+
+    def file_changed(self, path):
+        if not self.user.is_watched(path):
+            return
+        with self.lock:
+            self.pending[path] = time.monotonic()
+            self.deleted.discard(path)
+
+    def file_deleted(self, path):
+        with self.lock:
+            self.pending.pop(path, None)
+            self.deleted.add(path)
+
+    #
+    # Take the files that have had no events for DAEMON_DEBOUNCE_SECONDS and
+    # whose mtime is at least that old too (some writers don't generate
+    # events for every write).
+    #
+    def __take_ready__(self):
+        now = time.monotonic()
+        with self.lock:
+            ready = [path for path, last_event in self.pending.items() if now - last_event >= DAEMON_DEBOUNCE_SECONDS]
+            for path in ready:
+                del self.pending[path]
+            deleted = self.deleted
+            self.deleted = set()
+
+        quiescent = []
+        for path in ready:
+            try:
+                modified = os.stat(path).st_mtime
+            except OSError:
+                continue
+            if time.time() - modified < DAEMON_DEBOUNCE_SECONDS:
+                with self.lock:
+                    self.pending.setdefault(path, now)
+            else:
+                quiescent.append(path)
+
+        return quiescent, deleted
+
+    def run(self):
+        # Catch up on anything that changed while we weren't running
+        self.watcher.observeAndSync(jobs=self.jobs)
+
+        executor = make_process_pool(self.jobs) if self.jobs > 1 else None
+        replayer = SpoolReplayer(self.user) if USE_SPOOL else None
+        if replayer:
+            replayer.start()
+        observer = start_observer(self.dirs, SyncEventHandler(self))
+        print("Watching {} directories for changes...".format(len(self.dirs)))
+
+        try:
+            todo_due = time.monotonic() + DAEMON_TODO_SECONDS
+            while True:
+                time.sleep(DAEMON_POLL_SECONDS)
+                ready, deleted = self.__take_ready__()
+                if deleted:
+                    self.watcher.forgetFiles(deleted)
+                if ready:
+                    self.watcher.syncFiles(ready, executor)
+
+                # Chunks that failed above, or that the spool replayer
+                # requeued after the server rejected them
+                if time.monotonic() >= todo_due:
+                    self.watcher.syncTodoLists(executor)
+                    todo_due = time.monotonic() + DAEMON_TODO_SECONDS
+        except KeyboardInterrupt:
+            observer.stop()
+        observer.join()
+        if executor:
+            executor.shutdown()
+        if replayer:
+            replayer.stop()
+
 class ProcessMonitor:
     def __init__(self, user):
         self.user = user
@@ -1042,48 +2495,152 @@ class ProcessMonitor:
                          'knps_version': self.knps_version,
                          'knps_source': 'ProcessMonitor'}
 
-        self.observer = Observer()
-
     def __make_process_key__(self, p):
         return f"{p['pid']}_{p['create_time']}"
 
 
+    def __report__(self, pinfo, open_files):
+        pinfo['open_files'] = sorted(open_files)
+        pinfo['timestamp'] = datetime.now().astimezone().isoformat()
+        pinfo['action'] = 'PROCESS_OBSERVED'
+        print(json.dumps(self.metadata | pinfo, indent=2))
+        print('---')
+
+    #
+    # Print a record whenever a process's set of open watched files
+    # changes. On Linux this uses the same /proc collector as --monitor,
+    # which only reads the fd tables of processes that have run since the
+    # last scan; elsewhere it polls psutil every PROC_LOGGER_POLL_SECONDS.
+    #
     def run(self):
-        path = '/Users/mike/tmp/mrander_data'
+        try:
+            if sys.platform.startswith('linux'):
+                self.__run_procfs__()
+            else:
+                self.__run_psutil__()
+        except KeyboardInterrupt:
+            print("Done")
 
+    def __run_procfs__(self):
+        scanner = ProcScanner(self.dirs)
+        while True:
+            events, exited = scanner.scan()
+            changed = {key: name for key, name, path, mode in events}
+            for (pid, start_time), name in changed.items():
+                self.__report__({'pid': pid, 'name': name, 'cmdline': read_cmdline(pid),
+                                 'create_time': start_timestamp(start_time)},
+                                scanner.open_files.get((pid, start_time), {}))
+            time.sleep(scanner.interval)
+
+    def __run_psutil__(self):
+        import psutil
+
+        prefixes = tuple(os.path.join(os.path.abspath(d), '') for d in self.dirs)
         processes = {}
+        while True:
+            # Forget processes that have exited
+            current = {}
+            for proc in psutil.process_iter():
+                try:
+                    pinfo = proc.as_dict(attrs=['pid', 'name', 'cmdline', 'open_files', 'create_time'])
+                except psutil.NoSuchProcess:
+                    continue
+                if not pinfo['open_files']:
+                    continue
+
+                open_files = {f.path for f in pinfo['open_files'] if f.path.startswith(prefixes)}
+                key = self.__make_process_key__(pinfo)
+                if open_files and processes.get(key) != open_files:
+                    self.__report__(pinfo, open_files)
+                current[key] = open_files
+            processes = current
+            time.sleep(PROC_LOGGER_POLL_SECONDS)
+
+#
+# Process provenance on Linux. Which processes have which watched files
+# open comes from fanotify when running as root, and otherwise from
+# polling /proc (see knps.procfs). Files are only hashed when a process is
+# synced, PROCESS_SYNC_AGE_SECONDS after its last new file, or when it
+# exits. The records are the same ones Monitor builds from fs_usage.
+#
+class LinuxProcessMonitor:
+    def __init__(self, user, use_fanotify=None):
+        self.user = user
+        self.watcher = Watcher(self.user)
+        self.dirs = self.user.get_dirs()
+
+        if use_fanotify is None:
+            from knps import fanotify
+            use_fanotify = fanotify.available()
+        self.use_fanotify = use_fanotify
+
+        self.scanner = ProcScanner(self.dirs)
+        self.tracker = ProcessTracker(self.user, self.watcher)
+
+    def __file_opened__(self, key, name, path, mode):
+        if not self.user.is_watched(path):
+            return
+
+        pid, start_time = key
+        self.tracker.file_opened('{}_{}'.format(pid, start_time), name, path, mode,
+                                 pid=pid, cmdline=read_cmdline(pid),
+                                 timestamp=datetime.fromtimestamp(start_timestamp(start_time)))
 
+    #
+    # The close that says a file was written often comes as the process
+    # exits, when /proc/<pid> may already be gone, so remember who each pid
+    # was from its earlier opens.
+    #
+    def __watch_fanotify__(self, notifier):
+        pids = {}
+        for pid, path, mode in notifier.events():
+            stat = read_stat(pid)
+            if stat is not None:
+                name, start_time, cpu_ticks = stat
+                pids[pid] = (name, start_time)
+            elif pid not in pids:
+                continue
+            name, start_time = pids[pid]
+            self.__file_opened__((pid, start_time), name, path, mode)
+
+            if len(pids) > FANOTIFY_PID_CACHE_SIZE:
+                pids = {pid: v for pid, v in pids.items() if read_stat(pid) is not None}
+
+    def run(self):
+        if self.use_fanotify:
+            from knps import fanotify
+            notifier = fanotify.Fanotify(self.dirs)
+            threading.Thread(target=self.__watch_fanotify__, args=(notifier,), daemon=True).start()
+            print("Watching file opens with fanotify")
+        else:
+            print("Watching processes by polling /proc")
+        self.tracker.start()
+
+        last_report = time.monotonic()
         try:
             while True:
-                # time.sleep(1)
-
-                for proc in psutil.process_iter():
-                    try:
-                        pinfo = proc.as_dict(attrs=['pid', 'name', 'cmdline', 'open_files', 'create_time'])
-
-                        if pinfo['open_files'] != None:
-                            open_files = pinfo['open_files']
-                            key = self.__make_process_key__(pinfo)
-                            if not processes.get(key, None) == open_files:
-                                processes[key] = open_files
-                                for f in open_files:
-                                    if path in f.path:
-                                        pinfo['open_files'] = [x.path for x in open_files]
-                                        pinfo['timestamp'] = datetime.now().astimezone().isoformat()
-                                        pinfo['action'] = 'PROCESS_OBSERVED'
-                                        print(json.dumps(self.metadata | pinfo, indent=2))
-                                        print('---')
-                                        break
-
-                    except psutil.NoSuchProcess:
-                        pass
-
+                if self.use_fanotify:
+                    time.sleep(1)
+                    for key in self.tracker.keys():
+                        pid, start_time = [int(x) for x in key.split('_')]
+                        stat = read_stat(pid)
+                        if stat is None or stat[1] != start_time:
+                            self.tracker.process_exited(key)
+                else:
+                    events, exited = self.scanner.scan()
+                    for key, name, path, mode in events:
+                        self.__file_opened__(key, name, path, mode)
+                    for pid, start_time in exited:
+                        self.tracker.process_exited('{}_{}'.format(pid, start_time))
+                    time.sleep(self.scanner.interval)
+
+                if not self.use_fanotify and time.monotonic() - last_report >= PROCESS_MONITOR_REPORT_SECONDS:
+                    last_report = time.monotonic()
+                    print("Collector CPU: {:.2f}% ({} scans, {} fd table reads, interval {:.2f}s)".format(
+                        100 * self.scanner.overhead(), self.scanner.scans, self.scanner.fd_reads, self.scanner.interval))
         except KeyboardInterrupt:
             print("Done")
 
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
-
 class CustomHttpHandler(logging.Handler):
     def __init__(self, url: str, token: str, silent: bool = True):
         '''
@@ -1094,6 +2651,10 @@ class CustomHttpHandler(logging.Handler):
             silent (bool): If False the http response and logs will be sent
                            to STDOUT for debug
         '''
+        import requests
+        from requests.adapters import HTTPAdapter
+        from requests.packages.urllib3.util.retry import Retry
+
         self.url = url
         self.token = token
         self.silent = silent
@@ -1133,11 +2694,142 @@ class CustomHttpHandler(logging.Handler):
             print(logEntry)
             print(response.content)
 
+class AsyncHttpHandler(CustomHttpHandler):
+    def __init__(self, url: str, token: str, silent: bool = True):
+        '''
+        Like CustomHttpHandler, but records are put on a bounded queue and
+        sent by a background thread, several to a request, so logging never
+        waits on the network. Whatever is queued is sent when the program
+        exits. If the server has no batch endpoint the thread sends records
+        one at a time instead.
+        Parameters:
+            url (str): The URL that the logs will be sent to
+            token (str): The Authorization token being used
+            silent (bool): If False a line per request is printed for debug
+        '''
+        super().__init__(url, token, silent)
+
+        self.queue = collections.deque()
+        self.counts = {'sent': 0, 'dropped': 0, 'failed': 0, 'requests': 0}
+        self.stopping = threading.Event()
+        # Wakes the sender when a batch starts or fills, or on close()
+        self.ready = threading.Condition(self.lock)
+        self.closed = False
+
+        self.thread = threading.Thread(target=self.__run__, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    #
+    # Queue a record, already serialized to a JSON string, so later changes
+    # to the caller's objects don't change what is sent.
+    #
+    def enqueue(self, entry):
+        with self.lock:
+            if len(self.queue) >= LOG_QUEUE_SIZE:
+                self.counts['dropped'] += 1
+                return False
+            self.queue.append(entry)
+            if len(self.queue) in (1, LOG_BATCH_RECORDS):
+                self.ready.notify()
+            return True
+
+    def emit(self, record):
+        self.enqueue(self.format(record))
+
+    # The counts are updated from the callers' threads and the sender's
+    def __count__(self, name, n=1):
+        with self.lock:
+            self.counts[name] += n
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts, queued=len(self.queue))
+
+    def __next_batch__(self):
+        batch = []
+        size = 0
+        while self.queue and len(batch) < LOG_BATCH_RECORDS and size < LOG_BATCH_BYTES:
+            entry = self.queue.popleft()
+            batch.append(entry)
+            size += len(entry)
+        return batch
+
+    def __send__(self, batch):
+        import requests
+
+        base_url = self.url.rsplit('/', 1)[0]
+        capabilities = get_capabilities(base_url)
+
+        try:
+            if capabilities.get('log_batch'):
+                body = '[' + ', '.join(batch) + ']'
+                headers = {}
+                encoding = choose_encoding(capabilities.get('encodings', []), PAYLOAD_ENCODING)
+                if encoding:
+                    out = io.BytesIO()
+                    writer = open_compressed_writer(out, encoding)
+                    writer.write(body.encode())
+                    writer.close()
+                    body = out.getvalue()
+                    headers['Content-Encoding'] = encoding
+                responses = [self.session.post(self.url + '/batch', data=body, headers=headers)]
+            else:
+                responses = [self.session.post(self.url, data=entry) for entry in batch]
+        except requests.RequestException as e:
+            self.__count__('failed', len(batch))
+            if not self.silent:
+                print('Log delivery failed: {}'.format(e))
+            return
+
+        self.__count__('requests', len(responses))
+        if all(r.status_code < 400 for r in responses):
+            self.__count__('sent', len(batch))
+        else:
+            self.__count__('failed', len(batch))
+        if not self.silent:
+            print('Sent {} log records in {} requests: {}'.format(len(batch), len(responses), responses[-1].status_code))
+
+    def __run__(self):
+        while True:
+            with self.ready:
+                while not self.queue and not self.stopping.is_set():
+                    self.ready.wait()
+
+                # Let a batch fill up unless it's full already (or we're exiting)
+                deadline = time.monotonic() + LOG_BATCH_SECONDS
+                while not self.stopping.is_set() and len(self.queue) < LOG_BATCH_RECORDS:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.ready.wait(remaining)
+
+                stopping = self.stopping.is_set()
+                batch = self.__next_batch__()
+
+            if batch:
+                self.__send__(batch)
+            elif stopping:
+                return
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            with self.ready:
+                self.stopping.set()
+                self.ready.notify()
+            self.thread.join(LOG_FLUSH_TIMEOUT)
+            with self.lock:
+                self.counts['dropped'] += len(self.queue)
+                self.queue.clear()
+        super().close()
+
 class LogMessage:
     def __init__(self, user):
         self.user = user
         self.knps_version = get_version()
 
+        import uuid
         self.uuid = str(uuid.uuid4())
         self.install_id = user.get_install_id()
 
@@ -1213,7 +2905,7 @@ class LogMessage:
         self.data['extra'] = extra
 
 class Logger:
-    def __init__(self, user, token, use_dev=False):
+    def __init__(self, user, token, use_dev=False, asynchronous=LOG_ASYNC):
         self.user = user
         self.token = token
 
@@ -1236,11 +2928,17 @@ class Logger:
             self.log_server = KNPS_SERVER_PROD
 
         # create a custom http logger handler
-        httpHandler = CustomHttpHandler(
+        handler_class = AsyncHttpHandler if asynchronous else CustomHttpHandler
+        httpHandler = handler_class(
             url=f'http://{self.log_server}/log',
             token=self.token,
             silent=False
         )
+        self.handler = httpHandler
+        self.async_handler = httpHandler if asynchronous else None
+        self.log_fields = {'username': getattr(self.user, 'username', None),
+                           'knps_version': self.knps_version,
+                           'knps_source': 'LoggerAPI'}
 
         httpHandler.setLevel(logging.INFO)
 
@@ -1251,6 +2949,8 @@ class Logger:
         self.logger.addHandler(httpHandler)
 
     def get_token(self):
+        import requests
+
         if self.user:
             response = requests.post(f'http://{self.log_server}/get_log_token', data={'username': self.user.username})
             obj_data = response.json()
@@ -1258,6 +2958,21 @@ class Logger:
         return 'No token available'
 
     def log(self, message):
+        # Async delivery: the payload is serialized here, so errors are
+        # raised to the caller, and the handler's thread sends it
+        if self.async_handler is not None:
+            send_time = datetime.now().astimezone().isoformat()
+            try:
+                if type(message) == LogMessage:
+                    data = dict(message.data, metadata=dict(message.data['metadata'], send_time=send_time))
+                else:
+                    data = {'send_time': send_time} | self.log_fields | message
+                json_msg = json.dumps(data)
+            except TypeError:
+                raise TypeError('KNPS Logger payload must be a dict or LogMessage object.')
+            self.async_handler.enqueue(json_msg)
+            return
+
         try:
             if type(message) == LogMessage:
                 message.data['metadata']['send_time'] = datetime.now().astimezone().isoformat()
@@ -1276,9 +2991,45 @@ class Logger:
     def start_message(self):
         return LogMessage(self.user)
 
+    #
+    # Delivery counters (sent, dropped, failed, requests, queued) when
+    # records are sent asynchronously.
+    #
+    def delivery_stats(self):
+        if self.async_handler is not None:
+            return self.async_handler.stats()
+        return None
+
 #
 # main()
 #
+#
+# Run a sync, with --profile and --cprofile if they were given
+#
+def profile_sync(sync, profile_file=None, top=20, cprofile_file=None):
+    global SYNC_PROFILE
+    if profile_file:
+        SYNC_PROFILE = SyncProfile(top)
+    profiler = None
+    if cprofile_file:
+        import cProfile
+        profiler = cProfile.Profile()
+
+    try:
+        if profiler:
+            profiler.enable()
+        sync()
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(cprofile_file)
+            print("cProfile stats written to {}".format(cprofile_file))
+        if SYNC_PROFILE is not None:
+            SYNC_PROFILE.report()
+            SYNC_PROFILE.write(profile_file)
+            print("Sync profile written to {}".format(profile_file))
+            SYNC_PROFILE = None
+
 def main():
     # execute only if run as a script
     parser = argparse.ArgumentParser(description='KNPS command line')
@@ -1291,13 +3042,23 @@ def main():
     parser.add_argument("--comment", nargs="+", help="Add a comment to a data object")
     parser.add_argument("--addDataset", help="Add a Dataset to the graph. Takes a YAML file")
     parser.add_argument("--sync", action="store_true", help="Sync observations to service")
+    parser.add_argument("--full", action="store_true", help="With --sync, observe every watched file, not just the ones changed since the last sync")
+    parser.add_argument("--jobs", type=int, default=1, help="Number of worker processes used to observe files during --sync")
+    parser.add_argument("--profile", help="With --sync, write per-stage timings, bytes read, counts per file type and the slowest files to this JSON file")
+    parser.add_argument("--profile_top", type=int, default=20, help="With --profile, how many of the slowest files to list")
+    parser.add_argument("--cprofile", help="With --sync, also write cProfile stats for the main thread to this file (for snakeviz, flameprof or pstats)")
     parser.add_argument("--server", help="Set KNPS server. Options: dev, prod, or address:port")
+    parser.add_argument("--daemon", action="store_true", help="Keep running and sync watched files as they change")
     parser.add_argument("--monitor", action="store_true", help="Run KNPS as a process and file system monitor.")
+    parser.add_argument("--record", help="With --monitor on macOS, also save the raw fs_usage trace to this file")
+    parser.add_argument("--replay", help="Replay an fs_usage trace saved with --record and report parser throughput")
     parser.add_argument("--proc_logger", action="store_true", help="Run KNPS as a process and file system monitor.")
     parser.add_argument("--file_logger", action="store_true", help="Run KNPS as a process and file system monitor.")
     parser.add_argument("--log", action="store_true", help="Run KNPS as a process and file system monitor.")
     parser.add_argument("--store", help="Upload bytes in addition to metadata. Options: True or False (default)")
     parser.add_argument("--version", action="store_true", help="Display version information")
+    parser.add_argument("--cache", choices=["stats", "clear"], help="Show statistics for, or clear, the local hash cache")
+    parser.add_argument("--spool", choices=["status", "flush"], help="Show what is waiting in the upload spool, or send it now")
     parser.add_argument("--get_token", action="store_true", help="Get token for logging API")
     parser.add_argument("--get_dev_token", action="store_true", help="Get token for logging API (dev server)")
     parser.add_argument('args', type=str, help="KNPS command arguments", nargs='*' )
@@ -1346,8 +3107,10 @@ def main():
             print("Upload bytes? {}".format(u.get_store()))
             print()
             dirs = u.get_dirs()
-            files = u.get_files()
-            print("You have {} top-level directories and {} files watched by knps.".format(len(dirs), len(files)))
+            print("You have {} top-level directories and {} files watched by knps.".format(len(dirs), u.count_files()))
+            todoChunks, todoFiles = u.getTodoCounts()
+            if todoChunks:
+                print("{} files in {} chunks are waiting to be synced.".format(todoFiles, todoChunks))
 
             if 'dirs' in args.status:
                 print("\nWatched directories:")
@@ -1356,7 +3119,7 @@ def main():
 
             if 'files' in args.status:
                 print("\nWatched files:")
-                for d in files:
+                for d, entry in u.iter_files():
                     print("   {}".format(d))
 
         if 'dirs' in args.status or 'files' in args.status:
@@ -1367,7 +3130,8 @@ def main():
         if not u.username:
             print("Not logged in.")
         else:
-            Watcher(u).observeAndSync()
+            profile_sync(lambda: Watcher(u).observeAndSync(jobs=args.jobs, full=args.full),
+                         args.profile, args.profile_top, args.cprofile)
             # thread = threading.Thread(target = observeAndSyncThread, args = (Watcher(u), __file__))
             # thread.start()
 
@@ -1383,12 +3147,57 @@ def main():
     elif args.version:
         print(f'KNPS Version: {get_version()}')
 
+    elif args.cache:
+        cache = HashCache(Path(Path.home(), HASH_CACHE_FILE))
+        if args.cache == 'clear':
+            cache.clear()
+            print("Cleared the hash cache at {}".format(cache.path))
+        else:
+            stats = cache.stats()
+            print("Hash cache: {}".format(stats['path']))
+            print("   Version:   {}".format(stats['version']))
+            print("   Entries:   {}".format(stats['entries']))
+            print("   By hash:   {}".format(stats['content_entries']))
+            print("   Hits:      {}".format(stats['hits']))
+            print("   Misses:    {}".format(stats['misses']))
+            print("   Disk size: {:.1f} MB".format(stats['disk_bytes'] / (1000 * 1000)))
+        cache.close()
+
+    elif args.spool:
+        if not u.username:
+            print("Not logged in; please run: knps --login")
+        elif args.spool == 'flush':
+            replayer = SpoolReplayer(u)
+            if replayer.drain():
+                print("Spool flushed: {} payloads sent, {} rejected.".format(replayer.sent, replayer.rejected))
+            else:
+                records, size = u.get_spool().pending()
+                print("Sent {} payloads; {} ({:.1f} MB) still spooled.".format(replayer.sent, records, size / (1000 * 1000)))
+        else:
+            spool = u.get_spool()
+            records, size = spool.pending()
+            print("Upload spool: {}".format(spool.dir))
+            print("   Pending:   {} payloads, {:.1f} MB".format(records, size / (1000 * 1000)))
+            print("   Disk size: {:.1f} MB of {} MB".format(spool.size() / (1000 * 1000), SPOOL_MAX_MB))
+
+    elif args.daemon:
+        if not u.username:
+            print("Not logged in; please run: knps --login")
+        else:
+            SyncDaemon(u, jobs=args.jobs).run()
+
     elif args.monitor:
         if not u.username:
             print("Not logged in; please run: knps --login")
+        elif sys.platform.startswith('linux'):
+            m = LinuxProcessMonitor(u)
+            m.run()
         else:
             m = Monitor(u)
-            m.run()
+            m.run(record=args.record)
+    elif args.replay:
+        m = Monitor(u)
+        m.replay(args.replay)
     elif args.get_token:
         if not u.username:
             print("Not logged in; please run: knps --login")
@@ -0,0 +1,90 @@
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+#
+# The sync manifest records, per user and server, the size, mtime and hash
+# of every file as of its last successful upload. A sync only needs to
+# observe files whose size or mtime differ from the manifest, so unchanged
+# files are skipped without being read at all.
+#
+class SyncManifest:
+    def __init__(self, path, username, server):
+        self.path = Path(path)
+        self.username = username
+        self.server = server
+        self.lock = threading.RLock()
+
+        self.conn = sqlite3.connect(str(self.path), timeout=60, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS manifest ('
+                              'username TEXT, server TEXT, path TEXT, size INTEGER, mtime_ns INTEGER, '
+                              'file_hash TEXT, last_uploaded REAL, '
+                              'PRIMARY KEY (username, server, path))')
+
+    def lookup(self, path):
+        with self.lock:
+            row = self.conn.execute('SELECT size, mtime_ns, file_hash, last_uploaded FROM manifest '
+                                    'WHERE username = ? AND server = ? AND path = ?',
+                                    (self.username, self.server, str(path))).fetchone()
+        if row is None:
+            return None
+        return {'size': row[0], 'mtime_ns': row[1], 'file_hash': row[2], 'last_uploaded': row[3]}
+
+    #
+    # Returns 'new', 'changed' or 'unchanged' for a file with these stats.
+    #
+    def classify(self, path, stats):
+        entry = self.lookup(path)
+        if entry is None:
+            return 'new', None
+        if entry['size'] != stats.st_size or entry['mtime_ns'] != stats.st_mtime_ns:
+            return 'changed', entry
+        return 'unchanged', entry
+
+    #
+    # Record that files were uploaded. Each entry is (path, size, mtime_ns,
+    # file_hash).
+    #
+    def mark_uploaded(self, entries):
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO manifest '
+                                  '(username, server, path, size, mtime_ns, file_hash, last_uploaded) '
+                                  'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                  [(self.username, self.server, str(path), size, mtime_ns, file_hash, now)
+                                   for path, size, mtime_ns, file_hash in entries])
+
+    def remove(self, paths):
+        with self.lock, self.conn:
+            self.conn.executemany('DELETE FROM manifest WHERE username = ? AND server = ? AND path = ?',
+                                  [(self.username, self.server, str(path)) for path in paths])
+
+    #
+    # Deleted-file detection: call begin_scan(), mark_seen() every file that
+    # still exists, then end_scan() to drop (and count) everything else.
+    #
+    def begin_scan(self):
+        with self.lock:
+            self.conn.execute('CREATE TEMP TABLE IF NOT EXISTS seen (path TEXT PRIMARY KEY)')
+            self.conn.execute('DELETE FROM seen')
+
+    def mark_seen(self, path):
+        with self.lock:
+            self.conn.execute('INSERT OR IGNORE INTO seen (path) VALUES (?)', (str(path),))
+
+    def end_scan(self):
+        with self.lock, self.conn:
+            deleted = self.conn.execute('DELETE FROM manifest WHERE username = ? AND server = ? '
+                                        'AND path NOT IN (SELECT path FROM seen)',
+                                        (self.username, self.server)).rowcount
+            self.conn.execute('DELETE FROM seen')
+        return deleted
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
@@ -0,0 +1,131 @@
+import gzip
+import io
+import json
+import os
+import tempfile
+import uuid
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Compressed payloads larger than this are spooled to a temporary file
+SPOOL_MAX_MEMORY = 8 * 1024 * 1024
+
+#
+# Content encodings this client can produce, most preferred first.
+#
+def supported_encodings():
+    encodings = ['gzip']
+    if zstandard is not None:
+        encodings.insert(0, 'zstd')
+    return encodings
+
+#
+# Pick the best encoding both sides support, or None to send the payload
+# uncompressed (the original format).
+#
+def choose_encoding(server_encodings, preferred='auto'):
+    if preferred == 'identity':
+        return None
+
+    candidates = supported_encodings()
+    if preferred != 'auto':
+        candidates = [x for x in candidates if x == preferred]
+
+    for encoding in candidates:
+        if encoding in server_encodings:
+            return encoding
+    return None
+
+def open_compressed_writer(fileobj, encoding):
+    if encoding == 'gzip':
+        return gzip.GzipFile(fileobj=fileobj, mode='wb', compresslevel=6, mtime=0)
+    elif encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=3).stream_writer(fileobj, closefd=False)
+    raise ValueError("Unsupported payload encoding: {}".format(encoding))
+
+#
+# Serialize items as a JSON array straight into a compressor (or, with no
+# encoding, a temporary file), one item at a time, so the uncompressed
+# document never exists in memory. Once decompressed the bytes are
+# identical to json.dumps(list(items)).
+#
+# Returns a file object positioned at the start of the encoded data.
+#
+def write_json_array(items, encoding):
+    out = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+    writer = open_compressed_writer(out, encoding) if encoding else out
+
+    writer.write(b'[')
+    for i, item in enumerate(items):
+        if i:
+            writer.write(b', ')
+        writer.write(json.dumps(item).encode())
+    writer.write(b']')
+    if writer is not out:
+        writer.close()
+
+    out.seek(0)
+    return out
+
+#
+# A multipart/form-data body that is read from as it is sent, so a large
+# payload is never copied into memory the way requests' files= does.
+# fields are sent first as plain form fields, then fileobj (or bytes) as
+# the file part called name; the bytes are the same as requests builds.
+# len() is the size of the whole body, so requests sends a Content-Length
+# rather than chunking it.
+#
+class MultipartStream:
+    def __init__(self, fields, name, filename, fileobj, content_type=None, boundary=None):
+        self.boundary = boundary or uuid.uuid4().hex
+        if isinstance(fileobj, bytes):
+            fileobj = io.BytesIO(fileobj)
+
+        head = b''
+        for key, value in fields.items():
+            head += self.__part_header__('name="{}"'.format(key)) + str(value).encode() + b'\r\n'
+        head += self.__part_header__('name="{}"; filename="{}"'.format(name, filename), content_type)
+        tail = '\r\n--{}--\r\n'.format(self.boundary).encode()
+
+        start = fileobj.tell()
+        size = fileobj.seek(0, os.SEEK_END) - start
+        fileobj.seek(start)
+
+        self.parts = [io.BytesIO(head), fileobj, io.BytesIO(tail)]
+        self.length = len(head) + size + len(tail)
+
+    def __part_header__(self, disposition, content_type=None):
+        header = '--{}\r\nContent-Disposition: form-data; {}\r\n'.format(self.boundary, disposition)
+        if content_type:
+            header += 'Content-Type: {}\r\n'.format(content_type)
+        return (header + '\r\n').encode()
+
+    @property
+    def content_type(self):
+        return 'multipart/form-data; boundary={}'.format(self.boundary)
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        data = b''
+        while self.parts and (size < 0 or len(data) < size):
+            block = self.parts[0].read(-1 if size < 0 else size - len(data))
+            if not block:
+                self.parts.pop(0)
+            data += block
+        return data
+
+def decode_payload(data, encoding):
+    if encoding in (None, '', 'identity'):
+        return data
+    elif encoding == 'gzip':
+        return gzip.decompress(data)
+    elif encoding == 'zstd':
+        if zstandard is None:
+            raise ValueError("zstd payload received but the zstandard module is not installed")
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    raise ValueError("Unsupported payload encoding: {}".format(encoding))
@@ -0,0 +1,239 @@
+import atexit
+import hashlib
+import json
+import os
+import select
+import subprocess
+import sys
+import threading
+import time
+
+#
+# PDF text extraction, kept out of the syncing process. PyPDF2 is slow and
+# some PDFs make it spin or balloon, so pages are extracted by a small pool
+# of long-lived worker processes (python -m knps.pdf_extract --worker),
+# each with an address-space limit. A file gets a wall-clock budget; if it
+# runs out, or a worker dies, the workers involved are killed and the
+# file gets no line hashes instead of holding up the sync.
+#
+# With more than one worker, large PDFs are split into ranges of
+# PAGES_PER_TASK pages extracted in parallel. The first range also
+# reports the page count, so small PDFs take a single round trip.
+#
+PAGES_PER_TASK = 50
+
+#
+# transient is True when the file may well succeed on another try: it ran
+# out of time or memory, or a worker died. Otherwise the PDF itself
+# couldn't be parsed.
+#
+class PdfExtractError(Exception):
+    def __init__(self, message, transient=False):
+        super().__init__(message)
+        self.transient = transient
+
+#
+# In the worker: line hashes for pages [start, end) of a PDF (end None
+# for all of them). Returns (pages in the document, hashes). The last
+# document opened is kept open, since the next request is usually for
+# the next range of the same file.
+#
+class PageExtractor:
+    def __init__(self):
+        self.key = None
+        self.f = None
+        self.reader = None
+
+    def __open__(self, path):
+        import PyPDF2
+
+        stats = os.stat(path)
+        key = (path, stats.st_dev, stats.st_ino, stats.st_size, stats.st_mtime_ns)
+        if key != self.key:
+            self.close()
+            self.f = open(path, 'rb')
+            self.reader = PyPDF2.PdfFileReader(self.f, strict=False)
+            self.key = key
+        return self.reader
+
+    def line_hashes(self, path, start, end):
+        import PyPDF2
+
+        reader = self.__open__(path)
+        pages = reader.getNumPages()
+        hashes = []
+        try:
+            for pageNumber in range(start, pages if end is None else min(end, pages)):
+                for line in reader.getPage(pageNumber).extractText().splitlines():
+                    hashes.append(hashlib.md5(line.strip().encode()).hexdigest())
+        except PyPDF2.utils.PdfReadError as e:
+            # PyPDF2 has trouble with some PDFs; keep what we got
+            print("Problem hashing PDF lines: ", e, file=sys.stderr)
+        return pages, hashes
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+        self.key = self.f = self.reader = None
+
+class Worker:
+    def __init__(self, memory_mb):
+        self.proc = subprocess.Popen([sys.executable, '-m', 'knps.pdf_extract', '--worker', str(memory_mb)],
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=0)
+        self.stdout = self.proc.stdout
+
+    #
+    # Send one request and wait up to timeout seconds for the reply,
+    # {'pages': ..., 'hashes': [...]} or {'error': ...}.
+    #
+    def request(self, path, start, end, timeout):
+        self.proc.stdin.write(json.dumps({'path': path, 'start': start, 'end': end}).encode() + b'\n')
+        self.proc.stdin.flush()
+
+        line = b''
+        deadline = time.monotonic() + timeout
+        while not line.endswith(b'\n'):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([self.stdout], [], [], remaining)[0]:
+                raise PdfExtractError('timed out', transient=True)
+            data = os.read(self.stdout.fileno(), 1024 * 1024)
+            if not data:
+                raise PdfExtractError('worker exited ({})'.format(self.proc.wait()), transient=True)
+            line += data
+
+        return json.loads(line)
+
+    def kill(self):
+        self.proc.kill()
+        self.proc.wait()
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.proc.wait(1)
+        except subprocess.TimeoutExpired:
+            self.kill()
+
+class PdfExtractor:
+    def __init__(self, workers, timeout, memory_mb):
+        self.max_workers = max(1, workers)
+        self.timeout = timeout
+        self.memory_mb = memory_mb
+        self.idle = []
+        self.started = 0
+        self.available = threading.Condition()
+        self.pid = os.getpid()
+        atexit.register(self.close)
+
+    def __take__(self):
+        with self.available:
+            while not self.idle and self.started >= self.max_workers:
+                self.available.wait()
+            if self.idle:
+                return self.idle.pop()
+            self.started += 1
+
+        try:
+            return Worker(self.memory_mb)
+        except OSError:
+            self.__discard__(None)
+            raise
+
+    def __give__(self, worker):
+        with self.available:
+            self.idle.append(worker)
+            self.available.notify()
+
+    def __discard__(self, worker):
+        if worker is not None:
+            worker.kill()
+        with self.available:
+            self.started -= 1
+            self.available.notify()
+
+    def __run__(self, path, start, end, deadline):
+        worker = self.__take__()
+        try:
+            reply = worker.request(path, start, end, deadline - time.monotonic())
+        except PdfExtractError:
+            self.__discard__(worker)
+            raise
+        except (OSError, ValueError) as e:
+            self.__discard__(worker)
+            raise PdfExtractError(str(e), transient=True)
+
+        # A worker that ran out of memory exits after replying
+        out_of_memory = reply.get('error') == 'out of memory'
+        if out_of_memory:
+            self.__discard__(worker)
+        else:
+            self.__give__(worker)
+        if 'error' in reply:
+            raise PdfExtractError(reply['error'], transient=out_of_memory)
+        return reply['pages'], reply['hashes']
+
+    #
+    # Line hashes for every page of path. Raises PdfExtractError if the
+    # file can't be done within the budget.
+    #
+    def line_hashes(self, path):
+        deadline = time.monotonic() + self.timeout
+        if self.max_workers == 1:
+            return self.__run__(path, 0, None, deadline)[1]
+
+        pages, hashes = self.__run__(path, 0, PAGES_PER_TASK, deadline)
+        if pages <= PAGES_PER_TASK:
+            return hashes
+
+        from concurrent.futures import ThreadPoolExecutor
+        ranges = range(PAGES_PER_TASK, pages, PAGES_PER_TASK)
+        with ThreadPoolExecutor(self.max_workers) as executor:
+            results = list(executor.map(lambda start: self.__run__(path, start, start + PAGES_PER_TASK, deadline), ranges))
+        for pages, more in results:
+            hashes.extend(more)
+        return hashes
+
+    def close(self):
+        if os.getpid() != self.pid:
+            return
+        with self.available:
+            idle, self.idle = self.idle, []
+        for worker in idle:
+            worker.close()
+
+def worker_main(memory_mb):
+    try:
+        import resource
+        limit = memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, resource.getrlimit(resource.RLIMIT_AS)[1]))
+    except (ImportError, ValueError, OSError):
+        pass
+
+    # Replies go to the real stdout; anything PyPDF2 prints goes to stderr
+    out = sys.stdout.buffer
+    sys.stdout = sys.stderr
+    extractor = PageExtractor()
+    for line in sys.stdin.buffer:
+        request = json.loads(line)
+        try:
+            pages, hashes = extractor.line_hashes(request['path'], request['start'], request['end'])
+            reply = {'pages': pages, 'hashes': hashes}
+        except MemoryError:
+            out.write(json.dumps({'error': 'out of memory'}).encode() + b'\n')
+            out.flush()
+            return
+        except Exception as e:
+            extractor.close()
+            reply = {'error': '{}: {}'.format(type(e).__name__, e)}
+        out.write(json.dumps(reply).encode() + b'\n')
+        out.flush()
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == '--worker':
+        worker_main(int(sys.argv[2]))
+    else:
+        print("usage: python -m knps.pdf_extract --worker <memory MB>", file=sys.stderr)
+        sys.exit(2)
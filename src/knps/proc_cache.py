@@ -0,0 +1,142 @@
+import threading
+import time
+
+import psutil
+
+# How often the background refresher re-lists processes, in seconds
+REFRESH_SECONDS = 2
+
+# Lifetime of a cached lookup result, and of a cached miss
+POSITIVE_TTL = 60
+NEGATIVE_TTL = 5
+
+# Lifetime of a process's cached open file list
+OPEN_FILES_TTL = 1
+
+#
+# Process lookups for the fs_usage monitor. A background thread keeps an
+# index of running processes by name and pid, which is cheap to build
+# because it doesn't ask for open files. A lookup only fetches the open
+# files of the few processes that have the right name, and both hits and
+# misses are cached per (name, thread), so handling an event doesn't
+# depend on how many processes the host is running.
+#
+class ProcessInfoCache:
+    def __init__(self, refresh_seconds=REFRESH_SECONDS):
+        self.refresh_seconds = refresh_seconds
+        self.lock = threading.Lock()
+
+        # pid -> {'pid', 'name', 'cmdline', 'create_time'}
+        self.by_pid = {}
+        # name -> set of pids
+        self.by_name = {}
+        # pid -> (fetched, [paths])
+        self.open_files = {}
+        # proc_key -> (expires, name, pinfo or None)
+        self.lookups = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+        self.refresher = None
+
+    def start(self):
+        self.refresh()
+        self.refresher = threading.Thread(target=self.__run__, daemon=True)
+        self.refresher.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.wake.set()
+
+    def __run__(self):
+        while not self.stopped.is_set():
+            self.wake.wait(self.refresh_seconds)
+            self.wake.clear()
+            if not self.stopped.is_set():
+                self.refresh()
+
+    #
+    # Rebuild the name/pid index and drop anything cached for processes
+    # that have exited (or whose pid has been reused).
+    #
+    def refresh(self):
+        by_pid = {}
+        by_name = {}
+        for proc in psutil.process_iter(['pid', 'name', 'cmdline', 'create_time']):
+            pinfo = proc.info
+            by_pid[pinfo['pid']] = pinfo
+            by_name.setdefault(pinfo['name'], set()).add(pinfo['pid'])
+
+        now = time.monotonic()
+        with self.lock:
+            old = self.by_pid
+            old_names = self.by_name
+            self.by_pid = by_pid
+            self.by_name = by_name
+            for pid in list(self.open_files):
+                if pid not in by_pid or old.get(pid, {}).get('create_time') != by_pid[pid]['create_time']:
+                    del self.open_files[pid]
+            for key, (expires, name, pinfo) in list(self.lookups.items()):
+                if expires < now:
+                    del self.lookups[key]
+                elif pinfo is None and name in by_name and name not in old_names:
+                    # Missed because the process hadn't been listed yet
+                    del self.lookups[key]
+                elif pinfo is not None and by_pid.get(pinfo['pid'], {}).get('create_time') != pinfo['create_time']:
+                    del self.lookups[key]
+            self.refreshes += 1
+
+    def __open_files__(self, pid, now):
+        cached = self.open_files.get(pid)
+        if cached is not None and now - cached[0] < OPEN_FILES_TTL:
+            return cached[1]
+        try:
+            paths = [f.path for f in psutil.Process(pid).open_files()]
+        except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
+            paths = []
+        self.open_files[pid] = (now, paths)
+        return paths
+
+    #
+    # Find the process called procname that has filename open. Returns a
+    # dict with pid, name, cmdline and open_files, or None.
+    #
+    def lookup(self, procname, threadid, filename):
+        proc_key = f'{procname}.{threadid}'
+        now = time.monotonic()
+
+        with self.lock:
+            cached = self.lookups.get(proc_key)
+            if cached is not None and cached[0] >= now:
+                self.hits += 1
+                return cached[2]
+            self.misses += 1
+
+            result = None
+            pids = self.by_name.get(procname, ())
+            for pid in pids:
+                paths = self.__open_files__(pid, now)
+                if any(filename in path for path in paths):
+                    result = dict(self.by_pid[pid], open_files=paths)
+                    break
+
+            ttl = POSITIVE_TTL if result is not None else NEGATIVE_TTL
+            self.lookups[proc_key] = (now + ttl, procname, result)
+
+        # A process we've never heard of probably started since the last
+        # refresh; get the refresher to pick it up early
+        if not pids:
+            self.wake.set()
+        return result
+
+    def stats(self):
+        with self.lock:
+            return {'processes': len(self.by_pid),
+                    'cached_lookups': len(self.lookups),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'refreshes': self.refreshes}
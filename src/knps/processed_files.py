@@ -0,0 +1,153 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+#
+# Schema migrations, applied in order. PRAGMA user_version records how
+# many have been applied, so a store written by an older knps is upgraded
+# in place instead of being thrown away. Only ever append to this list.
+#
+MIGRATIONS = [
+    # 1: one row per (user and server, file hash, path), indexed by hash
+    # and by path. The user and server are stored once in scopes, and MD5
+    # hashes as 16 raw bytes.
+    [
+        'CREATE TABLE scopes (id INTEGER PRIMARY KEY, username TEXT, server TEXT, UNIQUE (username, server))',
+        'CREATE TABLE processed (scope INTEGER, file_hash BLOB, path TEXT, recorded REAL, '
+        'PRIMARY KEY (scope, file_hash, path)) WITHOUT ROWID',
+        'CREATE INDEX processed_path ON processed (scope, path)',
+    ],
+]
+
+# Rows written per transaction when importing the old JSON store
+IMPORT_BATCH = 10000
+
+def pack_hash(file_hash):
+    try:
+        return bytes.fromhex(file_hash) if len(file_hash) == 32 else file_hash
+    except ValueError:
+        return file_hash
+
+def unpack_hash(value):
+    return value.hex() if isinstance(value, bytes) else value
+
+#
+# The files a user has uploaded to a server, by file hash and path. This
+# replaces the ~/.knps_dir_db JSON file, which had to be read into memory
+# whole and rewritten after every chunk. Here each chunk is one small
+# transaction and lookups go through an index, so memory use doesn't
+# grow with the number of files. The JSON file, if there is one, is
+# imported the first time the store is opened and renamed to
+# <name>.migrated.
+#
+class ProcessedFiles:
+    def __init__(self, path, username, server, legacy_path=None):
+        self.path = Path(path)
+        self.lock = threading.RLock()
+
+        self.conn = sqlite3.connect(str(self.path), timeout=60, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.__migrate__()
+        if legacy_path is not None and Path(legacy_path).exists():
+            self.__import_json__(Path(legacy_path))
+        self.scope = self.__scope__(username, server)
+
+    def __migrate__(self):
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+                for version, statements in enumerate(MIGRATIONS[version:], version + 1):
+                    for statement in statements:
+                        self.conn.execute(statement)
+                    self.conn.execute('PRAGMA user_version = {}'.format(version))
+                self.conn.commit()
+            except BaseException:
+                self.conn.rollback()
+                raise
+
+    def __scope__(self, username, server):
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR IGNORE INTO scopes (username, server) VALUES (?, ?)', (username, server))
+            return self.conn.execute('SELECT id FROM scopes WHERE username = ? AND server = ?',
+                                     (username, server)).fetchone()[0]
+
+    #
+    # Import {user: {server: {file_hash: {path: 1}}}} from the old JSON
+    # store. Entries already here are left alone, so it is safe if two
+    # processes do this at once.
+    #
+    def __import_json__(self, legacy_path):
+        try:
+            with open(legacy_path) as f:
+                db = json.load(f)
+        except (OSError, ValueError) as e:
+            print("Not importing {}: {}".format(legacy_path, e))
+            return
+
+        now = time.time()
+        rows = []
+        for username, servers in db.items():
+            if username.startswith('__') or not isinstance(servers, dict):
+                continue
+            for server, hashes in servers.items():
+                scope = self.__scope__(username, server)
+                for file_hash, paths in hashes.items():
+                    for path in paths:
+                        rows.append((scope, pack_hash(file_hash), path, now))
+                        if len(rows) >= IMPORT_BATCH:
+                            self.__insert__(rows, 'IGNORE')
+                            rows = []
+        self.__insert__(rows, 'IGNORE')
+
+        try:
+            os.replace(legacy_path, legacy_path.with_name(legacy_path.name + '.migrated'))
+        except FileNotFoundError:
+            pass
+
+    def __insert__(self, rows, conflict='REPLACE'):
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT OR {} INTO processed (scope, file_hash, path, recorded) '
+                                  'VALUES (?, ?, ?, ?)'.format(conflict), rows)
+
+    #
+    # Record that files were uploaded. entries are (path, file_hash).
+    #
+    def record(self, entries):
+        now = time.time()
+        self.__insert__([(self.scope, pack_hash(file_hash), str(path), now) for path, file_hash in entries])
+
+    def forget(self, entries):
+        with self.lock, self.conn:
+            self.conn.executemany('DELETE FROM processed WHERE scope = ? AND file_hash = ? AND path = ?',
+                                  [(self.scope, pack_hash(file_hash), str(path)) for path, file_hash in entries])
+
+    def contains(self, path, file_hash):
+        with self.lock:
+            return self.conn.execute('SELECT 1 FROM processed WHERE scope = ? AND file_hash = ? AND path = ?',
+                                     (self.scope, pack_hash(file_hash), str(path))).fetchone() is not None
+
+    def paths_for_hash(self, file_hash):
+        with self.lock:
+            rows = self.conn.execute('SELECT path FROM processed WHERE scope = ? AND file_hash = ?',
+                                     (self.scope, pack_hash(file_hash))).fetchall()
+        return [row[0] for row in rows]
+
+    def hashes_for_path(self, path):
+        with self.lock:
+            rows = self.conn.execute('SELECT file_hash FROM processed WHERE scope = ? AND path = ?',
+                                     (self.scope, str(path))).fetchall()
+        return [unpack_hash(row[0]) for row in rows]
+
+    def count(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM processed WHERE scope = ?', (self.scope,)).fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
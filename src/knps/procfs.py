@@ -0,0 +1,192 @@
+import os
+import time
+
+PROC = '/proc'
+
+# Polling interval bounds, in seconds. The interval drops to the minimum
+# whenever a scan finds new file activity and backs off when nothing does.
+MIN_INTERVAL = 0.25
+MAX_INTERVAL = 2.0
+BACKOFF = 1.5
+
+# Fraction of one core the scanner may use; slow scans stretch the interval
+CPU_BUDGET = 0.01
+
+# Every so often re-read the fds of every process, not just busy ones: a
+# process can open a file in less than a clock tick of CPU time.
+FULL_REFRESH_SECONDS = 10
+
+O_ACCMODE = 0o3
+O_WRONLY = 0o1
+O_RDWR = 0o2
+
+#
+# Returns (comm, start_time, cpu_ticks) from /proc/<pid>/stat, or None if
+# the process has gone away.
+#
+def read_stat(pid):
+    try:
+        with open('{}/{}/stat'.format(PROC, pid), 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+
+    # comm is in parentheses and may itself contain spaces or parentheses
+    close = data.rfind(b')')
+    comm = data[data.find(b'(') + 1:close].decode(errors='replace')
+    fields = data[close + 2:].split()
+    return comm, int(fields[19]), int(fields[11]) + int(fields[12])
+
+_boot_time = None
+
+#
+# Convert a start_time from read_stat() (clock ticks since boot) to a Unix
+# timestamp.
+#
+def start_timestamp(start_time):
+    global _boot_time
+    if _boot_time is None:
+        with open('{}/stat'.format(PROC), 'rt') as f:
+            for line in f:
+                if line.startswith('btime'):
+                    _boot_time = int(line.split()[1])
+    return _boot_time + start_time / os.sysconf('SC_CLK_TCK')
+
+def read_cmdline(pid):
+    try:
+        with open('{}/{}/cmdline'.format(PROC, pid), 'rb') as f:
+            return [x.decode(errors='replace') for x in f.read().split(b'\0') if x]
+    except OSError:
+        return []
+
+#
+# 'read' or 'writable' for an open fd, from the flags in /proc/<pid>/fdinfo.
+#
+def fd_mode(pid, fd):
+    try:
+        with open('{}/{}/fdinfo/{}'.format(PROC, pid, fd), 'rt') as f:
+            for line in f:
+                if line.startswith('flags:'):
+                    flags = int(line.split()[1], 8)
+                    return 'read' if flags & O_ACCMODE not in (O_WRONLY, O_RDWR) else 'writable'
+    except (OSError, ValueError):
+        pass
+    return 'read'
+
+#
+# Tracks which processes have files under the watched directories open.
+# Each scan lists /proc and reads one small stat file per process; the fd
+# table is only read for processes that are new or have used CPU since the
+# last scan, since an idle process can't have opened anything.
+#
+class ProcScanner:
+    def __init__(self, dirs):
+        self.prefixes = tuple(os.path.join(os.path.abspath(d), '') for d in dirs)
+        self.self_pid = os.getpid()
+
+        # pid -> (start_time, cpu_ticks) as of the last scan
+        self.seen = {}
+        # (pid, start_time) -> {path: mode} for processes with watched files open
+        self.open_files = {}
+        # Processes whose fds we aren't allowed to read
+        self.unreadable = set()
+
+        self.interval = MIN_INTERVAL
+        self.last_full_refresh = 0
+
+        self.scans = 0
+        self.fd_reads = 0
+        self.cpu_time = 0.0
+        self.started = time.monotonic()
+
+    def __watched__(self, path):
+        return path.startswith(self.prefixes)
+
+    def __read_fds__(self, pid):
+        self.fd_reads += 1
+        files = {}
+        fd_dir = '{}/{}/fd'.format(PROC, pid)
+        with os.scandir(fd_dir) as it:
+            for entry in it:
+                try:
+                    path = os.readlink(entry.path)
+                except OSError:
+                    continue
+                if self.__watched__(path):
+                    files[path] = fd_mode(pid, entry.name)
+        return files
+
+    #
+    # Scan once. Returns (events, exited): events is a list of
+    # (key, comm, path, mode) for files a process has newly opened, exited
+    # the keys of processes that had watched files open and are now gone.
+    #
+    def scan(self):
+        start_cpu = time.process_time()
+        now = time.monotonic()
+        full = now - self.last_full_refresh >= FULL_REFRESH_SECONDS
+        if full:
+            self.last_full_refresh = now
+
+        events = []
+        current = {}
+        with os.scandir(PROC) as it:
+            for entry in it:
+                if not entry.name.isdigit():
+                    continue
+                pid = int(entry.name)
+                if pid == self.self_pid:
+                    continue
+
+                stat = read_stat(pid)
+                if stat is None:
+                    continue
+                comm, start_time, cpu_ticks = stat
+                current[pid] = (start_time, cpu_ticks)
+
+                key = (pid, start_time)
+                if key in self.unreadable or (not full and self.seen.get(pid) == (start_time, cpu_ticks)):
+                    continue
+
+                try:
+                    files = self.__read_fds__(pid)
+                except PermissionError:
+                    self.unreadable.add(key)
+                    continue
+                except OSError:
+                    continue
+
+                if not files:
+                    continue
+                known = self.open_files.setdefault(key, {})
+                for path, mode in files.items():
+                    # Once a process has had a file open for writing, it stays that way
+                    previous = known.get(path)
+                    if previous is None or (previous == 'read' and mode == 'writable'):
+                        known[path] = mode
+                        events.append((key, comm, path, mode))
+
+        exited = [key for key in self.open_files if current.get(key[0], (None,))[0] != key[1]]
+        for key in exited:
+            del self.open_files[key]
+        self.unreadable = {key for key in self.unreadable if current.get(key[0], (None,))[0] == key[1]}
+        self.seen = current
+
+        cost = time.process_time() - start_cpu
+        self.scans += 1
+        self.cpu_time += cost
+
+        if events:
+            self.interval = MIN_INTERVAL
+        else:
+            self.interval = min(MAX_INTERVAL, self.interval * BACKOFF)
+        self.interval = max(self.interval, cost / CPU_BUDGET)
+
+        return events, exited
+
+    #
+    # CPU used by scanning as a fraction of wall-clock time since start.
+    #
+    def overhead(self):
+        elapsed = time.monotonic() - self.started
+        return self.cpu_time / elapsed if elapsed > 0 else 0.0
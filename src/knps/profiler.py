@@ -0,0 +1,165 @@
+import heapq
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+#
+# Opt-in instrumentation for --sync (knps --sync --profile FILE). Code
+# marks the work it does with stage(name); each stage's wall and CPU time
+# are accumulated, exclusive of any stage nested inside it, so the stage
+# times don't double count and "decode" means decoding alone, not decoding
+# plus the reads and MD5 updates it triggered. CPU time is per thread.
+#
+# Stages run on several threads at once (observation, upload, spool
+# replay), so stage times can add up to more than the sync's wall time.
+#
+# Per file, the profile keeps counts and bytes by file type and the
+# slowest files observed. --jobs workers profile each file separately and
+# send the numbers back to be merged.
+#
+class SyncProfile:
+    def __init__(self, top=20):
+        self.top = top
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started = time.perf_counter()
+        self.cpu_started = time.process_time()
+        self.stages = {}
+        self.counters = {}
+        self.types = {}
+        self.slowest = []
+
+    @contextmanager
+    def stage(self, name):
+        stack = self.local.__dict__.setdefault('stack', [])
+        # [name, wall start, cpu start, nested wall, nested cpu]
+        frame = [name, time.perf_counter(), time.thread_time(), 0.0, 0.0]
+        stack.append(frame)
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - frame[1]
+            cpu = time.thread_time() - frame[2]
+            stack.pop()
+            if stack:
+                stack[-1][3] += wall
+                stack[-1][4] += cpu
+            self.__add_stage__(name, 1, wall - frame[3], cpu - frame[4])
+
+    #
+    # Iterate over iterable, counting the time spent producing each item
+    # as the stage name.
+    #
+    def iter_stage(self, name, iterable):
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    #
+    # Wrap a function so each call counts as the stage name
+    #
+    def timed(self, name, function):
+        def call(*args):
+            with self.stage(name):
+                return function(*args)
+        return call
+
+    def __add_stage__(self, name, calls, wall, cpu):
+        with self.lock:
+            totals = self.stages.setdefault(name, [0, 0.0, 0.0])
+            totals[0] += calls
+            totals[1] += wall
+            totals[2] += cpu
+
+    #
+    # Count bytes read from observed files. The count is also kept per
+    # thread, so file_done() can be given a file's share.
+    #
+    def add_read(self, nbytes):
+        self.local.bytes_read = self.thread_bytes_read() + nbytes
+        with self.lock:
+            self.counters['bytes_read'] = self.counters.get('bytes_read', 0) + nbytes
+
+    def thread_bytes_read(self):
+        return getattr(self.local, 'bytes_read', 0)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def file_done(self, path, file_type, size, seconds, bytes_read):
+        with self.lock:
+            totals = self.types.setdefault(file_type, [0, 0, 0.0])
+            totals[0] += 1
+            totals[1] += size
+            totals[2] += seconds
+            self.counters['files'] = self.counters.get('files', 0) + 1
+
+            entry = (seconds, path, file_type, size, bytes_read)
+            if len(self.slowest) < self.top:
+                heapq.heappush(self.slowest, entry)
+            elif entry > self.slowest[0]:
+                heapq.heapreplace(self.slowest, entry)
+
+    #
+    # The raw numbers, to send from a worker process to be merged
+    #
+    def export(self):
+        with self.lock:
+            return {'stages': self.stages, 'counters': self.counters, 'types': self.types, 'slowest': self.slowest}
+
+    def merge(self, data):
+        for name, (calls, wall, cpu) in data['stages'].items():
+            self.__add_stage__(name, calls, wall, cpu)
+        with self.lock:
+            for name, n in data['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + n
+            for file_type, (files, size, seconds) in data['types'].items():
+                totals = self.types.setdefault(file_type, [0, 0, 0.0])
+                totals[0] += files
+                totals[1] += size
+                totals[2] += seconds
+            for entry in data['slowest']:
+                entry = tuple(entry)
+                if len(self.slowest) < self.top:
+                    heapq.heappush(self.slowest, entry)
+                elif entry > self.slowest[0]:
+                    heapq.heapreplace(self.slowest, entry)
+
+    def summary(self):
+        with self.lock:
+            return {
+                'wall_seconds': time.perf_counter() - self.started,
+                'cpu_seconds': time.process_time() - self.cpu_started,
+                'stages': {name: {'calls': calls, 'wall_seconds': wall, 'cpu_seconds': cpu}
+                           for name, (calls, wall, cpu) in sorted(self.stages.items(), key=lambda s: -s[1][1])},
+                'counters': dict(self.counters),
+                'file_types': {file_type: {'files': files, 'bytes': size, 'seconds': seconds}
+                               for file_type, (files, size, seconds) in sorted(self.types.items(), key=lambda t: -t[1][2])},
+                'slowest_files': [{'path': path, 'file_type': file_type, 'seconds': seconds,
+                                   'bytes': size, 'bytes_read': bytes_read}
+                                  for seconds, path, file_type, size, bytes_read in sorted(self.slowest, reverse=True)],
+            }
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def report(self):
+        summary = self.summary()
+        print("Sync profile: {:.2f}s wall, {:.2f}s CPU in this process".format(
+            summary['wall_seconds'], summary['cpu_seconds']))
+        print("   {:<16} {:>9} {:>10} {:>10}".format('stage', 'calls', 'wall s', 'CPU s'))
+        for name, stage in summary['stages'].items():
+            print("   {:<16} {:>9} {:>10.3f} {:>10.3f}".format(
+                name, stage['calls'], stage['wall_seconds'], stage['cpu_seconds']))
+        counters = summary['counters']
+        print("   {} files observed, {:.1f} MB read".format(counters.get('files', 0), counters.get('bytes_read', 0) / (1000 * 1000)))
+        for entry in summary['slowest_files'][:5]:
+            print("   {:>8.3f}s  {}".format(entry['seconds'], entry['path']))
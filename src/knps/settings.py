@@ -5,6 +5,42 @@ KNPS_SERVER_PROD = os.getenv('KNPS_SERVER_PROD', 'ec2-3-224-14-41.compute-1.amaz
 
 CACHE_FILE_PROCESSING = bool(os.getenv('CASHE_FILE_PROCESSING', True))
 
+# Keep file hashes, line hashes and shingles in a persistent on-disk cache
+# so unchanged files are not re-read on every sync
+USE_HASH_CACHE = os.getenv('KNPS_USE_HASH_CACHE', 'True').lower() not in ('0', 'false', 'no')
+
+# Text files at least this many bytes are shingled with one-permutation
+# MinHash (much cheaper, but not comparable with regular signatures).
+# 0 disables it.
+MINHASH_OPH_BYTES = int(os.getenv('KNPS_MINHASH_OPH_BYTES', 0))
+
+# Compression for uploads: auto (best the server supports), gzip, zstd or
+# identity (never compress)
+PAYLOAD_ENCODING = os.getenv('KNPS_PAYLOAD_ENCODING', 'auto')
+
+# Deliver Logger API records from a background thread in compressed
+# batches, instead of one blocking request per record
+LOG_ASYNC = os.getenv('KNPS_LOG_ASYNC', 'True').lower() not in ('0', 'false', 'no')
+
+# Spool every upload to disk first and send it from there, so collection
+# carries on while the server is unreachable. The spool is capped at
+# SPOOL_MAX_MB; SPOOL_RATE_KBPS limits how fast it is drained (0: no limit)
+USE_SPOOL = os.getenv('KNPS_USE_SPOOL', 'True').lower() not in ('0', 'false', 'no')
+SPOOL_MAX_MB = int(os.getenv('KNPS_SPOOL_MAX_MB', 1024))
+SPOOL_RATE_KBPS = int(os.getenv('KNPS_SPOOL_RATE_KBPS', 0))
+
+# PDF text extraction runs in up to PDF_WORKERS worker processes (0: one
+# per CPU, at most 4; shared between --jobs workers), each limited to
+# PDF_MEMORY_MB of address space. A PDF not done in PDF_TIMEOUT_SECONDS
+# gets no line hashes, and is tried again on the next sync
+PDF_WORKERS = int(os.getenv('KNPS_PDF_WORKERS', 0))
+PDF_MEMORY_MB = int(os.getenv('KNPS_PDF_MEMORY_MB', 1024))
+PDF_TIMEOUT_SECONDS = float(os.getenv('KNPS_PDF_TIMEOUT_SECONDS', 60))
+
+# CSV files at least this many MB are sampled by seeking to evenly spaced
+# byte offsets instead of reading every line. 0 disables it.
+CSV_SEEK_SAMPLE_MB = int(os.getenv('KNPS_CSV_SEEK_SAMPLE_MB', 1024))
+
 # Create a personal.py file in this directory and set any of the above variables
 # to override the default settings without setting environment variables
 try:
@@ -0,0 +1,251 @@
+import contextlib
+import fcntl
+import json
+import os
+import struct
+import threading
+import zlib
+from pathlib import Path
+
+# Segments are rolled over at this size
+SEGMENT_MAX_BYTES = 16 * 1024 * 1024
+
+# Block size for copying a record from a file into a segment
+COPY_BLOCK_SIZE = 1024 * 1024
+
+# Record framing: magic, payload length, CRC-32 of the payload
+MAGIC = b'KNPS'
+HEADER = struct.Struct('<4sII')
+
+class SpoolFull(Exception):
+    pass
+
+#
+# A durable first-in first-out spool of opaque records, in a directory of
+# append-only segment files (segment-00000001, ...). Every record is
+# framed with a length and checksum and fsync'ed before append() returns.
+# A cursor file records how far the reader has got; segments before it
+# are deleted.
+#
+# Appends from several processes are serialized with a lock file. If a
+# writer dies mid-record, the reader skips the damaged bytes and carries
+# on from the next intact record.
+#
+class Spool:
+    def __init__(self, directory, max_bytes):
+        self.dir = Path(directory)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.lock = threading.RLock()
+        self.lock_file = open(self.dir / 'lock', 'a')
+
+    def __segment_path__(self, seq):
+        return self.dir / 'segment-{:08d}'.format(seq)
+
+    def segments(self):
+        return sorted(int(p.name.split('-')[1]) for p in self.dir.glob('segment-*'))
+
+    def size(self):
+        total = 0
+        for seq in self.segments():
+            try:
+                total += self.__segment_path__(seq).stat().st_size
+            except OSError:
+                pass
+        return total
+
+    @contextlib.contextmanager
+    def __locked__(self):
+        with self.lock:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+    #
+    # Append a record: data, followed by the rest of fileobj if one is
+    # given. fileobj is copied a block at a time, so a large record never
+    # has to be in memory.
+    #
+    def append(self, data, fileobj=None):
+        length = len(data)
+        crc = zlib.crc32(data)
+        if fileobj is not None:
+            start = fileobj.tell()
+            for block in iter(lambda: fileobj.read(COPY_BLOCK_SIZE), b''):
+                length += len(block)
+                crc = zlib.crc32(block, crc)
+            fileobj.seek(start)
+
+        header = HEADER.pack(MAGIC, length, crc)
+        with self.__locked__():
+            if self.size() + len(header) + length > self.max_bytes:
+                raise SpoolFull("Spool {} is full ({} bytes)".format(self.dir, self.max_bytes))
+
+            segments = self.segments()
+            if segments:
+                seq = segments[-1]
+            else:
+                cursor_seq, cursor_offset = self.read_cursor()
+                seq = cursor_seq + 1 if cursor_offset else cursor_seq
+            path = self.__segment_path__(seq)
+            if path.exists() and path.stat().st_size + len(header) + length > SEGMENT_MAX_BYTES:
+                seq += 1
+                path = self.__segment_path__(seq)
+
+            with open(path, 'ab') as f:
+                f.write(header + data)
+                if fileobj is not None:
+                    for block in iter(lambda: fileobj.read(COPY_BLOCK_SIZE), b''):
+                        f.write(block)
+                f.flush()
+                os.fsync(f.fileno())
+
+    #
+    # The cursor is (segment, offset) of the first unread record.
+    #
+    def read_cursor(self):
+        try:
+            with open(self.dir / 'cursor', 'rt') as f:
+                cursor = json.load(f)
+            return cursor['segment'], cursor['offset']
+        except (OSError, ValueError, KeyError):
+            segments = self.segments()
+            return (segments[0] if segments else 1), 0
+
+    def __write_cursor__(self, seq, offset, **extra):
+        tmp = self.dir / 'cursor.tmp'
+        with open(tmp, 'wt') as f:
+            json.dump(dict(extra, segment=seq, offset=offset), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.dir / 'cursor')
+
+    #
+    # Read one record from a segment at offset. Returns (data, next_offset),
+    # (None, next_offset) to skip damaged bytes, or (None, None) at the end
+    # of what has been written so far.
+    #
+    def __read_record__(self, f, offset, segment_size):
+        if offset + HEADER.size > segment_size:
+            return None, None
+
+        f.seek(offset)
+        magic, length, crc = HEADER.unpack(f.read(HEADER.size))
+        if magic == MAGIC and offset + HEADER.size + length <= segment_size:
+            data = f.read(length)
+            if zlib.crc32(data) == crc:
+                return data, offset + HEADER.size + length
+
+        if magic == MAGIC and offset + HEADER.size + length > segment_size:
+            # Either still being written or a torn write; only a later
+            # intact record shows which
+            f.seek(offset + 1)
+            if f.read().find(MAGIC) < 0:
+                return None, None
+
+        # Damaged: skip to the next thing that looks like a record
+        f.seek(offset + 1)
+        found = f.read().find(MAGIC)
+        return None, (offset + 1 + found if found >= 0 else segment_size)
+
+    #
+    # Yield (position, data) for every unacknowledged record, in order.
+    # Pass position to ack() once the record has been dealt with.
+    #
+    def records(self):
+        seq, offset = self.read_cursor()
+        while True:
+            with self.__locked__():
+                segments = [x for x in self.segments() if x >= seq]
+                if not segments:
+                    return
+                if segments[0] != seq:
+                    seq, offset = segments[0], 0
+
+                path = self.__segment_path__(seq)
+                segment_size = path.stat().st_size
+                with open(path, 'rb') as f:
+                    data, next_offset = self.__read_record__(f, offset, segment_size)
+                last_segment = seq == segments[-1]
+
+            if next_offset is None:
+                if last_segment:
+                    return
+                seq, offset = seq + 1, 0
+                continue
+
+            offset = next_offset
+            if data is None:
+                continue
+            yield (seq, offset), data
+
+    def ack(self, position):
+        seq, offset = position
+        with self.__locked__():
+            # Everything has been read: start the next record in a new segment
+            segments = self.segments()
+            if segments and seq == segments[-1] and offset == self.__segment_path__(seq).stat().st_size:
+                seq, offset = seq + 1, 0
+
+            self.__write_cursor__(seq, offset)
+            for old in segments:
+                if old < seq:
+                    self.__segment_path__(old).unlink()
+
+    #
+    # Count a failed attempt to deal with the record at position, the
+    # first one not yet acked. The count is kept in the cursor file, so it
+    # carries over to whichever process reads the spool next, and ack()
+    # clears it. Returns the number of attempts so far.
+    #
+    def fail(self, position):
+        with self.__locked__():
+            try:
+                with open(self.dir / 'cursor', 'rt') as f:
+                    cursor = json.load(f)
+            except (OSError, ValueError):
+                cursor = {}
+            attempts = 1
+            if cursor.get('failed') == list(position):
+                attempts += cursor.get('attempts', 0)
+
+            seq, offset = self.read_cursor()
+            self.__write_cursor__(seq, offset, failed=list(position), attempts=attempts)
+        return attempts
+
+    #
+    # Returns (records, bytes) still to be read.
+    #
+    def pending(self):
+        records = 0
+        total = 0
+        for position, data in self.records():
+            records += 1
+            total += len(data)
+        return records, total
+
+    def close(self):
+        self.lock_file.close()
+
+#
+# Held by whichever process is draining a spool, so two processes never
+# send the same records.
+#
+class DrainLock:
+    def __init__(self, directory):
+        self.f = open(Path(directory, 'drain.lock'), 'a')
+
+    def acquire(self):
+        try:
+            fcntl.flock(self.f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            return False
+
+    def release(self):
+        fcntl.flock(self.f, fcntl.LOCK_UN)
+
+    def close(self):
+        self.f.close()
@@ -0,0 +1,315 @@
+#
+# A small stand-in for the KNPS server, for exercising the client locally
+# without the dev or prod servers. It accepts uploads, decodes them the
+# way the real server would, and keeps counters instead of a graph.
+#
+#   python -m knps.standin_server --port 5000
+#   knps --server 127.0.0.1:5000
+#
+# It can also be made slow, flaky or narrow, to see how the client copes:
+#
+#   python -m knps.standin_server --latency-ms 50 --error-rate 0.1 --max-kbps 512
+#
+# The same settings can be changed while it runs with POST /control and a
+# JSON body, e.g. {"error_rate": 1} to take it "down" and {"error_rate": 0}
+# to bring it back; {"reset": true} zeroes the counters in GET /stats.
+#
+import argparse
+import email.parser
+import email.policy
+import json
+import random
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from knps.blobs import BLOB_BLOCK_SIZE, BlobError, BlobStore
+from knps.payload import decode_payload, supported_encodings
+
+#
+# Split a multipart/form-data body into {name: bytes}.
+#
+def parse_form(content_type, body):
+    if not content_type.startswith('multipart/form-data'):
+        return {}
+
+    header = 'Content-Type: {}\r\nMIME-Version: 1.0\r\n\r\n'.format(content_type).encode()
+    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(header + body)
+
+    fields = {}
+    for part in message.iter_parts():
+        name = part.get_param('name', header='content-disposition')
+        if name:
+            fields[name] = part.get_payload(decode=True)
+    return fields
+
+class StandInState:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {
+            'requests': 0,
+            'bytes_received': 0,
+            'observations': 0,
+            'processes': 0,
+            'log_records': 0,
+            'blobs': 0,
+            'blob_bytes': 0,
+            'adornments': 0,
+            'datasets': 0,
+            'bytes_sent': 0,
+            'failures_injected': 0,
+        }
+
+    def add(self, **counts):
+        with self.lock:
+            for key, value in counts.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def reset(self):
+        with self.lock:
+            for key in self.counters:
+                self.counters[key] = 0
+
+#
+# Injected faults. Every upload (POST or PUT) waits latency_ms plus up to
+# jitter_ms before it is handled and fails with a 503 with probability
+# error_rate. Request bodies are read no faster than max_kbps across all
+# connections (0: no limit).
+#
+class Faults:
+    SETTINGS = ('latency_ms', 'jitter_ms', 'error_rate', 'max_kbps')
+
+    def __init__(self, latency_ms=0, jitter_ms=0, error_rate=0.0, max_kbps=0, seed=None):
+        self.lock = threading.Lock()
+        self.random = random.Random(seed)
+        self.latency_ms = float(latency_ms)
+        self.jitter_ms = float(jitter_ms)
+        self.error_rate = float(error_rate)
+        self.max_kbps = float(max_kbps)
+        self.next_free = time.monotonic()
+
+    def update(self, settings):
+        with self.lock:
+            for key in self.SETTINGS:
+                if key in settings:
+                    setattr(self, key, type(getattr(self, key))(settings[key]))
+
+    def snapshot(self):
+        with self.lock:
+            return {key: getattr(self, key) for key in self.SETTINGS}
+
+    def delay(self):
+        with self.lock:
+            delay = self.latency_ms + self.random.uniform(0, self.jitter_ms)
+        if delay:
+            time.sleep(delay / 1000)
+
+    def should_fail(self):
+        with self.lock:
+            return self.error_rate > 0 and self.random.random() < self.error_rate
+
+    #
+    # Wait until nbytes more fit under the throughput limit
+    #
+    def throttle(self, nbytes):
+        with self.lock:
+            if not self.max_kbps:
+                return
+            now = time.monotonic()
+            start = max(now, self.next_free)
+            self.next_free = start + nbytes / (self.max_kbps * 1024)
+            wait = self.next_free - now
+        time.sleep(wait)
+
+class StandInHandler(BaseHTTPRequestHandler):
+    state = None
+    blobs = None
+    faults = None
+    verbose = False
+
+    def send_json(self, obj, status=200):
+        body = json.dumps(obj).encode()
+        self.state.add(bytes_sent=len(body))
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        return b''.join(self.iter_body())
+
+    #
+    # Yield the request body a block at a time, whether it has a
+    # Content-Length or is sent with chunked transfer encoding.
+    #
+    def iter_body(self):
+        self.state.add(requests=1)
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if size == 0:
+                    while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+                        pass
+                    return
+                data = self.rfile.read(size)
+                self.rfile.readline()
+                self.faults.throttle(len(data))
+                self.state.add(bytes_received=len(data))
+                yield data
+        else:
+            remaining = int(self.headers.get('Content-Length', 0))
+            while remaining > 0:
+                data = self.rfile.read(min(remaining, BLOB_BLOCK_SIZE))
+                if not data:
+                    return
+                remaining -= len(data)
+                self.faults.throttle(len(data))
+                self.state.add(bytes_received=len(data))
+                yield data
+
+    def do_GET(self):
+        if self.path == '/capabilities':
+            self.send_json({'encodings': supported_encodings(), 'log_batch': True, 'blobs': True})
+        elif self.path == '/stats':
+            self.send_json(self.state.snapshot())
+        elif self.path == '/control':
+            self.send_json(self.faults.snapshot())
+        elif self.path.startswith('/blobs/'):
+            try:
+                self.send_json({'offset': self.blobs.offset(self.path.rsplit('/', 1)[1])})
+            except BlobError as e:
+                self.send_json({'error': str(e)}, 400)
+        else:
+            self.send_json({'error': 'Not found'}, 404)
+
+    #
+    # PUT /blobs/<user>/<hash>?offset=N&size=S: the body is bytes N..S of
+    # the blob. Returns how many bytes are now held.
+    #
+    def do_PUT(self):
+        url = urlsplit(self.path)
+        if not url.path.startswith('/blobs/'):
+            self.send_json({'error': 'Not found'}, 404)
+            return
+
+        if self.__inject_failure__():
+            return
+
+        query = parse_qs(url.query)
+        blob_hash = url.path.rsplit('/', 1)[1]
+        size = int(query.get('size', ['0'])[0])
+        try:
+            held = self.blobs.write(blob_hash, int(query.get('offset', ['0'])[0]), size, self.iter_body())
+        except BlobError as e:
+            self.close_connection = True
+            self.send_json({'error': str(e)}, 409 if 'offset' in str(e) else 422)
+            return
+
+        if held >= size:
+            self.state.add(blobs=1, blob_bytes=size)
+        self.send_json({'offset': held})
+
+    #
+    # Apply the injected latency and error rate to an upload. Returns True
+    # (having sent a 503) if it is to fail.
+    #
+    def __inject_failure__(self):
+        self.faults.delay()
+        if not self.faults.should_fail():
+            return False
+
+        for block in self.iter_body():
+            pass
+        self.state.add(failures_injected=1)
+        self.send_json({'error': 'Injected failure'}, 503)
+        return True
+
+    def do_POST(self):
+        if self.path == '/control':
+            settings = json.loads(self.read_body() or b'{}')
+            self.faults.update(settings)
+            if settings.get('reset'):
+                self.state.reset()
+            self.send_json(self.faults.snapshot())
+            return
+
+        if self.__inject_failure__():
+            return
+
+        body = self.read_body()
+        fields = parse_form(self.headers.get('Content-Type', ''), body)
+
+        if self.path.startswith('/synclist/'):
+            encoding = fields.get('encoding', b'').decode() or None
+            observations = json.loads(decode_payload(fields['observations'], encoding))
+            self.state.add(observations=len(observations))
+            self.send_json({})
+        elif self.path == '/log':
+            json.loads(body)
+            self.state.add(log_records=1)
+            self.send_json({})
+        elif self.path == '/log/batch':
+            records = json.loads(decode_payload(body, self.headers.get('Content-Encoding')))
+            self.state.add(log_records=len(records))
+            self.send_json({})
+        elif self.path.startswith('/syncprocess/'):
+            self.state.add(processes=1)
+            self.send_json({})
+        elif self.path.startswith('/adorn/'):
+            json.loads(fields['filename'])
+            json.loads(fields['comment'])
+            self.state.add(adornments=1)
+            self.send_json({})
+        elif self.path.startswith('/createdataset/'):
+            for name in ('id', 'title', 'desc', 'targetHash'):
+                json.loads(fields[name])
+            self.state.add(datasets=1)
+            self.send_json({})
+        elif self.path.startswith('/blobs/missing/'):
+            self.send_json({'missing': self.blobs.missing(json.loads(fields['hashes']))})
+        else:
+            self.send_json({'error': 'Not found'}, 404)
+
+    def log_message(self, format, *args):
+        if self.verbose:
+            super().log_message(format, *args)
+
+def make_server(host='127.0.0.1', port=5000, verbose=False, blob_dir=None, faults=None):
+    if blob_dir is None:
+        blob_dir = tempfile.mkdtemp(prefix='knps-blobs-')
+    handler = type('Handler', (StandInHandler,), {'state': StandInState(),
+                                                  'blobs': BlobStore(blob_dir),
+                                                  'faults': faults or Faults(),
+                                                  'verbose': verbose})
+    return ThreadingHTTPServer((host, port), handler)
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in KNPS server')
+    parser.add_argument("--host", default='127.0.0.1', help="Address to listen on")
+    parser.add_argument("--port", type=int, default=5000, help="Port to listen on")
+    parser.add_argument("--verbose", action="store_true", help="Log every request")
+    parser.add_argument("--blob-dir", help="Where to keep uploaded blobs (default: a new temporary directory)")
+    parser.add_argument("--latency-ms", type=float, default=0, help="Delay every upload by this much")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="Plus a random delay of up to this much")
+    parser.add_argument("--error-rate", type=float, default=0, help="Fraction of uploads that fail with a 503")
+    parser.add_argument("--max-kbps", type=float, default=0, help="Limit on upload throughput, in KB/s (0: none)")
+    parser.add_argument("--seed", type=int, help="Seed for the injected jitter and failures")
+    args = parser.parse_args()
+
+    faults = Faults(args.latency_ms, args.jitter_ms, args.error_rate, args.max_kbps, args.seed)
+    server = make_server(args.host, args.port, args.verbose, args.blob_dir, faults)
+    print("KNPS stand-in server listening on {}:{}".format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
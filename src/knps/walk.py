@@ -0,0 +1,180 @@
+import fnmatch
+import os
+import queue
+import threading
+from pathlib import Path
+
+IGNORE_FILE = '.knpsignore'
+
+# knps' own files and directories (.knps config dirs, ~/.knps_spool,
+# ~/.knps_hash_cache and its -wal/-shm files, .knpsignore, ...) are never
+# synced
+KNPS_PREFIX = '.knps'
+
+# Entries buffered between the per-root scanner threads and the consumer
+SCAN_QUEUE_SIZE = 10000
+
+#
+# Ignore rules, read from ~/.knpsignore and from a .knpsignore at the top
+# of each watched directory. One glob pattern per line; blank lines and
+# lines starting with '#' are skipped. Anything whose name starts with
+# .knps is always ignored.
+#
+#   node_modules      any file or directory with this name
+#   *.tmp             any name matching the glob
+#   scratch/          directories only
+#   build/output      a path relative to the watched directory
+#
+class IgnoreRules:
+    def __init__(self, patterns=()):
+        self.name_patterns = []
+        self.dir_patterns = []
+        self.path_patterns = []
+        for pattern in patterns:
+            self.add(pattern)
+
+    def add(self, pattern):
+        pattern = pattern.strip()
+        if not pattern or pattern.startswith('#'):
+            return
+        if pattern.endswith('/'):
+            self.dir_patterns.append(pattern.rstrip('/'))
+        elif '/' in pattern:
+            self.path_patterns.append(pattern.lstrip('/'))
+        else:
+            self.name_patterns.append(pattern)
+
+    #
+    # The files the rules for a watched directory are read from
+    #
+    @staticmethod
+    def sources(root):
+        return [Path(Path.home(), IGNORE_FILE), Path(root, IGNORE_FILE)]
+
+    @classmethod
+    def for_root(cls, root):
+        rules = cls()
+        for p in cls.sources(root):
+            try:
+                with open(p, 'rt') as f:
+                    for line in f:
+                        rules.add(line)
+            except OSError:
+                pass
+        return rules
+
+    def ignored(self, name, relpath, is_dir):
+        if name.startswith(KNPS_PREFIX):
+            return True
+        for pattern in self.name_patterns:
+            if fnmatch.fnmatch(name, pattern):
+                return True
+        if is_dir:
+            for pattern in self.dir_patterns:
+                if fnmatch.fnmatch(name, pattern):
+                    return True
+        for pattern in self.path_patterns:
+            if fnmatch.fnmatch(relpath, pattern):
+                return True
+        return False
+
+    #
+    # Would a walk from root skip this path (or any directory above it)?
+    #
+    def ignores_path(self, root, path):
+        relpath = os.path.relpath(path, root)
+        if relpath.startswith('..'):
+            return True
+
+        parts = relpath.split(os.sep)
+        for i, name in enumerate(parts):
+            is_dir = i < len(parts) - 1
+            if self.ignored(name, '/'.join(parts[:i + 1]), is_dir):
+                return True
+        return False
+
+#
+# Lazily yield (path, DirEntry) for every file under root. The DirEntry
+# caches its stat result, so callers that need one don't stat twice.
+# Like os.walk, symlinked directories are listed but not followed.
+#
+def scan_tree(root, rules=None):
+    root = str(root)
+    if rules is None:
+        rules = IgnoreRules.for_root(root)
+
+    stack = [(root, '')]
+    while stack:
+        directory, reldir = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    relpath = reldir + '/' + entry.name if reldir else entry.name
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+
+                    if rules.ignored(entry.name, relpath, is_dir):
+                        continue
+
+                    if is_dir:
+                        if not entry.is_symlink():
+                            stack.append((entry.path, relpath))
+                    else:
+                        yield entry.path, entry
+        except OSError:
+            # Vanished or unreadable directories are skipped, as os.walk does
+            continue
+
+#
+# Yield (path, DirEntry) for every file under all roots. Several roots are
+# scanned concurrently, one thread each, feeding a bounded queue so memory
+# stays flat however many files there are.
+#
+def iter_files(roots):
+    roots = [str(r) for r in roots]
+    if len(roots) <= 1:
+        for root in roots:
+            yield from scan_tree(root)
+        return
+
+    entries = queue.Queue(maxsize=SCAN_QUEUE_SIZE)
+    done = object()
+    stop = threading.Event()
+
+    def scan(root):
+        try:
+            for item in scan_tree(root):
+                while not stop.is_set():
+                    try:
+                        entries.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+        finally:
+            entries.put(done)
+
+    threads = [threading.Thread(target=scan, args=(root,), daemon=True) for root in roots]
+    for t in threads:
+        t.start()
+
+    remaining = len(threads)
+    try:
+        while remaining:
+            item = entries.get()
+            if item is done:
+                remaining -= 1
+            else:
+                yield item
+    finally:
+        # The consumer may stop early; let the scanners exit
+        stop.set()
+        while remaining and any(t.is_alive() for t in threads):
+            try:
+                if entries.get(timeout=0.1) is done:
+                    remaining -= 1
+            except queue.Empty:
+                pass
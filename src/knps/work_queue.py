@@ -0,0 +1,85 @@
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+# Chunks fetched from the database at a time while iterating
+PAGE_SIZE = 100
+
+#
+# The sync work queue: the chunks of files still to be observed and
+# uploaded, per user. Chunks get unique, increasing ids and each enqueue
+# or ack is a single small transaction, so an interrupted sync resumes
+# from the first unacknowledged chunk without rewriting anything else.
+#
+class WorkQueue:
+    def __init__(self, path, username):
+        self.path = Path(path)
+        self.username = username
+        self.lock = threading.RLock()
+
+        self.conn = sqlite3.connect(str(self.path), timeout=60, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS chunks ('
+                              'id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT, '
+                              'files TEXT, file_count INTEGER, created REAL)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS chunks_username ON chunks (username, id)')
+
+    def enqueue(self, files):
+        return self.enqueue_many([files])[0]
+
+    def enqueue_many(self, chunks):
+        now = time.time()
+        ids = []
+        with self.lock, self.conn:
+            for files in chunks:
+                cursor = self.conn.execute('INSERT INTO chunks (username, files, file_count, created) '
+                                           'VALUES (?, ?, ?, ?)',
+                                           (self.username, json.dumps(files), len(files), now))
+                ids.append(cursor.lastrowid)
+        return ids
+
+    def ack(self, chunk_id):
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM chunks WHERE id = ? AND username = ?', (int(chunk_id), self.username))
+
+    def clear(self):
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM chunks WHERE username = ?', (self.username,))
+
+    def first(self):
+        for chunk in self.pending():
+            return chunk
+        return None
+
+    #
+    # Iterate over (chunk_id, files) in enqueue order. Chunks acked while
+    # iterating are simply not returned again.
+    #
+    def pending(self):
+        last_id = 0
+        while True:
+            with self.lock:
+                rows = self.conn.execute('SELECT id, files FROM chunks WHERE username = ? AND id > ? '
+                                         'ORDER BY id LIMIT ?', (self.username, last_id, PAGE_SIZE)).fetchall()
+            if not rows:
+                return
+            for chunk_id, files in rows:
+                last_id = chunk_id
+                yield chunk_id, json.loads(files)
+
+    #
+    # Returns (pending chunks, pending files).
+    #
+    def counts(self):
+        with self.lock:
+            row = self.conn.execute('SELECT COUNT(*), COALESCE(SUM(file_count), 0) FROM chunks '
+                                    'WHERE username = ?', (self.username,)).fetchone()
+        return row[0], row[1]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
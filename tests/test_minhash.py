@@ -0,0 +1,103 @@
+import hashlib
+import random
+import re
+
+import pytest
+
+from knps import knps_cli
+from knps.knps_cli import MinHash, ShingleHasher, getShingles, minhash
+
+#
+# The MinHash signatures computed before it was vectorized: for each
+# permutation, a dict from permuted value to fingerprint (so the last
+# fingerprint with the minimum wins), using Python big-int arithmetic.
+# Signatures already on the server were made this way, so the current
+# code has to match it exactly.
+#
+def reference_minhash(all_shingles, num_shingles=10, fingerprint_bytes=8):
+    random.seed(0)
+    shingles = []
+    if all_shingles:
+        for i in range(num_shingles):
+            factor = int(random.random()*(256**fingerprint_bytes))
+            shift = int(random.random()*(256**fingerprint_bytes))
+            new_shingles = {}
+            for shingle in all_shingles:
+                new_shingles[(factor*shingle+shift)%(256**fingerprint_bytes)] = shingle
+            minimum = min(new_shingles.keys())
+            shingles.append(str(new_shingles[minimum]))
+    return shingles
+
+def reference_fingerprints(s, shingle_length=5, fingerprint_bytes=8):
+    words = re.sub(r'[^\w\s]', '', s).lower().split()
+    if len(words) <= shingle_length:
+        return {int.from_bytes(hashlib.sha256(words.__str__().encode()).digest()[:fingerprint_bytes], 'little')}
+    return [int.from_bytes(hashlib.sha256(words[i:i+shingle_length].__str__().encode()).digest()[:fingerprint_bytes], 'little')
+            for i in range(len(words)-shingle_length)]
+
+#
+# Run each test with the NumPy path and with the pure-Python fallback
+#
+@pytest.fixture(params=['numpy', 'python'])
+def engine(request, monkeypatch):
+    if request.param == 'numpy':
+        pytest.importorskip('numpy')
+        # Small batches, so signatures span several vectorized flushes
+        monkeypatch.setattr(knps_cli, 'MINHASH_BATCH_SIZE', 7)
+    else:
+        monkeypatch.setattr(knps_cli, 'load_numpy', lambda: None)
+    return request.param
+
+def test_engine_is_used(engine):
+    assert MinHash().vectorized == (engine == 'numpy')
+
+def test_empty(engine):
+    assert minhash([]) == reference_minhash([]) == []
+
+def test_single_shingle(engine):
+    for shingle in [0, 1, 12345, 2**64 - 1]:
+        assert minhash([shingle]) == reference_minhash([shingle]) == [str(shingle)] * 10
+
+@pytest.mark.parametrize('shingles', [
+    [1, 2, 3, 4, 5],
+    [5, 4, 3, 2, 1],
+    [7, 7, 7, 3, 3, 9],
+    list(range(100)),
+])
+def test_fixed_sets(engine, shingles):
+    assert minhash(shingles) == reference_minhash(shingles)
+
+# factor * shingle overflows 64 bits for almost any 8-byte fingerprint;
+# uint64 arithmetic has to wrap exactly like % 256**8
+def test_uint64_wrap(engine):
+    shingles = [2**64 - 1, 2**64 - 2, 2**63, 2**63 - 1, 2**32, 2**32 - 1, 0]
+    assert minhash(shingles) == reference_minhash(shingles)
+
+@pytest.mark.parametrize('seed', range(5))
+def test_random_sets(engine, seed):
+    rand = random.Random(seed)
+    shingles = [rand.getrandbits(64) for i in range(rand.randint(1, 500))]
+    # Some repeats, which tie on every permutation
+    shingles += rand.sample(shingles, len(shingles) // 10)
+    assert minhash(shingles) == reference_minhash(shingles)
+
+@pytest.mark.parametrize('fingerprint_bytes', [2, 4])
+def test_shorter_fingerprints(engine, fingerprint_bytes):
+    rand = random.Random(fingerprint_bytes)
+    shingles = [rand.getrandbits(8 * fingerprint_bytes) for i in range(300)]
+    assert minhash(shingles, fingerprint_bytes=fingerprint_bytes) == reference_minhash(shingles, fingerprint_bytes=fingerprint_bytes)
+
+@pytest.mark.parametrize('text', [
+    '',
+    'one',
+    'Just five words, no more.',
+    'The quick brown fox jumps over the lazy dog.\nThe quick brown fox naps!\n' * 20,
+])
+def test_text_signatures(engine, text):
+    expected = reference_minhash(reference_fingerprints(text))
+    assert getShingles(text, None, 'text/plain') == expected
+
+    hasher = ShingleHasher()
+    for line in text.splitlines(keepends=True):
+        hasher.feed(line)
+    assert hasher.signature() == expected
@@ -0,0 +1,51 @@
+import io
+
+import pytest
+import requests
+
+from knps.payload import MultipartStream, write_json_array
+
+FIELDS = {'username': 'alice', 'access_token': 'INSECURE_TOKEN_alice'}
+
+def requests_body(fields, files, boundary):
+    request = requests.Request('POST', 'http://localhost/', data=fields, files=files).prepare()
+    # requests picks its own boundary; put ours in its place
+    old = request.headers['Content-Type'].split('boundary=')[1]
+    return request.body.replace(old.encode(), boundary.encode())
+
+def read_all(stream, size):
+    data = b''
+    while True:
+        block = stream.read(size)
+        if not block:
+            return data
+        data += block
+
+@pytest.mark.parametrize('size', [-1, 1, 7, 8192])
+def test_matches_requests_encoding(size):
+    payload = b'[{"metadata": {"file_name": "a.txt"}}]' * 100
+    stream = MultipartStream(FIELDS, 'observations', 'observations', payload, boundary='b0undary')
+    expected = requests_body(FIELDS, {'observations': payload}, 'b0undary')
+    assert len(stream) == len(expected)
+    assert read_all(stream, size) == expected
+    assert stream.content_type == 'multipart/form-data; boundary=b0undary'
+
+def test_file_part_with_content_type():
+    fields = dict(FIELDS, encoding='gzip')
+    payload = write_json_array(({'i': i} for i in range(1000)), 'gzip')
+    compressed = payload.read()
+    payload.seek(0)
+
+    stream = MultipartStream(fields, 'observations', 'observations.json', payload,
+                             'application/octet-stream', boundary='b0undary')
+    files = {'observations': ('observations.json', compressed, 'application/octet-stream')}
+    expected = requests_body(fields, files, 'b0undary')
+    assert len(stream) == len(expected)
+    assert read_all(stream, 4096) == expected
+
+# A file object is sent from where it is positioned, as requests does
+def test_starts_at_file_position():
+    payload = io.BytesIO(b'skipped' + b'sent')
+    payload.seek(len(b'skipped'))
+    stream = MultipartStream(FIELDS, 'observations', 'observations', payload, boundary='b0undary')
+    assert read_all(stream, -1) == requests_body(FIELDS, {'observations': b'sent'}, 'b0undary')
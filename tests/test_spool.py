@@ -0,0 +1,86 @@
+import json
+import threading
+
+import pytest
+
+from knps import knps_cli
+from knps.knps_cli import SpoolReplayer, User, spool_payload
+from knps.spool import Spool
+from knps.standin_server import StandInHandler, make_server
+
+#
+# A stand-in server that turns down every synclist with a 400
+#
+@pytest.fixture
+def rejecting_server(tmp_path):
+    server = make_server('127.0.0.1', 0, blob_dir=str(tmp_path / 'blobs'))
+    handler = server.RequestHandlerClass
+
+    def do_POST(self):
+        if self.path.startswith('/synclist/'):
+            self.read_body()
+            self.send_json({'error': 'Bad synclist'}, 400)
+        else:
+            StandInHandler.do_POST(self)
+    handler.do_POST = do_POST
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def user(tmp_path, monkeypatch, rejecting_server):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    user = User()
+    user.set_server('127.0.0.1:{}'.format(rejecting_server.server_address[1]))
+    user.login('alice')
+    return user
+
+def spool_synclist(user, path):
+    header = {'kind': 'synclist', 'encoding': None, 'files': [[path, 'hash-of-' + path]]}
+    assert spool_payload(user, header, json.dumps([]).encode()) == {}
+
+def test_fail_counts_survive_reopening(tmp_path):
+    spool = Spool(tmp_path / 'spool', 1024 * 1024)
+    spool.append(b'first')
+    spool.append(b'second')
+    position, data = next(spool.records())
+    assert spool.fail(position) == 1
+    assert spool.fail(position) == 2
+
+    spool = Spool(tmp_path / 'spool', 1024 * 1024)
+    assert spool.fail(position) == 3
+
+    spool.ack(position)
+    position, data = next(spool.records())
+    assert data == b'second'
+    assert spool.fail(position) == 1
+
+# Each run of knps gets a new replayer. The attempts a rejected record has
+# had must add up across them, or a record that is turned down every time
+# holds up the spool forever when no single run retries it often enough.
+def test_rejected_record_unblocks_spool_across_replayers(user):
+    spool_synclist(user, '/data/rejected.txt')
+    spool_synclist(user, '/data/behind.txt')
+    first_run = knps_cli.SPOOL_MAX_ATTEMPTS // 2
+
+    replayer = SpoolReplayer(user)
+    for i in range(first_run):
+        assert not replayer.drain()
+    assert replayer.rejected == 0
+
+    replayer = SpoolReplayer(User())
+    for i in range(knps_cli.SPOOL_MAX_ATTEMPTS - first_run - 1):
+        assert not replayer.drain()
+    assert replayer.rejected == 0
+
+    # The last attempt for the first record moves it aside; the one behind
+    # it is now at the head of the spool with a fresh count
+    assert not replayer.drain()
+    assert replayer.rejected == 1
+    assert user.get_spool().pending()[0] == 1
+
+    rejected = [json.loads(line) for line in (user.get_spool().dir / 'rejected').read_text().splitlines()]
+    assert [record['error'] for record in rejected] == ['Bad synclist']